@@ -0,0 +1,174 @@
+# Reportes de nutrición vectorizados con NumPy. El historial se carga una vez
+# en columnas (ts, tolva, gramos, kcal, alimento) y los totales por día, tolva
+# y alimento salen de np.bincount, sin bucles por fila en Python.
+#
+# Para rangos más largos que la retención (RETENTION_DAYS) usar load_daily(),
+# que lee los acumulados de history_daily.
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+# Tolvas 1..HOPPERS (como en la pantalla); la columna de la tolva h es h - 1
+HOPPERS = 3
+
+
+def day_bounds(start_day, end_day):
+    # Medianoches locales [start_day, end_day + 1] como timestamps; con
+    # searchsorted cada ts cae en su día aunque haya cambio de horario
+    n = (end_day - start_day).days + 1
+    days = [start_day + timedelta(days=i) for i in range(n)]
+    bounds = [datetime(d.year, d.month, d.day).timestamp() for d in days]
+    last = end_day + timedelta(days=1)
+    bounds.append(datetime(last.year, last.month, last.day).timestamp())
+    return days, np.asarray(bounds, dtype=np.float64)
+
+
+class HistoryFrame:
+
+    def __init__(self, days, ts, hopper, grams, kcal, food, food_names):
+        self.days = days              # [date], uno por índice de día
+        self.ts = ts                  # int64
+        self.hopper = hopper          # int64
+        self.grams = grams            # float64
+        self.kcal = kcal              # float64
+        self.food = food              # int64, índice en food_names
+        self.food_names = food_names  # [str]
+        _, bounds = day_bounds(days[0], days[-1])
+        self.day = np.searchsorted(bounds, ts, side="right") - 1
+
+    def __len__(self):
+        return len(self.ts)
+
+    @classmethod
+    def load(cls, db, start_day, end_day, batch=5000):
+        # start_day/end_day: date (inclusive)
+        days, bounds = day_bounds(start_day, end_day)
+        ts, hopper, grams, kcal, food = [], [], [], [], []
+        codes = {}  # nombre -> índice, en orden de aparición
+        for rows in db.history_range(bounds[0], bounds[-1], batch):
+            cols = list(zip(*rows))
+            ts.append(np.asarray(cols[0], dtype=np.int64))
+            hopper.append(np.asarray(cols[1], dtype=np.int64))
+            grams.append(np.asarray(cols[2], dtype=np.float64))
+            kcal.append(np.asarray(cols[3], dtype=np.float64))
+            food.append(np.asarray([codes.setdefault(n, len(codes)) for n in cols[4]], dtype=np.int64))
+
+        def _cat(parts, dtype):
+            return np.concatenate(parts) if parts else np.empty(0, dtype=dtype)
+
+        return cls(
+            days,
+            _cat(ts, np.int64),
+            _cat(hopper, np.int64),
+            _cat(grams, np.float64),
+            _cat(kcal, np.float64),
+            _cat(food, np.int64),
+            list(codes),
+        )
+
+    def per_day(self):
+        # (gramos[n_días], kcal[n_días])
+        n = len(self.days)
+        return (
+            np.bincount(self.day, weights=self.grams, minlength=n),
+            np.bincount(self.day, weights=self.kcal, minlength=n),
+        )
+
+    def per_day_hopper(self):
+        # (gramos[n_días, HOPPERS], kcal[n_días, HOPPERS])
+        n = len(self.days)
+        idx = self.day * HOPPERS + np.clip(self.hopper - 1, 0, HOPPERS - 1)
+        shape = (n, HOPPERS)
+        return (
+            np.bincount(idx, weights=self.grams, minlength=n * HOPPERS).reshape(shape),
+            np.bincount(idx, weights=self.kcal, minlength=n * HOPPERS).reshape(shape),
+        )
+
+    def per_food(self):
+        # {alimento: (gramos, kcal, raciones)} ordenado por kcal descendente
+        n = len(self.food_names)
+        grams = np.bincount(self.food, weights=self.grams, minlength=n)
+        kcal = np.bincount(self.food, weights=self.kcal, minlength=n)
+        count = np.bincount(self.food, minlength=n)
+        order = np.argsort(-kcal, kind="stable")
+        return {
+            self.food_names[i]: (float(grams[i]), float(kcal[i]), int(count[i]))
+            for i in order
+        }
+
+
+def load_daily(db, start_day, end_day):
+    # Acumulados diarios (sobreviven a prune_history):
+    # (días, gramos[n_días, HOPPERS], kcal[n_días, HOPPERS])
+    days, _ = day_bounds(start_day, end_day)
+    index = {d.isoformat(): i for i, d in enumerate(days)}
+    grams = np.zeros((len(days), HOPPERS))
+    kcal = np.zeros((len(days), HOPPERS))
+    for hopper in range(1, HOPPERS + 1):
+        for day, g, c, _ in db.daily_totals(days[0].isoformat(), days[-1].isoformat(), hopper):
+            i = index.get(day)
+            if i is not None:
+                grams[i, hopper - 1] = g
+                kcal[i, hopper - 1] = c
+    return days, grams, kcal
+
+
+def moving_average(values, window=7):
+    # Media móvil de los últimos `window` valores; NaN mientras no hay suficientes
+    values = np.asarray(values, dtype=np.float64)
+    out = np.full(values.shape, np.nan)
+    if window <= 0 or len(values) < window:
+        return out
+    csum = np.cumsum(np.insert(values, 0, 0.0))
+    out[window - 1:] = (csum[window:] - csum[:-window]) / window
+    return out
+
+
+def anomalies(values, window=7, z=3.0):
+    # True donde el valor se aleja más de z desviaciones de la media de los
+    # `window` días anteriores (sin incluirse a sí mismo)
+    values = np.asarray(values, dtype=np.float64)
+    flags = np.zeros(values.shape, dtype=bool)
+    if len(values) <= window:
+        return flags
+    c1 = np.cumsum(np.insert(values, 0, 0.0))
+    c2 = np.cumsum(np.insert(values * values, 0, 0.0))
+    mean = (c1[window:-1] - c1[:-window - 1]) / window
+    var = (c2[window:-1] - c2[:-window - 1]) / window - mean * mean
+    std = np.sqrt(np.maximum(var, 0.0))
+    x = values[window:]
+    # Con desviación 0 cualquier cambio cuenta como anomalía
+    flags[window:] = np.where(std > 0, np.abs(x - mean) > z * std, x != mean)
+    return flags
+
+
+# Versiones por lote de DB.calories_for_grams / DB.grams_for_calories
+def calories_for_grams(grams, grams_per_portion, calories_per_portion):
+    grams = np.asarray(grams, dtype=np.float64)
+    gpp = np.asarray(grams_per_portion, dtype=np.float64)
+    cpp = np.asarray(calories_per_portion, dtype=np.float64)
+    safe = np.where(gpp > 0, gpp, 1.0)
+    return np.where(gpp > 0, grams / safe * cpp, 0.0)
+
+
+def grams_for_calories(calories, grams_per_portion, calories_per_portion):
+    calories = np.asarray(calories, dtype=np.float64)
+    gpp = np.asarray(grams_per_portion, dtype=np.float64)
+    cpp = np.asarray(calories_per_portion, dtype=np.float64)
+    safe = np.where(cpp > 0, cpp, 1.0)
+    return np.where(cpp > 0, calories / safe * gpp, 0.0)
+
+
+def summary(db, today=None, window=7):
+    # Resumen para la pantalla de historial: kcal de hoy, media móvil y si
+    # hoy es anómalo, a partir de los acumulados de los últimos 4 ventanas
+    today = today or date.today()
+    days, _, kcal = load_daily(db, today - timedelta(days=4 * window - 1), today)
+    per_day = kcal.sum(axis=1)
+    avg = moving_average(per_day[:-1], window)
+    flags = anomalies(per_day, window)
+    return {
+        "today_kcal": float(per_day[-1]),
+        "avg_kcal": float(avg[-1]) if len(avg) and not np.isnan(avg[-1]) else None,
+        "anomaly": bool(flags[-1]),
+    }
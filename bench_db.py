@@ -0,0 +1,180 @@
+# Benchmarks de models.DB con volúmenes de producción.
+# Llena una base temporal, mide cada método de DB y el tick del scheduler, y
+# compara contra una línea base guardada.
+#
+#   python bench_db.py --preset production --save bench_baseline.json
+#   python bench_db.py --preset production --baseline bench_baseline.json
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+from time import perf_counter, time
+
+from models import DB
+
+PRESETS = {
+    "small": {"foods": 1000, "history": 100000, "schedules": 10000},
+    "production": {"foods": 10000, "history": 1000000, "schedules": 100000},
+}
+
+
+def populate(db, foods, history, schedules, seed=1):
+    rng = random.Random(seed)
+    now = int(time())
+    conn = db.conn
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO foods(name, grams_per_portion, calories_per_portion) VALUES(?,?,?)",
+            ((f"Alimento {i:06d}", 100.0, float(rng.randint(50, 500))) for i in range(foods))
+        )
+    food_ids = [r[0] for r in conn.execute("SELECT id FROM foods;")]
+    year = 365 * 24 * 3600
+    with conn:
+        conn.executemany(
+            "INSERT INTO history(food_name, hopper_index, grams, calories, ts) VALUES(?,?,?,?,?)",
+            ((f"Alimento {rng.randrange(foods):06d}", rng.randint(1, 3), 50.0, 100.0,
+              now - rng.randrange(year)) for _ in range(history))
+        )
+    # Programaciones: la mayoría ya ejecutadas (pasado), el resto futuras
+    with conn:
+        conn.executemany(
+            "INSERT INTO schedules(food_id, hopper_index, grams, when_ts, executed) VALUES(?,?,?,?,?)",
+            ((rng.choice(food_ids), rng.randint(1, 3), 50.0, ts, 1 if ts < now else 0)
+             for ts in (now + rng.randrange(-year, year // 12) for _ in range(schedules)))
+        )
+    # Descarta la caché cargada durante la migración
+    db._foods_by_id = None
+    return food_ids
+
+
+def timeit(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        t0 = perf_counter()
+        fn()
+        samples.append(perf_counter() - t0)
+    samples.sort()
+    return {
+        "n": repeat,
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 4),
+        "p50_ms": round(samples[len(samples) // 2] * 1000, 4),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 4),
+    }
+
+
+def run(foods, history, schedules, repeat=20, seed=1):
+    workdir = tempfile.mkdtemp(prefix="bench_db_")
+    path = os.path.join(workdir, "bench.db")
+    try:
+        db = DB(path)
+        t0 = perf_counter()
+        food_ids = populate(db, foods, history, schedules, seed)
+        fill_s = perf_counter() - t0
+        rng = random.Random(seed)
+        now = int(time())
+        max_hist = db.conn.execute("SELECT MAX(id) FROM history;").fetchone()[0] or 0
+        sched_ids = [r[0] for r in db.conn.execute("SELECT id FROM schedules LIMIT 1000;")]
+
+        results = {}
+        results["list_foods.cold"] = timeit(lambda: (setattr(db, "_foods_by_id", None), db.list_foods()), max(3, repeat // 4))
+        results["list_foods"] = timeit(db.list_foods, repeat)
+        results["get_food"] = timeit(lambda: db.get_food(rng.choice(food_ids)), repeat * 50)
+        results["food_by_name"] = timeit(lambda: db.food_by_name(f"Alimento {rng.randrange(foods):06d}"), repeat * 50)
+        results["upsert_food"] = timeit(lambda: db.upsert_food(f"Bench {rng.random()}", 100, 100), repeat)
+        results["add_schedule"] = timeit(lambda: db.add_schedule(rng.choice(food_ids), 1, 10, now + 3600), repeat)
+        results["list_schedules"] = timeit(db.list_schedules, max(3, repeat // 4))
+        results["list_pending_schedules"] = timeit(lambda: db.list_pending_schedules(now - 30), repeat)
+        results["get_schedule"] = timeit(lambda: db.get_schedule(rng.choice(sched_ids)), repeat * 10)
+        results["mark_executed"] = timeit(lambda: db.mark_executed(rng.choice(sched_ids)), repeat)
+        results["add_history"] = timeit(lambda: db.add_history("Bench", 1, 10, 10, now), repeat)
+        results["history_last_7_days"] = timeit(lambda: db.history_last_7_days(now), repeat)
+        results["history_after"] = timeit(lambda: db.history_after(max_hist - 100, now - 7 * 24 * 3600), repeat)
+
+        results["scheduler_tick"] = _bench_scheduler_tick(db, repeat)
+        db.close()
+
+        wb = DB(path, write_behind=True, flush_size=10 ** 9, flush_interval=3600)
+        results["add_history.write_behind"] = timeit(lambda: wb.add_history("Bench", 1, 10, 10, now), repeat * 10)
+        results["flush.write_behind"] = timeit(wb.flush, 1)
+        wb.close()
+
+        return {
+            "meta": {
+                "foods": foods, "history": history, "schedules": schedules,
+                "fill_s": round(fill_s, 2),
+                "db_bytes": os.path.getsize(path),
+                "python": platform.python_version(),
+                "sqlite": sqlite3.sqlite_version,
+                "machine": platform.machine(),
+            },
+            "results": results,
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _bench_scheduler_tick(db, repeat):
+    from scheduler import SchedulerEngine
+    from simulate import VirtualClock
+
+    # Timer sin Kivy: los ticks se llaman a mano y el reloj virtual solo
+    # guarda los rearmes, que nunca se ejecutan
+    engine = SchedulerEngine(db, lambda *a: True, timer=VirtualClock(time()))
+    engine._reload()
+    return timeit(engine._tick, repeat)
+
+
+def compare(current, baseline, threshold, min_delta_ms=0.05):
+    regressions = []
+    for name, res in current["results"].items():
+        base = baseline.get("results", {}).get(name)
+        if not base or not base["p50_ms"]:
+            continue
+        ratio = res["p50_ms"] / base["p50_ms"]
+        # Las operaciones de microsegundos son ruidosas: se exige también una diferencia absoluta
+        if ratio > threshold and res["p50_ms"] - base["p50_ms"] > min_delta_ms:
+            regressions.append((name, base["p50_ms"], res["p50_ms"], ratio))
+    return regressions
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmarks de models.DB")
+    ap.add_argument("--preset", choices=sorted(PRESETS), default="small")
+    ap.add_argument("--foods", type=int)
+    ap.add_argument("--history", type=int)
+    ap.add_argument("--schedules", type=int)
+    ap.add_argument("--repeat", type=int, default=20)
+    ap.add_argument("--save", help="guarda los resultados JSON en este archivo")
+    ap.add_argument("--baseline", help="compara contra un JSON guardado con --save")
+    ap.add_argument("--threshold", type=float, default=1.25, help="razón p50 que cuenta como regresión")
+    ap.add_argument("--min-delta-ms", type=float, default=0.05, help="diferencia p50 mínima para reportar")
+    args = ap.parse_args()
+
+    sizes = dict(PRESETS[args.preset])
+    for key in sizes:
+        if getattr(args, key) is not None:
+            sizes[key] = getattr(args, key)
+
+    result = run(repeat=args.repeat, **sizes)
+    print(json.dumps(result, indent=2))
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(result, baseline, args.threshold, args.min_delta_ms)
+        for name, before, after, ratio in regressions:
+            print(f"REGRESIÓN {name}: {before} ms → {after} ms (x{ratio:.2f})", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+# Benchmark del camino de envío contra firmware_sim.py.
+# Mide comandos/s y latencia de ida y vuelta (p50/p99) desde send_async()
+# hasta la confirmación del firmware.
+#
+#   python bench_protocol.py --count 2000 --window 4 --dispense-time 0.001
+import argparse
+import json
+import threading
+from time import perf_counter
+
+import protocol
+from bt import SocketBluetooth
+from firmware_sim import FirmwareSimulator
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, int(round(p / 100.0 * (len(sorted_values) - 1)))))
+    return sorted_values[k]
+
+
+def run(count=1000, window=1, batch=0, dispense_time=0.0, jitter=0.0, drop_rate=0.0,
+        ack_timeout=2.0, seed=1):
+    sim = FirmwareSimulator(dispense_time=dispense_time, jitter=jitter,
+                            drop_rate=drop_rate, batch=bool(batch), seed=seed)
+    address = sim.start()
+    link = SocketBluetooth(address)
+    link.worker_options = {"window": window, "ack_timeout": ack_timeout,
+                           "require_ack": True, "maxsize": max(32, count)}
+    ok, msg = link.connect(address)
+    if not ok:
+        sim.stop()
+        raise SystemExit(msg)
+    # La negociación CAPS no forma parte de la medición
+    link.wait_caps(ack_timeout + 1)
+
+    # Lazo cerrado: como mucho `window` tramas en vuelo, así la latencia mide
+    # la ida y vuelta y no el tiempo en cola
+    slots = threading.Semaphore(window)
+    latencies = []
+    failures = [0]
+
+    def track(fut, started):
+        def _cb(f):
+            ok, _ = f.result()
+            if ok:
+                latencies.append(perf_counter() - started)
+            else:
+                failures[0] += 1
+        fut.add_done_callback(_cb)
+
+    def frame_done(_):
+        slots.release()
+
+    pairs = [((i % 3) + 1, 10) for i in range(count)]
+    t0 = perf_counter()
+    futures = []
+    for chunk in protocol.chunks(pairs, batch or 1):
+        slots.acquire()
+        started = perf_counter()
+        frame = link.dispense_batch(chunk)
+        frame[-1].add_done_callback(frame_done)
+        for fut in frame:
+            track(fut, started)
+        futures.extend(frame)
+    for fut in futures:
+        fut.result()
+    elapsed = perf_counter() - t0
+
+    link.disconnect()
+    sim.stop()
+    latencies.sort()
+    return {
+        "count": count,
+        "window": window,
+        "batch": batch,
+        "elapsed_s": round(elapsed, 4),
+        "commands_per_s": round(count / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "failures": failures[0],
+        "firmware": sim.stats,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark del protocolo de dispensado")
+    ap.add_argument("--count", type=int, default=1000)
+    ap.add_argument("--window", type=int, default=1, help="comandos sin confirmar en vuelo")
+    ap.add_argument("--batch", type=int, default=0, help="pares por trama DISPENSEB (0 = sin lotes)")
+    ap.add_argument("--dispense-time", type=float, default=0.0)
+    ap.add_argument("--jitter", type=float, default=0.0)
+    ap.add_argument("--drop-rate", type=float, default=0.0)
+    ap.add_argument("--ack-timeout", type=float, default=2.0)
+    ap.add_argument("--json", action="store_true", help="salida JSON")
+    args = ap.parse_args()
+
+    result = run(args.count, args.window, args.batch, args.dispense_time, args.jitter,
+                 args.drop_rate, args.ack_timeout)
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print(f"{result['count']} comandos en {result['elapsed_s']} s "
+              f"(ventana {result['window']}, lote {result['batch'] or '-'})")
+        print(f"  {result['commands_per_s']} cmd/s · p50 {result['p50_ms']} ms · p99 {result['p99_ms']} ms"
+              f" · fallos {result['failures']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,41 +1,338 @@
-from kivy.utils import platform
 from datetime import datetime
+from collections import deque
+from concurrent.futures import Future
+from time import monotonic, sleep
+import threading
+import socket
+import queue
+import sys
+import os
+
+import metrics
+import protocol
+
+
+def _detect_platform():
+    # Igual que kivy.utils.platform, sin importar Kivy (lo usa daemon.py)
+    if os.environ.get("KIVY_BUILD", "") in ("android", "ios"):
+        return os.environ["KIVY_BUILD"]
+    if "P4A_BOOTSTRAP" in os.environ or "ANDROID_ARGUMENT" in os.environ:
+        return "android"
+    return sys.platform
+
+
+platform = _detect_platform()
 
 if platform == "android":
     from jnius import autoclass
     BluetoothAdapter = autoclass('android.bluetooth.BluetoothAdapter')
+    BluetoothDevice = autoclass('android.bluetooth.BluetoothDevice')
     UUID = autoclass('java.util.UUID')
 
 SPP_UUID = "00001101-0000-1000-8000-00805F9B34FB"
 
-class MockBluetooth:
-    def __init__(self):
+
+# Hilo de E/S: escribe comandos de una cola acotada y empareja respuestas.
+# El firmware responde en orden (FIFO), así que cada línea recibida se asigna
+# al comando más antiguo que espera confirmación. Los resultados se entregan
+# como Future con la misma tupla (ok, msg) que devuelve send(). ok es True
+# (confirmado, o enviado a un firmware sin ACK), False (no llegó al
+# dispensador, o este lo rechazó) o None: se escribió pero no hubo
+# confirmación, así que pudo haber dispensado y no debe reenviarse a ciegas.
+# Tras un tiempo agotado el emparejamiento deja de ser fiable: una respuesta
+# tardía se asignaría al comando siguiente. Se vencen todos los comandos en
+# vuelo y el hilo no escribe hasta descartar sus respuestas tardías (o hasta
+# que pase otro ack_timeout sin recibir nada).
+class LinkWorker:
+
+    def __init__(self, link, maxsize=32, window=1, ack_timeout=2.0,
+                 require_ack=False, poll=0.002, idle_poll=0.1):
+        self.link = link
+        self.window = max(1, int(window))
+        self.ack_timeout = ack_timeout
+        self.require_ack = require_ack
+        # poll: sondeo de lectura mientras hay comandos sin confirmar;
+        # idle_poll: espera máxima sin nada en vuelo (submit() despierta al hilo)
+        self.poll = poll
+        self.idle_poll = idle_poll
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._waiting = deque()  # (future, deadline)
+        # Respuestas tardías por descartar y hasta cuándo esperarlas
+        self._stale = 0
+        self._resync_until = 0.0
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        # monotonic() de la última línea recibida (None: el firmware aún no
+        # ha respondido nada); lo usa supervisor.py para el keepalive
+        self.last_rx = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="bt-io", daemon=True)
+        self._thread.start()
+
+    def stop(self, reason="Conexión cerrada"):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=1.0)
+        self._thread = None
+        self._fail_all(reason)
+
+    def submit(self, text, callback=None):
+        fut = Future()
+        if callback is not None:
+            fut.add_done_callback(lambda f: callback(*f.result()))
+        try:
+            self._queue.put_nowait((text, fut))
+        except queue.Full:
+            metrics.count("bt.queue_full")
+            fut.set_result((False, "Cola de envío llena"))
+        self._wakeup.set()
+        return fut
+
+    def pending(self):
+        return self._queue.qsize() + len(self._waiting)
+
+    def _fail_all(self, reason):
+        # Los ya escritos quedan sin confirmar; los de la cola no salieron
+        while self._waiting:
+            fut, _ = self._waiting.popleft()
+            _resolve(fut, None, f"{reason} (sin confirmación)")
+        while True:
+            try:
+                _, fut = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            _resolve(fut, False, reason)
+
+    def _expire(self):
+        # Vence el comando más antiguo y los que esperan detrás de él
+        while self._waiting:
+            fut, _ = self._waiting.popleft()
+            metrics.count("bt.ack_timeout")
+            if self.require_ack:
+                _resolve(fut, None, "Sin confirmación del dispensador")
+            else:
+                _resolve(fut, True, "Enviado (sin confirmación)")
+            self._stale += 1
+        self._resync_until = monotonic() + self.ack_timeout
+
+    def _run(self):
+        while not self._stop.is_set():
+            busy = False
+            if self._stale and monotonic() > self._resync_until:
+                # Las respuestas que faltaban no llegaron: se sigue enviando
+                self._stale = 0
+
+            # Escritura: hasta `window` comandos esperando confirmación
+            while len(self._waiting) < self.window and not self._stale:
+                try:
+                    text, fut = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                busy = True
+                ok, msg = self.link._write_line(text)
+                if not ok:
+                    _resolve(fut, False, msg)
+                    continue
+                self._waiting.append((fut, monotonic() + self.ack_timeout))
+
+            # Lectura de respuestas del firmware
+            try:
+                line = self.link._read_line()
+            except Exception as e:
+                self._fail_all(f"Error leyendo: {e}")
+                line = None
+            if line:
+                busy = True
+                self.last_rx = monotonic()
+                if self._stale:
+                    # Respuesta tardía de un comando ya vencido
+                    self._stale -= 1
+                    metrics.count("bt.ack_discarded")
+                elif self._waiting:
+                    fut, deadline = self._waiting.popleft()
+                    # Tiempo desde la escritura hasta la respuesta
+                    metrics.record("bt.ack", monotonic() - (deadline - self.ack_timeout))
+                    if line == "OK":
+                        _resolve(fut, True, "Confirmado")
+                    elif line.startswith("OK:"):
+                        # Respuesta con datos (p. ej. CAPS): se entrega la línea
+                        _resolve(fut, True, line)
+                    else:
+                        _resolve(fut, False, f"Respuesta del dispensador: {line}")
+
+            # Tiempo de espera del comando más antiguo
+            if self._waiting and monotonic() > self._waiting[0][1]:
+                self._expire()
+
+            if not busy:
+                if self._waiting or self._stale:
+                    sleep(self.poll)
+                else:
+                    self._wakeup.wait(self.idle_poll)
+                    self._wakeup.clear()
+
+
+def _resolve(fut, ok, msg):
+    if not fut.done():
+        fut.set_result((ok, msg))
+
+
+def _done(ok, msg, callback=None):
+    fut = Future()
+    if callback is not None:
+        fut.add_done_callback(lambda f: callback(*f.result()))
+    fut.set_result((ok, msg))
+    return fut
+
+
+def _fanout(fut, n):
+    # Un Future por elemento de un lote, resueltos con el resultado del lote
+    children = [Future() for _ in range(n)]
+
+    def _done_cb(f):
+        ok, msg = f.result()
+        for child in children:
+            _resolve(child, ok, msg)
+
+    fut.add_done_callback(_done_cb)
+    return children
+
+
+class _LinkBase:
+    # Interfaz común: send_async() encola y devuelve un Future con (ok, msg);
+    # send() es la versión bloqueante para scripts y pruebas.
+    # require_ack se negocia al conectar: solo un firmware que respondió a
+    # CAPS (OK o ERR) debe confirmar cada DISPENSE, y sin su OK el dispensado
+    # queda sin confirmar (outbox.py). El firmware antiguo, que no responde
+    # nada, sigue con envío sin confirmación. worker_options puede fijarlo.
+    worker_options = {}
+    caps = frozenset()
+
+    def _start_worker(self):
+        self._stop_worker()
+        self.caps = frozenset()
+        self._worker = LinkWorker(self, **self.worker_options)
+        self._worker.start()
+        # Negociación de capacidades; el firmware antiguo no responde y se
+        # queda con el protocolo de texto clásico
+        self._caps_future = self._worker.submit(protocol.CAPS, callback=self._on_caps)
+
+    def _on_caps(self, ok, msg):
+        self.caps = frozenset(protocol.parse_caps(msg) if ok else ())
+        worker = getattr(self, "_worker", None)
+        if worker is not None and "require_ack" not in self.worker_options:
+            worker.require_ack = worker.last_rx is not None
+
+    def wait_caps(self, timeout=None):
+        fut = getattr(self, "_caps_future", None)
+        if fut is not None:
+            self._on_caps(*fut.result(timeout))
+        return self.caps
+
+    def dispense_batch(self, pairs, callback=None):
+        # pairs: [(tolva, gramos)]. Devuelve un Future por par. Con BATCH se
+        # agrupan en tramas DISPENSEB; si no, un DISPENSE por par.
+        pairs = list(pairs)
+        if protocol.CAP_BATCH not in self.caps or len(pairs) < 2:
+            futures = [self.send_async(protocol.dispense_cmd(h, g)) for h, g in pairs]
+        else:
+            futures = []
+            for chunk in protocol.chunks(pairs):
+                if len(chunk) == 1:
+                    futures.append(self.send_async(protocol.dispense_cmd(*chunk[0])))
+                else:
+                    futures.extend(_fanout(self.send_async(protocol.batch_cmd(chunk)), len(chunk)))
+        if callback is not None:
+            for i, fut in enumerate(futures):
+                fut.add_done_callback(lambda f, i=i: callback(i, *f.result()))
+        return futures
+
+    def _stop_worker(self):
+        worker = getattr(self, "_worker", None)
+        if worker is not None:
+            worker.stop()
+            self._worker = None
+
+    @property
+    def worker(self):
+        return getattr(self, "_worker", None)
+
+    @metrics.timed("bt.send_async")
+    def send_async(self, text: str, callback=None):
+        worker = getattr(self, "_worker", None)
+        if not self.is_connected() or worker is None:
+            return _done(False, "No conectado", callback)
+        return worker.submit(text, callback)
+
+    def send(self, text: str, timeout=None):
+        return self.send_async(text).result(timeout)
+
+
+class MockBluetooth(_LinkBase):
+    def __init__(self, latency=0.0, reply="OK", batch=True):
         self._connected = False
         self._device_name = None
+        self._worker = None
+        # Latencia simulada (s) antes de la respuesta del "firmware"
+        self.latency = latency
+        self.reply = reply
+        # batch=False simula firmware antiguo (sin tramas DISPENSEB)
+        self.batch = batch
+        self._replies = deque()
 
     def list_paired(self):
         return [("HC-05-MOCK", "00:00:00:00:00:00")]
 
+    @metrics.timed("bt.connect")
     def connect(self, name_or_mac):
         self._connected = True
         self._device_name = name_or_mac
+        self._start_worker()
         return True, f"Conectado a {name_or_mac} (simulado)"
 
     def is_connected(self):
         return self._connected
 
-    def send(self, text: str):
+    def disconnect(self):
+        self._connected = False
+        self._stop_worker()
+        self._replies.clear()
+
+    def _write_line(self, text):
         if not self._connected:
             return False, "No conectado"
         print(f"[MOCK BT] → {text.strip()}")
+        reply = self.reply
+        if text.strip() == protocol.CAPS:
+            reply = f"OK:{protocol.CAP_BATCH}" if self.batch else "ERR"
+        if reply is not None:
+            self._replies.append((monotonic() + self.latency, reply))
         return True, "Enviado (simulado)"
 
-class AndroidBluetooth:
+    def _read_line(self):
+        if self._replies and self._replies[0][0] <= monotonic():
+            return self._replies.popleft()[1]
+        return None
+
+
+class AndroidBluetooth(_LinkBase):
     def __init__(self):
         self._connected = False
         self._socket = None
         self._in_stream = None
         self._out_stream = None
+        self._worker = None
+        self._rx = bytearray()
+        # Handle del dispositivo por nombre o MAC: las reconexiones no
+        # recorren otra vez los emparejados
+        self._adapter = None
+        self._devices = {}
 
     def list_paired(self):
         adapter = BluetoothAdapter.getDefaultAdapter()
@@ -47,28 +344,53 @@ class AndroidBluetooth:
             devices.append((d.getName(), d.getAddress()))
         return devices
 
+    def _find_device(self, adapter, name_or_mac):
+        target = self._devices.get(name_or_mac)
+        if target is not None:
+            return target
+        if BluetoothAdapter.checkBluetoothAddress(name_or_mac):
+            # MAC conocida: sin recorrer la lista de emparejados
+            target = adapter.getRemoteDevice(name_or_mac)
+            if target.getBondState() != BluetoothDevice.BOND_BONDED:
+                target = None
+        else:
+            for d in adapter.getBondedDevices().toArray():
+                if d.getName() == name_or_mac:
+                    target = d
+                    break
+        if target is not None:
+            self._devices[name_or_mac] = target
+        return target
+
+    @metrics.timed("bt.connect")
     def connect(self, name_or_mac):
+        # Bloquea hasta que RFCOMM conecta: llamar fuera del hilo de la UI
+        # (supervisor.py lo hace en su propio hilo)
         try:
-            adapter = BluetoothAdapter.getDefaultAdapter()
+            self.disconnect()
+            adapter = self._adapter or BluetoothAdapter.getDefaultAdapter()
             if adapter is None or not adapter.isEnabled():
                 return False, "Bluetooth apagado o no disponible"
-            target = None
-            for d in adapter.getBondedDevices().toArray():
-                if d.getAddress() == name_or_mac or d.getName() == name_or_mac:
-                    target = d
-                    break
+            self._adapter = adapter
+            target = self._find_device(adapter, name_or_mac)
             if target is None:
                 return False, "Dispositivo no emparejado"
 
-            uuid = UUID.fromString(SPP_UUID)
-            socket = target.createRfcommSocketToServiceRecord(uuid)
+            socket = target.createRfcommSocketToServiceRecord(UUID.fromString(SPP_UUID))
             adapter.cancelDiscovery()
-            socket.connect()
+            try:
+                socket.connect()
+            except Exception:
+                # El handle pudo quedar obsoleto (p. ej. se volvió a emparejar)
+                self._devices.pop(name_or_mac, None)
+                raise
 
             self._socket = socket
             self._in_stream = socket.getInputStream()
             self._out_stream = socket.getOutputStream()
+            self._rx = bytearray()
             self._connected = True
+            self._start_worker()
             return True, f"Conectado a {target.getName()}"
         except Exception as e:
             return False, f"Error conectando: {e}"
@@ -76,7 +398,20 @@ class AndroidBluetooth:
     def is_connected(self):
         return self._connected
 
-    def send(self, text: str):
+    def disconnect(self):
+        self._connected = False
+        self._stop_worker()
+        try:
+            if self._socket is not None:
+                self._socket.close()
+        except Exception:
+            pass
+        self._socket = None
+        self._in_stream = None
+        self._out_stream = None
+
+    # Llamados solo desde el hilo de LinkWorker
+    def _write_line(self, text):
         try:
             if not self._connected or self._out_stream is None:
                 return False, "No conectado"
@@ -86,9 +421,112 @@ class AndroidBluetooth:
             self._out_stream.flush()
             return True, "Enviado"
         except Exception as e:
+            # Socket roto: is_connected() lo refleja y el supervisor reconecta
+            self._connected = False
+            return False, f"Error enviando: {e}"
+
+    def _read_line(self):
+        if self._in_stream is None or not self._connected:
+            return None
+        # available() evita bloquear el hilo en read()
+        try:
+            n = self._in_stream.available()
+            for _ in range(n):
+                b = self._in_stream.read()
+                if b < 0:
+                    raise ConnectionError("enlace cerrado por el dispositivo")
+                self._rx.append(b)
+        except Exception:
+            self._connected = False
+            raise
+        idx = self._rx.find(b"\n")
+        if idx < 0:
+            return None
+        line = bytes(self._rx[:idx]).decode("utf-8", "replace").strip()
+        del self._rx[:idx + 1]
+        return line
+
+class SocketBluetooth(_LinkBase):
+    # Transporte TCP hacia firmware_sim.py (misma interfaz que los adaptadores BT).
+    # name_or_mac es "host:puerto".
+    def __init__(self, address=None):
+        self._address = address or os.environ.get("DISPENSADOR_SIM", "127.0.0.1:7777")
+        self._connected = False
+        self._sock = None
+        self._worker = None
+        self._rx = bytearray()
+
+    def list_paired(self):
+        return [("FIRMWARE-SIM", self._address)]
+
+    @metrics.timed("bt.connect")
+    def connect(self, name_or_mac):
+        try:
+            self.disconnect()
+            host, port = (name_or_mac or self._address).rsplit(":", 1)
+            sock = socket.create_connection((host, int(port)), timeout=5)
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._sock = sock
+            self._rx = bytearray()
+            self._connected = True
+            self._start_worker()
+            return True, f"Conectado a {host}:{port} (simulador)"
+        except Exception as e:
+            return False, f"Error conectando: {e}"
+
+    def is_connected(self):
+        return self._connected
+
+    def disconnect(self):
+        self._connected = False
+        self._stop_worker()
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+
+    def _write_line(self, text):
+        try:
+            if not self._connected or self._sock is None:
+                return False, "No conectado"
+            if not text.endswith("\n"):
+                text = text + "\n"
+            self._sock.setblocking(True)
+            try:
+                self._sock.sendall(text.encode("utf-8"))
+            finally:
+                self._sock.setblocking(False)
+            return True, "Enviado"
+        except OSError as e:
+            self._connected = False
             return False, f"Error enviando: {e}"
 
+    def _read_line(self):
+        idx = self._rx.find(b"\n")
+        if idx < 0 and self._connected and self._sock is not None:
+            try:
+                data = self._sock.recv(4096)
+            except BlockingIOError:
+                data = None
+            if data == b"":
+                self._connected = False
+                raise ConnectionError("enlace cerrado por el dispositivo")
+            if data:
+                self._rx.extend(data)
+            idx = self._rx.find(b"\n")
+        if idx < 0:
+            return None
+        line = bytes(self._rx[:idx]).decode("utf-8", "replace").strip()
+        del self._rx[:idx + 1]
+        return line
+
+
 def get_bluetooth():
+    if os.environ.get("DISPENSADOR_SIM"):
+        return SocketBluetooth()
     if platform == "android":
         return AndroidBluetooth()
     return MockBluetooth()
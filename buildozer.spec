@@ -15,7 +15,7 @@ source.dir = .
 source.include_exts = py,kv,json,png,jpg,db
 
 # (list) Application requirements
-requirements = python3,setuptools,wheel,cython==0.29.36,kivy==2.3.0,https://github.com/kivymd/KivyMD/archive/master.zip,sqlite3,pyjnius,plyer
+requirements = python3,setuptools,wheel,cython==0.29.36,kivy==2.3.0,https://github.com/kivymd/KivyMD/archive/master.zip,sqlite3,pyjnius,plyer,numpy
 
 # (str) Application versioning (method 1)
 version = 1.0.0
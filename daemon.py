@@ -0,0 +1,290 @@
+# Demonio sin interfaz: scheduler + Bluetooth sobre asyncio, sin importar Kivy.
+# Comparte models.DB (app.db) con la app y expone un pequeño API HTTP local.
+#
+#   python daemon.py --db app.db --connect 00:21:13:00:AA:BB --port 8765
+#
+#   GET  /status                     dispositivos, pendientes, caché, estado de enlaces
+#   GET  /schedules                  programaciones
+#   GET  /hoppers                    nivel y pronóstico de vaciado por tolva
+#   POST /dispense   {"food": "Arroz", "hopper": 1, "grams": 50, "device": null, "cmd_id": null}
+#   POST /schedules  {"food": "Arroz", "hopper": 1, "grams": 50, "when_ts": 1700000000}
+#   POST /connect    {"device": "00:21:13:00:AA:BB"}
+#   POST /refill     {"hopper": 1, "grams": 500, "capacity": null}
+#   GET  /profiles                   perfiles con presupuesto y kcal de hoy
+#   POST /profiles   {"name": "Luna", "hopper": 1, "daily_kcal": 500, "food": null}
+#   GET  /unconfirmed                dispensados enviados sin confirmación
+#   POST /unconfirmed {"cmd_id": "...", "dispensed": true}   resuelve uno
+#
+# No ejecutes a la vez el scheduler de la app: lanza la app con
+# DISPENSADOR_NO_SCHEDULER=1 mientras el demonio esté activo.
+import argparse
+import asyncio
+import json
+import signal
+from time import perf_counter, time
+
+_T0 = perf_counter()
+
+from models import DB, DB_NAME
+from fleet import Fleet
+from dispatch import Dispatcher
+from scheduler import SchedulerEngine
+from inventory import Inventory
+from profiles import Budget
+from supervisor import LinkSupervisor, CONNECTED
+
+# Espera máxima (s) de POST /dispense; después responde 202 y el comando
+# sigue en la bandeja de salida
+DISPENSE_WAIT = 10
+
+
+class _Handle:
+    def __init__(self):
+        self.cancelled = False
+        self.inner = None
+
+    def cancel(self):
+        self.cancelled = True
+        if self.inner is not None:
+            self.inner.cancel()
+
+
+class AsyncioTimer:
+    # Adaptador con la interfaz de kivy.clock.Clock.schedule_once que usa
+    # SchedulerEngine; se puede llamar desde cualquier hilo.
+    def __init__(self, loop):
+        self.loop = loop
+
+    def schedule_once(self, callback, timeout=0):
+        handle = _Handle()
+
+        def _arm():
+            if not handle.cancelled:
+                handle.inner = self.loop.call_later(max(0.0, timeout), callback, timeout)
+
+        if self._in_loop_thread():
+            _arm()
+        else:
+            self.loop.call_soon_threadsafe(_arm)
+        return handle
+
+    def _in_loop_thread(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+
+class Daemon:
+    def __init__(self, db_path=DB_NAME, host="127.0.0.1", port=8765, devices=()):
+        self.db_path = db_path
+        self.host = host
+        self.port = port
+        self.devices = list(devices)
+        self.loop = None
+        self.server = None
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.db = DB(self.db_path, write_behind=True)
+        # Conversión única a auto_vacuum=INCREMENTAL (VACUUM completo) antes de
+        # que haya escrituras que esperar; después es un incremental_vacuum
+        self.db.compact(full=True)
+        self.bt = Fleet()
+        self.dispatcher = Dispatcher(
+            self.db, self.bt,
+            post=lambda fn, *a: self.loop.call_soon_threadsafe(fn, *a),
+            on_error=lambda msg: print("[daemon]", msg),
+            timer=AsyncioTimer(self.loop),
+            budget=Budget(self.db),
+        )
+        self.dispatcher.start()
+        self.inventory = Inventory(self.db)
+        self.scheduler = SchedulerEngine(
+            self.db,
+            self.dispatcher.send_schedule,
+            self.dispatcher.send_schedule_batch,
+            timer=AsyncioTimer(self.loop),
+            inventory=self.inventory,
+            on_warning=lambda msg: print("[daemon] aviso:", msg),
+        )
+        self.scheduler.start()
+        self.supervisor = LinkSupervisor(self.bt, on_change=self._on_link_change)
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        print(f"[daemon] listo en {(perf_counter() - _T0) * 1000:.0f} ms · http://{self.host}:{self.port}")
+        self._maintenance_task = asyncio.ensure_future(self._maintenance_loop())
+        if self.devices:
+            # Las conexiones RFCOMM bloquean: fuera del bucle de eventos
+            results = await self.loop.run_in_executor(None, self.bt.connect_many, self.devices)
+            for mac, (ok, msg) in results.items():
+                print(f"[daemon] {mac}: {msg}")
+                # Los que fallaron se reintentan en segundo plano
+                self.supervisor.watch(mac, make_current=False)
+
+    def _on_link_change(self, mac, state, msg):
+        # Hilo del supervisor
+        print(f"[daemon] {mac}: {state} · {msg}")
+        if state == CONNECTED:
+            self.loop.call_soon_threadsafe(self.dispatcher.outbox.kick)
+
+    async def _maintenance_loop(self):
+        # Retención del historial una vez al día, fuera del bucle de eventos
+        while True:
+            try:
+                pruned = await self.loop.run_in_executor(None, self.db.maintenance)
+                if pruned:
+                    print(f"[daemon] {pruned} filas de historial archivadas")
+            except Exception as e:
+                print("[daemon] error en mantenimiento:", e)
+            await asyncio.sleep(24 * 3600)
+
+    async def stop(self):
+        self._maintenance_task.cancel()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        self.scheduler.stop()
+        self.dispatcher.stop()
+        self.supervisor.stop()
+        for mac in list(self.bt.devices()):
+            self.bt.disconnect(mac)
+        self.db.close()
+
+    # ---------------- HTTP ----------------
+    async def _handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            method, path, _ = request.decode("latin-1").split(" ", 2)
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                if name.strip().lower() == "content-length":
+                    length = int(value.strip())
+            body = json.loads(await reader.readexactly(length)) if length else {}
+            status, payload = await self._route(method, path.split("?", 1)[0], body)
+        except Exception as e:
+            status, payload = 400, {"error": str(e)}
+        data = json.dumps(payload).encode("utf-8")
+        writer.write(
+            f"HTTP/1.0 {status} {'OK' if status < 400 else 'Error'}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode("latin-1")
+            + data
+        )
+        await writer.drain()
+        writer.close()
+
+    async def _route(self, method, path, body):
+        if method == "GET" and path == "/status":
+            return 200, {
+                "devices": self.bt.devices(),
+                "current": self.bt.current,
+                "pending": len(self.scheduler._pending),
+                "next_ts": self.scheduler._heap[0][0] if self.scheduler._heap else None,
+                "food_cache": self.db.cache_stats(),
+                "outbox": self.db.outbox_stats(),
+                "links": self.supervisor.health(),
+            }
+        if method == "GET" and path == "/schedules":
+            cols = ("id", "food", "hopper", "grams", "when_ts", "executed", "food_id", "device")
+            return 200, [dict(zip(cols, r)) for r in self.db.list_schedules()]
+        if method == "GET" and path == "/hoppers":
+            cols = ("level_g", "capacity_g", "grams_per_day", "seconds_to_empty")
+            return 200, {
+                str(h): dict(zip(cols, fc)) if fc else None
+                for h, fc in ((h, self.inventory.forecast(h)) for h, *_ in self.db.hopper_levels())
+            }
+        if method == "POST" and path == "/refill":
+            level = self.db.add_refill(int(body["hopper"]), float(body["grams"]), int(time()),
+                                       body.get("capacity"))
+            return 200, {"hopper": int(body["hopper"]), "level_g": level}
+        if method == "GET" and path == "/profiles":
+            cols = ("id", "name", "hopper", "food", "daily_kcal", "kcal_today")
+            return 200, [dict(zip(cols, r)) for r in self.db.list_profiles()]
+        if method == "POST" and path == "/profiles":
+            if body.get("delete"):
+                return (200 if self.db.delete_profile(body["name"]) else 404), {"name": body["name"]}
+            food = body.get("food")
+            if food and self.db.food_by_name(food) is None:
+                return 404, {"error": "Alimento no encontrado"}
+            self.db.upsert_profile(body["name"], int(body["hopper"]), float(body["daily_kcal"]), food)
+            return 200, {"name": body["name"]}
+        if method == "GET" and path == "/unconfirmed":
+            cols = ("id", "cmd_id", "food", "hopper", "grams", "kcal", "device", "created_ts",
+                    "next_ts", "attempts", "state", "error")
+            return 200, [dict(zip(cols, r)) for r in self.db.list_unconfirmed()]
+        if method == "POST" and path == "/unconfirmed":
+            ok = self.db.resolve_command(body["cmd_id"], bool(body["dispensed"]), int(time()))
+            return (200 if ok else 404), {"cmd_id": body["cmd_id"], "resolved": ok}
+        if method == "POST" and path == "/connect":
+            ok, msg = await self.loop.run_in_executor(None, self.bt.connect, body["device"])
+            # Vigilado aunque haya fallado: el supervisor sigue reintentando
+            self.supervisor.watch(body["device"], make_current=ok)
+            return (200 if ok else 502), {"ok": ok, "msg": msg}
+        if method == "POST" and path == "/schedules":
+            food = self.db.food_by_name(body["food"])
+            if food is None:
+                return 404, {"error": "Alimento no encontrado"}
+            sched_id = self.db.add_schedule(food[0], int(body.get("hopper", 1)), float(body["grams"]),
+                                            int(body["when_ts"]), body.get("device"))
+            return 201, {"id": sched_id}
+        if method == "POST" and path == "/dispense":
+            food = self.db.food_by_name(body["food"])
+            if food is None:
+                return 404, {"error": "Alimento no encontrado"}
+            done = self.loop.create_future()
+            cmd_id = self.dispatcher.dispense(
+                food, int(body.get("hopper", 1)), float(body["grams"]),
+                body.get("device") or self.bt.current,
+                callback=lambda ok, msg: done.done() or done.set_result((ok, msg)),
+                cmd_id=body.get("cmd_id"),
+            )
+            if cmd_id is None:
+                # Presupuesto diario agotado: no se encoló
+                return 409, {"ok": False, "msg": done.result()[1]}
+            try:
+                ok, msg = await asyncio.wait_for(asyncio.shield(done), DISPENSE_WAIT)
+            except asyncio.TimeoutError:
+                # Sigue en la bandeja de salida con sus reintentos
+                return 202, {"ok": None, "msg": "En cola", "cmd_id": cmd_id}
+            if ok is None:
+                # Enviado sin confirmación: se resuelve con POST /unconfirmed
+                return 202, {"ok": None, "msg": msg, "cmd_id": cmd_id, "state": "unconfirmed"}
+            return (200 if ok else 502), {"ok": ok, "msg": msg, "cmd_id": cmd_id}
+        return 404, {"error": "Ruta desconocida"}
+
+
+async def _main(args):
+    daemon = Daemon(args.db, args.host, args.port, args.connect)
+    await daemon.start()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    try:
+        await stop.wait()
+    finally:
+        await daemon.stop()
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Dispensador sin interfaz (scheduler + Bluetooth)")
+    ap.add_argument("--db", default=DB_NAME)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--connect", action="append", default=[], metavar="MAC",
+                    help="dispensador a conectar al iniciar (repetible)")
+    args = ap.parse_args()
+    try:
+        asyncio.run(_main(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
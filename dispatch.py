@@ -0,0 +1,100 @@
+from time import time
+from uuid import uuid4
+import traceback
+
+from outbox import Outbox
+from scheduler import SKIP
+
+
+# Envío de dispensados y registro en el historial, compartido por la app
+# Kivy (main.py) y el demonio sin interfaz (daemon.py).
+#
+# Todo dispensado pasa por la bandeja de salida (outbox.py): se guarda en la
+# DB y el drenador lo envía con reintentos; el historial se escribe cuando el
+# firmware confirma. Las confirmaciones llegan en el hilo de E/S de bt.py;
+# `post(fn, *args)` debe ejecutar fn en el hilo dueño de la DB (Clock en
+# Kivy, call_soon_threadsafe en asyncio). `on_error(msg)` informa fallos al
+# usuario; `timer` y `clock` se pasan al drenador (ver SchedulerEngine).
+class Dispatcher:
+    def __init__(self, db, bt, post, on_error=print, timer=None, clock=time, budget=None):
+        self.db = db
+        self.bt = bt
+        self.post = post
+        self.on_error = on_error
+        # budget: objeto con check(tolva, alimento, kcal, reserved) -> aviso o
+        # None (profiles.Budget); con aviso el dispensado no se envía
+        self.budget = budget
+        self.outbox = Outbox(db, bt, post, timer=timer, on_error=on_error, clock=clock)
+
+    def start(self):
+        self.outbox.start()
+
+    def stop(self):
+        self.outbox.stop()
+
+    def _command(self, food, hopper, grams, device, cmd_id=None):
+        # food: fila (id, nombre, g/porción, kcal/porción)
+        _, name, gpp, cpp = food
+        kcal = self.db.calories_for_grams(grams, gpp, cpp)
+        return (cmd_id or uuid4().hex, name, hopper, grams, kcal, device)
+
+    def _over_budget(self, cmd, reserved=None):
+        if self.budget is None:
+            return None
+        _, name, hopper, _, kcal, _ = cmd
+        return self.budget.check(hopper, name, kcal, reserved)
+
+    def dispense(self, food, hopper, grams, device=None, callback=None, cmd_id=None):
+        # callback(ok, msg) en el hilo de la DB cuando el firmware confirma o
+        # se agotan los reintentos. Devuelve el cmd_id del comando, o None si
+        # excede el presupuesto diario del perfil (callback(False, aviso))
+        cmd = self._command(food, hopper, grams, device, cmd_id)
+        msg = self._over_budget(cmd)
+        if msg:
+            if callback is not None:
+                callback(False, msg)
+            else:
+                self.on_error(msg)
+            return None
+        self.outbox.submit([cmd], {cmd[0]: callback} if callback is not None else None)
+        return cmd[0]
+
+    # ---------------- Scheduler ----------------
+    def send_schedule(self, food_id, food_name, hopper_idx, grams, device=None, cmd_id=None):
+        # True en cuanto el comando queda guardado en la bandeja: desde ahí
+        # los reintentos son del drenador. cmd_id (p. ej. "s12@1700000000")
+        # evita repetir una ocurrencia que el scheduler vuelva a disparar
+        return self.send_schedule_batch([(food_id, food_name, hopper_idx, grams, device, cmd_id)])[0]
+
+    def send_schedule_batch(self, items):
+        # items: [(food_id, food_name, tolva, gramos, device[, cmd_id])]
+        # vencidos en el mismo tick; se guardan en una sola transacción y el
+        # drenador los agrupa por dispensador (tramas DISPENSEB si se puede).
+        # Lo que excede el presupuesto se avisa y devuelve SKIP: cuenta
+        # como atendido (el scheduler no lo reintenta durante toda la
+        # ventana) pero la programación queda omitida, no ejecutada
+        results = [False] * len(items)
+        commands = []
+        reserved = {}
+        try:
+            for i, item in enumerate(items):
+                food_id, _, hopper, grams, device = item[:5]
+                cmd_id = item[5] if len(item) > 5 else None
+                food = self.db.get_food(food_id)
+                if food is None:
+                    continue
+                cmd = self._command(food, hopper, grams, device, cmd_id)
+                msg = self._over_budget(cmd, reserved)
+                if msg:
+                    self.on_error(f"Programación omitida. {msg}")
+                    results[i] = SKIP
+                    continue
+                results[i] = True
+                commands.append(cmd)
+            if commands:
+                self.outbox.submit(commands)
+        except Exception as e:
+            traceback.print_exc()
+            self.on_error(f"Error enviando programación: {e}")
+            return [False] * len(items)
+        return results
@@ -0,0 +1,88 @@
+# Exportación en streaming de history, schedules, foods y recurrences a
+# CSV o JSON Lines (opcionalmente gzip). Lee con DB.iter_table (paginación
+# por clave) y escribe fila a fila: la memoria no crece con la tabla.
+#
+#   python export.py --db app.db --out exportes --format jsonl --gzip
+import argparse
+import csv
+import gzip
+import json
+import os
+from datetime import datetime
+
+from models import DB, DB_NAME
+
+TABLES = ("foods", "schedules", "recurrences", "history", "refills", "profiles")
+FORMATS = ("csv", "jsonl")
+# Frecuencia de los avisos de progreso (filas)
+PROGRESS_EVERY = 1000
+
+
+def _open(path, compress):
+    if compress:
+        return gzip.open(path, "wt", encoding="utf-8", newline="")
+    return open(path, "w", encoding="utf-8", newline="")
+
+
+def export_table(db, table, path, fmt="csv", compress=False, progress=None, batch=1000):
+    # progress(table, filas_escritas, total) se llama cada PROGRESS_EVERY filas y al final
+    if fmt not in FORMATS:
+        raise ValueError(f"Formato desconocido: {fmt}")
+    cols = db.EXPORT_COLUMNS[table]
+    total = db.count_rows(table)
+    written = 0
+    tmp = path + ".tmp"
+    with _open(tmp, compress) as out:
+        if fmt == "csv":
+            writer = csv.writer(out)
+            writer.writerow(cols)
+            write = writer.writerow
+        else:
+            write = lambda row: out.write(json.dumps(dict(zip(cols, row)), ensure_ascii=False) + "\n")
+        for row in db.iter_table(table, batch):
+            write(row)
+            written += 1
+            if progress is not None and written % PROGRESS_EVERY == 0:
+                progress(table, written, total)
+    os.replace(tmp, path)
+    if progress is not None:
+        progress(table, written, total)
+    return written
+
+
+def export_all(db, directory, fmt="csv", compress=False, progress=None, tables=TABLES):
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    ext = fmt + (".gz" if compress else "")
+    paths = {}
+    for table in tables:
+        path = os.path.join(directory, f"{table}-{stamp}.{ext}")
+        export_table(db, table, path, fmt, compress, progress)
+        paths[table] = path
+    return paths
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Exporta la base del dispensador")
+    ap.add_argument("--db", default=DB_NAME)
+    ap.add_argument("--out", default="exportes")
+    ap.add_argument("--format", choices=FORMATS, default="csv")
+    ap.add_argument("--gzip", action="store_true")
+    ap.add_argument("--table", action="append", choices=TABLES, help="por defecto, todas")
+    args = ap.parse_args()
+
+    db = DB(args.db)
+
+    def progress(table, done, total):
+        print(f"\r{table}: {done}/{total}", end="", flush=True)
+        if done == total:
+            print()
+
+    paths = export_all(db, args.out, args.format, args.gzip, progress, args.table or TABLES)
+    for table, path in paths.items():
+        print(f"{table} → {path}")
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
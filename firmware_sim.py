@@ -0,0 +1,138 @@
+# Simulador del firmware del dispensador sobre un socket TCP local.
+# Habla el mismo protocolo que el HC-05 (ver protocol.py) y permite ajustar
+# tiempo de dispensado, jitter, pérdida de respuestas y desconexiones.
+#
+#   python firmware_sim.py --port 7777 --dispense-time 0.05 --drop-rate 0.01
+#   DISPENSADOR_SIM=127.0.0.1:7777 python main.py
+import argparse
+import random
+import socket
+import socketserver
+import threading
+from time import sleep
+
+import protocol
+
+
+class FirmwareSimulator:
+    def __init__(self, host="127.0.0.1", port=0, dispense_time=0.0, jitter=0.0,
+                 drop_rate=0.0, disconnect_rate=0.0, batch=True, seed=None):
+        self.host = host
+        self.port = port
+        self.dispense_time = dispense_time
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.disconnect_rate = disconnect_rate
+        self.batch = batch
+        self.rng = random.Random(seed)
+        self.stats = {"commands": 0, "dispensed": 0, "dropped": 0, "disconnects": 0, "errors": 0}
+        self._server = None
+        self._thread = None
+
+    @property
+    def address(self):
+        return f"{self.host}:{self.port}"
+
+    def start(self):
+        sim = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for raw in self.rfile:
+                    line = raw.decode("utf-8", "replace").strip()
+                    if not line:
+                        continue
+                    reply = sim.handle_line(line)
+                    if reply is _DISCONNECT:
+                        self.connection.shutdown(socket.SHUT_RDWR)
+                        return
+                    if reply is not None:
+                        self.wfile.write((reply + "\n").encode("utf-8"))
+                        self.wfile.flush()
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self._server = socketserver.ThreadingTCPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fw-sim", daemon=True)
+        self._thread.start()
+        return self.address
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def handle_line(self, line):
+        self.stats["commands"] += 1
+        if self.disconnect_rate and self.rng.random() < self.disconnect_rate:
+            self.stats["disconnects"] += 1
+            return _DISCONNECT
+
+        if line == protocol.PING:
+            reply = "OK"
+        elif line == protocol.CAPS:
+            reply = f"OK:{protocol.CAP_BATCH}" if self.batch else "ERR:UNKNOWN"
+        elif line.startswith(protocol.BATCH_PREFIX) and self.batch:
+            pairs = protocol.parse_batch(line)
+            reply = self._dispense(pairs) if pairs else "ERR:CHECKSUM"
+        elif line.startswith("DISPENSE:"):
+            try:
+                _, h, g = line.split(":")
+                reply = self._dispense([(int(h), int(g))])
+            except ValueError:
+                reply = "ERR:FORMAT"
+        else:
+            reply = "ERR:UNKNOWN"
+
+        if reply.startswith("ERR"):
+            self.stats["errors"] += 1
+        if self.drop_rate and self.rng.random() < self.drop_rate:
+            self.stats["dropped"] += 1
+            return None
+        return reply
+
+    def _dispense(self, pairs):
+        for hopper, grams in pairs:
+            if not 1 <= hopper <= 3 or grams < 0:
+                return "ERR:RANGE"
+        delay = self.dispense_time * len(pairs)
+        if self.jitter:
+            delay += self.rng.uniform(0, self.jitter)
+        if delay > 0:
+            sleep(delay)
+        self.stats["dispensed"] += len(pairs)
+        return "OK"
+
+
+_DISCONNECT = object()
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Simulador del firmware del dispensador")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=7777)
+    ap.add_argument("--dispense-time", type=float, default=0.0, help="segundos por dispensado")
+    ap.add_argument("--jitter", type=float, default=0.0, help="retardo aleatorio extra (s)")
+    ap.add_argument("--drop-rate", type=float, default=0.0, help="fracción de respuestas perdidas")
+    ap.add_argument("--disconnect-rate", type=float, default=0.0, help="fracción de comandos que cortan el enlace")
+    ap.add_argument("--no-batch", action="store_true", help="simula firmware antiguo sin DISPENSEB")
+    ap.add_argument("--seed", type=int, default=None)
+    args = ap.parse_args()
+
+    sim = FirmwareSimulator(args.host, args.port, args.dispense_time, args.jitter,
+                            args.drop_rate, args.disconnect_rate, not args.no_batch, args.seed)
+    print(f"Simulador escuchando en {sim.start()} (Ctrl+C para salir)")
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.stop()
+        print(sim.stats)
+
+
+if __name__ == "__main__":
+    main()
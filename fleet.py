@@ -0,0 +1,103 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from bt import get_bluetooth, _done
+
+
+# Varios dispensadores a la vez: una conexión (y un hilo de E/S) por MAC.
+# Expone la misma interfaz que los adaptadores de bt.py, de modo que AppMain
+# puede usarlo como self.bt; `device=None` se refiere al dispensador actual.
+class Fleet:
+    def __init__(self, factory=get_bluetooth):
+        self._factory = factory
+        self._links = {}
+        # Enlaces que fallaron al conectar: se reutilizan en el siguiente
+        # intento para conservar el handle del dispositivo
+        self._idle = {}
+        self.current = None
+
+    def list_paired(self):
+        probe = next(iter(self._links.values()), None) or self._factory()
+        return probe.list_paired()
+
+    def connect(self, mac, make_current=True):
+        # make_current=False: reconexión en segundo plano (supervisor.py),
+        # sin cambiar el dispensador actual
+        link = self._links.get(mac) or self._idle.pop(mac, None) or self._factory()
+        ok, msg = link.connect(mac)
+        if ok:
+            self._links[mac] = link
+            if make_current or self.current is None:
+                self.current = mac
+        elif mac not in self._links:
+            self._idle[mac] = link
+        return ok, msg
+
+    def connect_many(self, macs):
+        # Las conexiones RFCOMM bloquean: se abren en paralelo
+        macs = list(macs)
+        if not macs:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(8, len(macs))) as pool:
+            results = list(pool.map(self._connect_link, macs))
+        for mac, link, ok, msg in results:
+            if ok:
+                self._links[mac] = link
+                if self.current is None:
+                    self.current = mac
+            elif mac not in self._links:
+                self._idle[mac] = link
+        return {mac: (ok, msg) for mac, _, ok, msg in results}
+
+    def _connect_link(self, mac):
+        link = self._links.get(mac) or self._idle.pop(mac, None) or self._factory()
+        ok, msg = link.connect(mac)
+        return mac, link, ok, msg
+
+    def disconnect(self, mac=None):
+        mac = mac or self.current
+        link = self._links.pop(mac, None)
+        self._idle.pop(mac, None)
+        if link is not None:
+            link.disconnect()
+        if self.current == mac:
+            self.current = next(iter(self._links), None)
+
+    def devices(self):
+        return [mac for mac, link in self._links.items() if link.is_connected()]
+
+    def get(self, device=None):
+        return self._links.get(device or self.current)
+
+    def is_connected(self, device=None):
+        link = self.get(device)
+        return link is not None and link.is_connected()
+
+    def send_async(self, text, callback=None, device=None):
+        link = self.get(device)
+        if link is None:
+            msg = f"Dispensador {device} no conectado" if device else "No conectado"
+            return _done(False, msg, callback)
+        return link.send_async(text, callback)
+
+    def send(self, text, timeout=None, device=None):
+        return self.send_async(text, device=device).result(timeout)
+
+    def dispense_batch(self, pairs, callback=None, device=None):
+        # Ver _LinkBase.dispense_batch: un Future por (tolva, gramos)
+        link = self.get(device)
+        if link is None:
+            msg = f"Dispensador {device} no conectado" if device else "No conectado"
+            return [_done(False, msg, callback and (lambda ok, m, i=i: callback(i, ok, m)))
+                    for i in range(len(pairs))]
+        return link.dispense_batch(pairs, callback)
+
+    def dispense_many(self, commands, callback=None):
+        # commands: [(device, texto)]. Cada enlace tiene su propio hilo de E/S,
+        # así que los envíos a dispositivos distintos avanzan en paralelo.
+        futures = []
+        for device, text in commands:
+            cb = None
+            if callback is not None:
+                cb = lambda ok, msg, d=device: callback(d, ok, msg)
+            futures.append(self.send_async(text, cb, device=device))
+        return futures
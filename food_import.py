@@ -0,0 +1,112 @@
+# Importación masiva de alimentos desde CSV (opcionalmente .gz). Se lee fila a
+# fila y se escribe con DB.import_foods en transacciones por lote, así que un
+# catálogo de cientos de miles de filas no se carga entero en memoria.
+#
+#   python food_import.py --db app.db alimentos.csv
+#
+# Columnas: nombre, gramos por porción, calorías por porción. Con encabezado
+# se aceptan también name/alimento, grams/gramos/porcion y calories/kcal; sin
+# encabezado se usa ese orden. Separador , o ; (con ; se admite coma decimal).
+import argparse
+import csv
+import gzip
+import io
+
+from models import DB, DB_NAME, normalize_name
+
+ALIASES = {
+    "name": ("name", "nombre", "alimento", "food"),
+    "gpp": ("grams_per_portion", "gramos_por_porcion", "gramos", "grams", "porcion", "g"),
+    "cpp": ("calories_per_portion", "calorias_por_porcion", "calorias", "calories", "kcal", "energia"),
+}
+BATCH = 1000
+
+
+def _open(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8-sig", newline="")
+    return open(path, "r", encoding="utf-8-sig", newline="")
+
+
+def _columns(header):
+    # Índices (nombre, gpp, cpp) según el encabezado, o None si no lo es
+    cols = [normalize_name(h.strip()).replace(" ", "_") for h in header]
+    found = {}
+    for key, names in ALIASES.items():
+        for i, col in enumerate(cols):
+            if col in names:
+                found[key] = i
+                break
+    if len(found) == 3:
+        return found["name"], found["gpp"], found["cpp"]
+    return None
+
+
+def _number(text):
+    return float(text.strip().replace(",", "."))
+
+
+def read_foods(f, stats):
+    # Genera (nombre, gpp, cpp) válidos; stats cuenta las filas descartadas
+    sample = f.read(4096)
+    f.seek(0)
+    delimiter = ";" if sample.count(";") > sample.count(",") else ","
+    reader = csv.reader(f, delimiter=delimiter)
+    first = next(reader, None)
+    if first is None:
+        return
+    idx = _columns(first)
+    if idx is None:
+        idx = (0, 1, 2)
+        reader = _chain(first, reader)
+    i_name, i_gpp, i_cpp = idx
+    for row in reader:
+        try:
+            name = row[i_name].strip()
+            gpp, cpp = _number(row[i_gpp]), _number(row[i_cpp])
+        except (IndexError, ValueError):
+            stats["skipped"] += 1
+            continue
+        if not name or gpp <= 0 or cpp < 0:
+            stats["skipped"] += 1
+            continue
+        yield name, gpp, cpp
+
+
+def _chain(first, rest):
+    yield first
+    yield from rest
+
+
+def import_csv(db, path, progress=None, batch=BATCH):
+    # progress(importadas, descartadas) por lote. Devuelve (importadas, descartadas)
+    stats = {"skipped": 0}
+    report = None
+    if progress is not None:
+        report = lambda done: progress(done, stats["skipped"])
+    with _open(path) as f:
+        if not f.seekable():
+            f = io.StringIO(f.read())
+        done = db.import_foods(read_foods(f, stats), batch, report)
+    return done, stats["skipped"]
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Importa alimentos desde CSV")
+    ap.add_argument("csv")
+    ap.add_argument("--db", default=DB_NAME)
+    ap.add_argument("--batch", type=int, default=BATCH)
+    args = ap.parse_args()
+
+    db = DB(args.db)
+    done, skipped = import_csv(
+        db, args.csv,
+        lambda d, s: print(f"\r{d} importados, {s} descartados", end="", flush=True),
+        args.batch,
+    )
+    print(f"\n{done} alimentos importados ({skipped} filas descartadas)")
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+# Formularios de los diálogos. Se importan al abrir el primer diálogo para
+# no cargar los widgets de KivyMD durante el arranque.
+from datetime import datetime
+
+from kivy.metrics import dp
+from kivymd.uix.boxlayout import MDBoxLayout
+from kivymd.uix.list import MDListItem, MDListItemHeadlineText
+from kivymd.uix.textfield import MDTextField
+
+
+class FoodSearch(MDBoxLayout):
+    # Campo con búsqueda incremental (DB.search_foods) y hasta `k` sugerencias.
+    # selected queda con la fila elegida; on_select(fila) se llama al elegir
+    def __init__(self, app, on_select=None, k=8, **kwargs):
+        super().__init__(**kwargs)
+        self.orientation = "vertical"
+        self.spacing = dp(4)
+        self.adaptive_height = True
+        self.app = app
+        self.k = k
+        self.on_select = on_select
+        self.selected = None
+        self.field = MDTextField(hint_text="Alimento (escriba para buscar)")
+        self.results = MDBoxLayout(orientation="vertical", adaptive_height=True)
+        self.field.bind(text=lambda _, text: self._search(text))
+        self.add_widget(self.field)
+        self.add_widget(self.results)
+
+    def _search(self, text):
+        self.results.clear_widgets()
+        if self.selected is not None and self.selected[1] == text:
+            return
+        self.selected = None
+        if not text.strip():
+            return
+        for row in self.app.db.search_foods(text, self.k):
+            self.results.add_widget(
+                MDListItem(
+                    MDListItemHeadlineText(text=row[1]),
+                    on_release=lambda *_, r=row: self._pick(r),
+                )
+            )
+
+    def _pick(self, row):
+        self.selected = row
+        self.field.text = row[1]
+        if self.on_select is not None:
+            self.on_select(row)
+
+
+class FoodForm(MDBoxLayout):
+    def __init__(self, app, food=None, **kwargs):
+        super().__init__(**kwargs)
+        self.orientation = "vertical"
+        self.spacing = dp(8)
+        self.app = app
+        self.food = food
+        self.name = MDTextField(hint_text="Nombre", text=food[1] if food else "")
+        self.gpp = MDTextField(
+            hint_text="Gramos por porción",
+            text=str(food[2]) if food else "100",
+            input_filter="float",
+        )
+        self.cpp = MDTextField(
+            hint_text="Calorías por porción",
+            text=str(food[3]) if food else "100",
+            input_filter="float",
+        )
+        self.add_widget(self.name)
+        self.add_widget(self.gpp)
+        self.add_widget(self.cpp)
+
+
+class ScheduleForm(MDBoxLayout):
+    def __init__(self, app, **kwargs):
+        super().__init__(**kwargs)
+        self.orientation = "vertical"
+        self.spacing = dp(8)
+        self.app = app
+        self.food_search = FoodSearch(app)
+        self.food_field = self.food_search.field
+        self.hopper_field = MDTextField(
+            hint_text="Tolva (1-3)", input_filter="int", text="1"
+        )
+        self.grams_field = MDTextField(
+            hint_text="Gramos", input_filter="float", text="50"
+        )
+        self.datetime_field = MDTextField(
+            hint_text="Fecha y hora (YYYY-MM-DD HH:MM)",
+            text=datetime.now().strftime("%Y-%m-%d %H:%M"),
+        )
+        self.device_field = MDTextField(
+            hint_text="Dispensador (MAC, vacío = actual)",
+            text=getattr(app.bt, "current", None) or "",
+        )
+        self.repeat_field = MDTextField(
+            hint_text="Repetir (vacío = una vez; diario, lun,vie 08:00 o cron)",
+        )
+        self.until_field = MDTextField(
+            hint_text="Hasta (YYYY-MM-DD, opcional)",
+        )
+        self.add_widget(self.food_search)
+        self.add_widget(self.hopper_field)
+        self.add_widget(self.grams_field)
+        self.add_widget(self.datetime_field)
+        self.add_widget(self.device_field)
+        self.add_widget(self.repeat_field)
+        self.add_widget(self.until_field)
+
+
+class RefillForm(MDBoxLayout):
+    def __init__(self, app, hopper, **kwargs):
+        super().__init__(**kwargs)
+        self.orientation = "vertical"
+        self.spacing = dp(8)
+        self.app = app
+        self.hopper = hopper
+        _, level, capacity, _ = hopper
+        self.grams_field = MDTextField(
+            hint_text="Gramos agregados",
+            input_filter="float",
+            text=f"{max(capacity - level, 0):.0f}" if capacity > 0 else "",
+        )
+        self.capacity_field = MDTextField(
+            hint_text="Capacidad de la tolva (g)",
+            input_filter="float",
+            text=f"{capacity:.0f}" if capacity > 0 else "",
+        )
+        self.add_widget(self.grams_field)
+        self.add_widget(self.capacity_field)
+
+
+class ProfileForm(MDBoxLayout):
+    # Perfil de alimentación: se guarda por nombre (DB.upsert_profile);
+    # alimento vacío = todo lo que sale de la tolva
+    def __init__(self, app, **kwargs):
+        super().__init__(**kwargs)
+        self.orientation = "vertical"
+        self.spacing = dp(8)
+        self.app = app
+        self.name_field = MDTextField(hint_text="Nombre (p. ej. Luna)")
+        self.hopper_field = MDTextField(
+            hint_text="Tolva (1-3)", input_filter="int", text="1"
+        )
+        self.kcal_field = MDTextField(
+            hint_text="Presupuesto diario (kcal)", input_filter="float"
+        )
+        self.food_search = FoodSearch(app)
+        self.food_search.field.hint_text = "Alimento (vacío = toda la tolva)"
+        self.add_widget(self.name_field)
+        self.add_widget(self.hopper_field)
+        self.add_widget(self.kcal_field)
+        self.add_widget(self.food_search)
@@ -0,0 +1,71 @@
+# Pronóstico de inventario por tolva: nivel actual (DB.hopper_levels, que se
+# descuenta en cada add_history) y ritmo de consumo reciente sobre history.
+# El scheduler llama a check() antes de cada envío para avisar con tiempo.
+from time import time
+
+# Días de historial usados para el ritmo de consumo
+RATE_DAYS = 7
+# Aviso cuando el pronóstico de vaciado cae dentro de este margen (s)
+LOW_HORIZON = 24 * 3600
+
+
+class Inventory:
+    def __init__(self, db, rate_days=RATE_DAYS, horizon=LOW_HORIZON, clock=time):
+        self.db = db
+        # clock() -> segundos epoch (simulate.py inyecta un reloj virtual)
+        self.clock = clock
+        self.rate_days = rate_days
+        self.horizon = horizon
+        # Último aviso por tolva ("low"/"empty"); se olvida cuando vuelve a
+        # haber margen, p. ej. tras una recarga
+        self._warned = {}
+
+    def rate(self, hopper_index, now_ts=None):
+        # Gramos por día en los últimos `rate_days` (o desde el primer registro
+        # si hay menos historial)
+        now_ts = int(now_ts or self.clock())
+        since = now_ts - self.rate_days * 86400
+        grams, first_ts = self.db.grams_dispensed(hopper_index, since)
+        if not grams or first_ts is None:
+            return 0.0
+        span = max(now_ts - first_ts, 3600)
+        return grams * 86400.0 / span
+
+    def forecast(self, hopper_index, now_ts=None):
+        # (nivel_g, capacidad_g, g/día, segundos hasta vaciarse o None)
+        row = self.db.get_hopper(hopper_index)
+        if row is None or row[2] <= 0:
+            return None
+        _, level, capacity, _ = row
+        rate = self.rate(hopper_index, now_ts)
+        seconds = level / rate * 86400 if rate > 0 else None
+        return level, capacity, rate, seconds
+
+    def forecasts(self, now_ts=None):
+        return {
+            h: self.forecast(h, now_ts)
+            for h, _, capacity, _ in self.db.hopper_levels()
+            if capacity > 0
+        }
+
+    def check(self, hopper_index, grams, now_ts=None):
+        # Mensaje de aviso o None. Cada situación se avisa una vez por tolva
+        # hasta la siguiente recarga o cambio de gravedad
+        fc = self.forecast(hopper_index, now_ts)
+        if fc is None:
+            return None
+        level, capacity, rate, seconds = fc
+        left = level - grams
+        if left < 0:
+            kind = "empty"
+            msg = f"Tolva {hopper_index}: quedan {level:.0f} g y se piden {grams:.0f} g"
+        elif rate > 0 and left / rate * 86400 < self.horizon:
+            kind = "low"
+            msg = f"Tolva {hopper_index}: se vaciará en ~{left / rate * 24:.0f} h ({left:.0f} g tras este envío)"
+        else:
+            self._warned.pop(hopper_index, None)
+            return None
+        if self._warned.get(hopper_index) == kind:
+            return None
+        self._warned[hopper_index] = kind
+        return msg
@@ -1,108 +1,143 @@
+from time import perf_counter
+_T0 = perf_counter()
+
 from kivy.config import Config
 Config.set('kivy', 'log_level', 'info')
 
 from kivy.lang import Builder
 from kivy.clock import Clock
-from kivy.metrics import dp
+from kivy.factory import Factory
 from kivy.properties import StringProperty
 
 from kivymd.app import MDApp
-from kivymd.uix.menu import MDDropdownMenu
-from kivymd.uix.snackbar import MDSnackbar
-from kivymd.uix.list import MDListItem
-from kivymd.uix.dialog import MDDialog
-from kivymd.uix.button import MDButton, MDButtonText
-from kivymd.uix.textfield import MDTextField
-from kivymd.uix.boxlayout import MDBoxLayout
 
 from datetime import datetime
 from time import time
+from bisect import bisect_left
 import traceback
+import threading
+import os
+
+import metrics
+from models import DB, SKIPPED
+
+# Tiempos de arranque: (etapa, ms). Se imprimen cuando termina _late_init.
+_STARTUP = []
+
 
-from models import DB
-from bt import get_bluetooth
-from scheduler import SchedulerEngine
+def _mark(label, since):
+    _STARTUP.append((label, (perf_counter() - since) * 1000))
+    return perf_counter()
 
-with open("ui.kv", "r", encoding="utf-8") as f:
-    KV = f.read()
+
+# Pantallas que se construyen en el primer go() (ver ui.kv)
+_SCREENS = {
+    "connect": "ConnectScreen",
+    "foods": "FoodsScreen",
+    "schedule": "ScheduleScreen",
+    "history": "HistoryScreen",
+    "hoppers": "HoppersScreen",
+    "diagnostics": "DiagnosticsScreen",
+}
 
 
 def _toast(msg: str):
     try:
+        from kivymd.uix.snackbar import MDSnackbar
+
         MDSnackbar(text=str(msg)).open()
     except Exception:
         print("[Snackbar FALLÓ]", msg)
 
 
-class FoodForm(MDBoxLayout):
-    def __init__(self, app, food=None, **kwargs):
-        super().__init__(**kwargs)
-        self.orientation = "vertical"
-        self.spacing = dp(8)
-        self.app = app
-        self.food = food
-        self.name = MDTextField(hint_text="Nombre", text=food[1] if food else "")
-        self.gpp = MDTextField(
-            hint_text="Gramos por porción",
-            text=str(food[2]) if food else "100",
-            input_filter="float",
-        )
-        self.cpp = MDTextField(
-            hint_text="Calorías por porción",
-            text=str(food[3]) if food else "100",
-            input_filter="float",
-        )
-        self.add_widget(self.name)
-        self.add_widget(self.gpp)
-        self.add_widget(self.cpp)
-
-
-class ScheduleForm(MDBoxLayout):
-    def __init__(self, app, **kwargs):
-        super().__init__(**kwargs)
-        self.orientation = "vertical"
-        self.spacing = dp(8)
-        self.app = app
-        self.food_field = MDTextField(hint_text="Alimento (exacto)")
-        self.hopper_field = MDTextField(
-            hint_text="Tolva (1-3)", input_filter="int", text="1"
-        )
-        self.grams_field = MDTextField(
-            hint_text="Gramos", input_filter="float", text="50"
-        )
-        self.datetime_field = MDTextField(
-            hint_text="Fecha y hora (YYYY-MM-DD HH:MM)",
-            text=datetime.now().strftime("%Y-%m-%d %H:%M"),
-        )
-        self.add_widget(self.food_field)
-        self.add_widget(self.hopper_field)
-        self.add_widget(self.grams_field)
-        self.add_widget(self.datetime_field)
-
-
 class AppMain(MDApp):
     selected_food = None
     selected_food_name = None
     unit = "gramos"
     bt_status_text = StringProperty("No conectado")
+    export_status_text = StringProperty("")
+    foods_status_text = StringProperty("")
+    history_summary_text = StringProperty("")
+    diagnostics_text = StringProperty("")
+
+    db = None
+    # False con DISPENSADOR_NO_SCHEDULER=1: los envíos los hace el demonio
+    dispatch_local = True
 
     def build(self):
+        t = _mark("imports", _T0)
         self.title = "Dispensador Inteligente"
         self.theme_cls.primary_palette = "Blue"
         self.theme_cls.theme_style = "Light"
 
+        # --- Cargar interfaz ---
+        # Solo la pantalla principal; las demás se construyen en el primer go()
+        with open("ui.kv", "r", encoding="utf-8") as f:
+            KV = f.read()
+        t = _mark("lectura ui.kv", t)
+        self.root = Builder.load_string(KV)
+        self.sm = self.root  # MDScreenManager
+        t = _mark("kv + pantalla principal", t)
+
+        # La etiqueta de conversión se recalcula solo cuando cambia la cantidad,
+        # la unidad (set_unit) o el alimento (_select_food)
+        self._dispenser().ids.amount.bind(
+            text=lambda *_: self._refresh_conversion_label()
+        )
+
+        # DB, Bluetooth y scheduler quedan fuera del camino crítico: se
+        # inicializan en el primer frame después de dibujar la interfaz
+        self._t_build = perf_counter()
+        Clock.schedule_once(self._late_init, 0)
+        return self.root
+
+    def _late_init(self, *_):
+        t = _mark("primer frame", self._t_build)
+
         # --- Inicializar DB ---
         try:
-            self.db = DB()
+            self.db = DB(write_behind=True)
         except Exception as e:
             print("ERROR iniciando DB:", e)
             traceback.print_exc()
             # Si la base falla no podemos continuar
             raise
+        t = _mark("DB + migración", t)
+
+        # Estado de las vistas incrementales (historial y programación). Las
+        # filas se cargan por páginas al desplazarse (paging.py); las claves
+        # de la vista son (-id, ts) en el historial y (when_ts, id) en las
+        # programaciones únicas, debajo de las recurrentes
+        from paging import KeysetPager
+
+        self._hist_pager = KeysetPager(
+            self._fetch_history_page, lambda r: (-r[0], r[5]), self._format_history_row
+        )
+        self._hist_hwm = 0
+        self._hist_version = -1
+        self._sched_pager = KeysetPager(
+            self.db.schedules_page, lambda r: (r[4], r[0]), self._format_schedule_row
+        )
+        self._sched_recs = []
+        self._sched_dirty = set()
+        self._sched_full = True
+        self.db.subscribe(self._on_db_change)
 
         # --- Inicializar Bluetooth ---
         try:
-            self.bt = get_bluetooth()
+            from fleet import Fleet
+
+            # Flota de dispensadores; self.bt.current es el dispensador activo
+            self.bt = Fleet()
+            # Conexión, keepalive y reconexión en segundo plano (supervisor.py)
+            from supervisor import LinkSupervisor
+
+            self.supervisor = LinkSupervisor(
+                self.bt,
+                on_change=lambda mac, state, msg: Clock.schedule_once(
+                    lambda *_: self._on_link_change(mac, state, msg), 0
+                ),
+            )
         except Exception as e:
             print("ERROR iniciando Bluetooth:", e)
             traceback.print_exc()
@@ -121,30 +156,176 @@ class AppMain(MDApp):
                 def send(self, cmd):
                     return False, "Bluetooth no disponible"
 
+                def send_async(self, cmd, callback=None, device=None):
+                    if callback is not None:
+                        callback(False, "Bluetooth no disponible")
+                    return None
+
             self.bt = DummyBT()
+            self.supervisor = None
             self.bt_status_text = "BT no disponible"
+        t = _mark("Bluetooth", t)
+
+        from dispatch import Dispatcher
+
+        from profiles import Budget
+
+        self.dispatcher = Dispatcher(
+            self.db,
+            self.bt,
+            post=lambda fn, *a: Clock.schedule_once(lambda *_: fn(*a), 0),
+            on_error=_toast,
+            budget=Budget(self.db),
+        )
+        # Con el demonio como dueño de los envíos la app solo encola: dos
+        # drenadores se quitarían los comandos de la misma tabla
+        self.dispatch_local = not os.environ.get("DISPENSADOR_NO_SCHEDULER")
+        if self.dispatch_local:
+            # Drena lo que haya quedado en la bandeja de salida de la sesión anterior
+            self.dispatcher.start()
+
+        from inventory import Inventory
+
+        self.inventory = Inventory(self.db)
 
         # --- Inicializar Scheduler ---
+        # Con DISPENSADOR_NO_SCHEDULER=1 la app solo muestra datos y el
+        # demonio (daemon.py) es quien ejecuta las programaciones
         try:
-            self.scheduler = SchedulerEngine(self.db, self._send_schedule)
-            self.scheduler.start()
+            from scheduler import SchedulerEngine
+
+            self.scheduler = SchedulerEngine(
+                self.db,
+                self.dispatcher.send_schedule,
+                self.dispatcher.send_schedule_batch,
+                inventory=self.inventory,
+                on_warning=_toast,
+            )
+            if not os.environ.get("DISPENSADOR_NO_SCHEDULER"):
+                self.scheduler.start()
         except Exception as e:
             print("ERROR iniciando Scheduler:", e)
             traceback.print_exc()
             self.scheduler = None
+        _mark("scheduler", t)
 
-        # --- Cargar interfaz ---
-        self.root = Builder.load_string(KV)
-        self.sm = self.root  # MDScreenManager
-
-        Clock.schedule_once(lambda *_: self._refresh_foods_ui(), 0.5)
-        Clock.schedule_interval(lambda *_: self._refresh_conversion_label(), 0.2)
         Clock.schedule_interval(lambda *_: self._refresh_history_ui(), 10)
         Clock.schedule_interval(lambda *_: self._refresh_schedule_ui(), 10)
-        return self.root
+        Clock.schedule_interval(lambda *_: self._refresh_hoppers_ui(), 10)
+        Clock.schedule_interval(lambda *_: self._refresh_diagnostics_ui(), 10)
+        # Escrituras del demonio sobre app.db: las revisa el tick del
+        # scheduler; sin scheduler en marcha, este intervalo
+        if self.scheduler is None or not self.dispatch_local:
+            Clock.schedule_interval(lambda *_: self.db.check_external(), 5)
+        # Retención del historial en segundo plano, lejos del arranque
+        Clock.schedule_once(lambda *_: self._start_maintenance(), 60)
+        self._print_startup_report()
+
+    def _start_maintenance(self):
+        def _run():
+            try:
+                pruned = self.db.maintenance()
+                if pruned:
+                    print(f"[mantenimiento] {pruned} filas de historial archivadas")
+            except Exception:
+                traceback.print_exc()
+
+        threading.Thread(target=_run, name="db-maintenance", daemon=True).start()
+
+    def _print_startup_report(self):
+        total = (perf_counter() - _T0) * 1000
+        parts = " · ".join(f"{label} {ms:.0f} ms" for label, ms in _STARTUP)
+        print(f"[arranque] {total:.0f} ms en total: {parts}")
+
+    def _ready(self):
+        if self.db is None:
+            _toast("Iniciando, intente de nuevo")
+            return False
+        return True
+
+    def on_stop(self):
+        # Vacía el búfer de historial antes de salir
+        metrics.profiler.stop()
+        if getattr(self, "supervisor", None) is not None:
+            self.supervisor.stop()
+        if getattr(self, "scheduler", None) is not None:
+            self.scheduler.stop()
+        if getattr(self, "dispatcher", None) is not None:
+            self.dispatcher.stop()
+        if getattr(self, "db", None) is not None:
+            self.db.close()
+
+    def _on_db_change(self, table, op, row_id):
+        if threading.current_thread() is not threading.main_thread():
+            # Aviso desde otro hilo (importación de alimentos): el estado de
+            # las vistas solo se toca en el hilo de la UI
+            Clock.schedule_once(lambda *_: self._on_db_change(table, op, row_id), 0)
+            return
+        if table == "schedules" and row_id is not None:
+            self._sched_dirty.add(("s", row_id))
+        elif table == "recurrences" and row_id is not None:
+            self._sched_dirty.add(("r", row_id))
+        elif table in ("foods", "db"):
+            # Un REPLACE puede borrar programaciones en cascada; "db": el
+            # demonio escribió en la base compartida
+            self._sched_full = True
+
+    # ---------------- Diagnóstico ----------------
+    def _refresh_diagnostics_ui(self):
+        # Solo se recalcula con la pantalla visible
+        if not self.sm.has_screen("diagnostics") or self.sm.current != "diagnostics":
+            return
+        cache = self.db.cache_stats()
+        outbox = self.db.outbox_stats()
+        startup = " · ".join(f"{label} {ms:.0f} ms" for label, ms in _STARTUP)
+        lines = [
+            f"Arranque: {startup}",
+            f"Caché de alimentos: {cache['hits']} aciertos / {cache['misses']} fallos",
+            f"Páginas de listas: {self._hist_pager.page_hits + self._sched_pager.page_hits} aciertos / "
+            f"{self._hist_pager.page_misses + self._sched_pager.page_misses} consultas",
+            f"Bandeja de salida: {outbox['pending'] + outbox['sending']} pendientes · "
+            f"{outbox['unconfirmed']} sin confirmar · {outbox['failed']} fallidos",
+            f"Perfilador: {'activo' if metrics.profiler.running else 'apagado'}",
+        ]
+        if self.supervisor is not None:
+            for mac, h in self.supervisor.health().items():
+                lines.append(
+                    f"Enlace {mac}: {h['state']} · PING {h['rtt_ms'] or '-'} ms · "
+                    f"reposo {h['idle_s'] or '-'} s · {h['reconnects']} reconexiones"
+                )
+        lines += ["", metrics.report()]
+        if metrics.profiler.samples:
+            lines.append("")
+            lines.append("Funciones más muestreadas:")
+            lines.extend(f"  {name}: {hits}" for name, hits in metrics.profiler.top(10))
+        self.diagnostics_text = "\n".join(lines)
+
+    def toggle_profiler(self):
+        running = metrics.profiler.toggle()
+        _toast("Perfilador activado" if running else "Perfilador detenido")
+        self._refresh_diagnostics_ui()
+
+    def dump_metrics(self):
+        directory = os.path.join(self.user_data_dir, "diagnostico")
+        os.makedirs(directory, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        path = metrics.dump(os.path.join(directory, f"metricas-{stamp}.json"))
+        if metrics.profiler.samples:
+            metrics.profiler.dump_collapsed(os.path.join(directory, f"perfil-{stamp}.txt"))
+        _toast(f"Guardado en {path}")
 
     # ---------------- Navegación ----------------
+    def _ensure_screen(self, name):
+        if not self.sm.has_screen(name):
+            t = perf_counter()
+            self.sm.add_widget(Factory.get(_SCREENS[name])())
+            _mark(f"pantalla {name}", t)
+        return self.sm.get_screen(name)
+
     def go(self, screen_name):
+        if not self._ready():
+            return
+        self._ensure_screen(screen_name)
         self.sm.current = screen_name
         if screen_name == "foods":
             self._refresh_foods_ui()
@@ -152,36 +333,74 @@ class AppMain(MDApp):
             self._refresh_schedule_ui()
         elif screen_name == "history":
             self._refresh_history_ui()
+        elif screen_name == "hoppers":
+            self._refresh_hoppers_ui()
+        elif screen_name == "diagnostics":
+            self._refresh_diagnostics_ui()
 
     def go_back(self):
+        # Al salir de una lista se liberan las páginas cargadas más allá de la primera
+        if self.sm.current == "schedule":
+            rv = self.sm.get_screen("schedule").ids.sched_rv
+            self._sched_pager.shrink(rv.data, len(self._sched_recs))
+        elif self.sm.current == "history":
+            self._hist_pager.shrink(self.sm.get_screen("history").ids.hist_rv.data)
         self.sm.current = "root"
 
+    def _on_list_scroll(self, screen_name, rv):
+        # scroll_y va de 1 (arriba) a 0 (abajo); cerca del final se carga otra página
+        if rv.scroll_y > 0.1 or not rv.data:
+            return
+        if screen_name == "schedule":
+            pager, offset = self._sched_pager, len(self._sched_recs)
+        else:
+            pager, offset = self._hist_pager, 0
+        if pager.exhausted:
+            return
+        # Las filas tienen alto fijo: se conserva la posición absoluta para que
+        # la vista no salte al crecer el contenido
+        content = rv.children[0].height if rv.children else 0
+        before = len(rv.data)
+        top = max(content - rv.height, 0) * (1 - rv.scroll_y)
+        if not pager.load_more(rv.data):
+            return
+        if screen_name == "history":
+            self._trim_history(rv)
+        grown = content * len(rv.data) / before
+        if grown > rv.height:
+            rv.scroll_y = max(0.0, 1 - top / (grown - rv.height))
+
     # ---------------- Dispensar ----------------
     def _dispenser(self):
         return self.sm.get_screen("root").ids.dispenser
 
     def open_food_menu(self, _caller=None):
+        if not self._ready():
+            return
         try:
-            foods = self.db.list_foods()
-            if not foods:
-                _toast("No hay alimentos en la base")
-                return
-            menu_items = []
-            for fid, name, gpp, cpp in foods:
-                menu_items.append(
-                    {
-                        "text": name,
-                        "on_release": (
-                            lambda i=fid, n=name: (
-                                self._select_food(i, n),
-                                self.food_menu.dismiss(),
-                            )
-                        ),
-                    }
-                )
-            caller = self._dispenser().ids.food_btn
-            self.food_menu = MDDropdownMenu(
-                caller=caller, items=menu_items, width_mult=4
+            # Búsqueda incremental en vez de un menú con todos los alimentos
+            from kivymd.uix.dialog import MDDialog
+            from kivymd.uix.button import MDButton, MDButtonText
+            from forms import FoodSearch
+
+            search = FoodSearch(
+                self,
+                on_select=lambda row: (
+                    self._select_food(row[0], row[1]),
+                    self.food_menu.dismiss(),
+                ),
+            )
+            self.food_menu = MDDialog(
+                title="Elegir alimento",
+                type="custom",
+                content_cls=search,
+                buttons=[
+                    MDButton(
+                        MDButtonText(text="Cancelar"),
+                        style="text",
+                        on_release=lambda *_: self.food_menu.dismiss(),
+                    ),
+                ],
             )
             self.food_menu.open()
         except Exception as e:
@@ -194,6 +413,7 @@ class AppMain(MDApp):
         disp = self._dispenser()
         disp.ids.food_btn_text.text = food_name
         disp.ids.sel_food.text = f"Alimento: {food_name}"
+        self._refresh_conversion_label()
 
     def set_unit(self, unit_text):
         self.unit = unit_text
@@ -225,10 +445,10 @@ class AppMain(MDApp):
         _, name, gpp, cpp = self.selected_food
         val = self._current_amount()
         if self.unit == "gramos":
-            kcal = self.db.calories_for_grams(val, gpp, cpp)
+            kcal = DB.calories_for_grams(val, gpp, cpp)
             label.text = f"≈ {kcal:.0f} kcal"
         else:
-            grams = self.db.grams_for_calories(val, gpp, cpp)
+            grams = DB.grams_for_calories(val, gpp, cpp)
             label.text = f"≈ {grams:.0f} g"
 
     def dispense(self):
@@ -239,7 +459,7 @@ class AppMain(MDApp):
             except Exception:
                 connected = False
 
-            if not connected:
+            if not connected and self.dispatch_local:
                 _toast("Conéctese por Bluetooth primero")
                 return
 
@@ -258,18 +478,79 @@ class AppMain(MDApp):
             )
             grams = max(0, grams)
 
-            cmd = f"DISPENSE:{hopper}:{int(round(grams))}"
-            ok, msg = self.bt.send(cmd)
-            _toast(msg)
+            if not self.dispatch_local:
+                # Lo envía el demonio; el historial se ve al confirmarse
+                if self.dispatcher.dispense(self.selected_food, hopper, grams):
+                    _toast("En cola: lo envía el demonio")
+                return
 
-            if ok:
-                kcal = self.db.calories_for_grams(grams, gpp, cpp)
-                self.db.add_history(name, hopper, grams, kcal, int(time()))
-                self._refresh_history_ui()
+            # El envío ocurre en el hilo de E/S; el resultado vuelve al hilo de la UI
+            self.dispatcher.dispense(
+                self.selected_food,
+                hopper,
+                grams,
+                getattr(self.bt, "current", None),
+                callback=self._on_dispensed,
+            )
         except Exception as e:
             traceback.print_exc()
             _toast(f"Error al dispensar: {e}")
 
+    def _on_dispensed(self, ok, msg):
+        if ok is None:
+            # Salió hacia el dispensador sin confirmación: decide el usuario
+            self.review_unconfirmed()
+            return
+        _toast(msg)
+        if ok:
+            self._refresh_history_ui()
+
+    def review_unconfirmed(self):
+        # Un dispensado sin confirmar por vez, el más antiguo primero; lo
+        # que se responda aquí decide si entra al historial (DB.resolve_command)
+        if not self._ready():
+            return
+        rows = self.db.list_unconfirmed()
+        if not rows:
+            _toast("No hay dispensados sin confirmar")
+            return
+        from kivymd.uix.dialog import MDDialog
+        from kivymd.uix.button import MDButton, MDButtonText
+
+        _, cmd_id, name, hopper, grams, _, _, created_ts, _, _, _, error = rows[0]
+        when = datetime.fromtimestamp(created_ts).strftime("%Y-%m-%d %H:%M")
+        self.unconfirmed_dialog = MDDialog(
+            title="¿Salió la comida?",
+            text=f"{name} · {grams:.0f} g en la tolva {hopper} ({when}). {error or ''}. "
+                 f"Revise la tolva antes de responder ({len(rows)} sin confirmar).",
+            buttons=[
+                MDButton(
+                    MDButtonText(text="No salió"),
+                    style="text",
+                    on_release=lambda *_: self._resolve_unconfirmed(cmd_id, False),
+                ),
+                MDButton(
+                    MDButtonText(text="Sí, dispensó"),
+                    style="elevated",
+                    on_release=lambda *_: self._resolve_unconfirmed(cmd_id, True),
+                ),
+            ],
+        )
+        self.unconfirmed_dialog.open()
+
+    def _resolve_unconfirmed(self, cmd_id, dispensed):
+        self.unconfirmed_dialog.dismiss()
+        try:
+            self.db.resolve_command(cmd_id, dispensed, int(time()))
+        except Exception as e:
+            traceback.print_exc()
+            _toast(f"Error: {e}")
+            return
+        if dispensed:
+            self._refresh_history_ui()
+        if self.db.list_unconfirmed():
+            self.review_unconfirmed()
+
     # ---------------- Conectar ----------------
     def refresh_paired(self):
         try:
@@ -277,6 +558,7 @@ class AppMain(MDApp):
             scr = self.sm.get_screen("connect")
             lst = scr.ids.devices_list
             lst.clear_widgets()
+            from kivymd.uix.list import MDListItem
 
             devices = self.bt.list_paired()
             if not devices:
@@ -297,17 +579,39 @@ class AppMain(MDApp):
             _toast(f"Error al buscar BT: {e}")
 
     def _connect_to(self, mac):
+        if self.supervisor is not None:
+            # La conexión RFCOMM bloquea: la hace el supervisor en su hilo
+            # y el resultado llega por _on_link_change
+            self.bt_status_text = f"Conectando a {mac}..."
+            self.supervisor.watch(mac)
+            return
         try:
             ok, msg = self.bt.connect(mac)
             self.bt_status_text = msg
+            if ok and hasattr(self.bt, "devices"):
+                self.bt_status_text = f"{msg} · {len(self.bt.devices())} conectados"
             _toast(msg)
         except Exception as e:
             traceback.print_exc()
             self.bt_status_text = "Error al conectar"
             _toast(f"No se pudo conectar: {e}")
 
+    def _on_link_change(self, mac, state, msg):
+        from supervisor import CONNECTED
+
+        self.bt_status_text = f"{mac}: {msg}"
+        if state == CONNECTED:
+            self.bt_status_text = f"{msg} · {len(self.bt.devices())} conectados"
+            # Lo que esperaba en la bandeja de salida sale sin esperar al
+            # siguiente reintento
+            self.dispatcher.outbox.kick()
+        _toast(self.bt_status_text)
+
     # ---------------- Alimentos (CRUD) ----------------
+    @metrics.timed("ui.refresh_foods")
     def _refresh_foods_ui(self):
+        if not self.sm.has_screen("foods"):
+            return
         foods_scr = self.sm.get_screen("foods")
         foods = self.db.list_foods()
         rv = foods_scr.ids.foods_rv
@@ -321,6 +625,10 @@ class AppMain(MDApp):
 
     def open_food_form(self, food_id):
         food = self.db.get_food(food_id) if food_id else None
+        from kivymd.uix.dialog import MDDialog
+        from kivymd.uix.button import MDButton, MDButtonText
+        from forms import FoodForm
+
         form = FoodForm(self, food=food)
         self.food_dialog = MDDialog(
             title=("Editar alimento" if food else "Nuevo alimento"),
@@ -358,23 +666,277 @@ class AppMain(MDApp):
             traceback.print_exc()
             _toast(f"Error: {e}")
 
+    # ---------------- Tolvas ----------------
+    @staticmethod
+    def _format_profiles(profiles):
+        # "Luna 320/500 kcal · Tom (Avena) 90/200 kcal"
+        return " · ".join(
+            f"{name}{f' ({food})' if food else ''} {eaten:.0f}/{kcal:.0f} kcal"
+            for _, name, _, food, kcal, eaten in profiles
+        )
+
+    @staticmethod
+    def _format_hopper_row(hopper, fc):
+        if fc is None:
+            return {
+                "headline_text": f"Tolva {hopper}",
+                "supporting_text": "Sin seguimiento — toque para registrar una recarga",
+            }
+        level, capacity, rate, seconds = fc
+        pct = level * 100 / capacity if capacity else 0
+        if seconds is None:
+            eta = "sin consumo reciente"
+        elif seconds < 86400:
+            eta = f"se vacía en ~{seconds / 3600:.0f} h"
+        else:
+            eta = f"se vacía en ~{seconds / 86400:.1f} días"
+        return {
+            "headline_text": f"Tolva {hopper} · {level:.0f} / {capacity:.0f} g ({pct:.0f}%)",
+            "supporting_text": f"{rate:.0f} g/día  —  {eta}",
+        }
+
+    @metrics.timed("ui.refresh_hoppers")
+    def _refresh_hoppers_ui(self):
+        if not self.sm.has_screen("hoppers") or self.sm.current != "hoppers":
+            return
+        rv = self.sm.get_screen("hoppers").ids.hoppers_rv
+        data = []
+        profiles = {}
+        for p in self.db.list_profiles():
+            profiles.setdefault(p[2], []).append(p)
+        for hopper, *_ in self.db.hopper_levels():
+            row = self._format_hopper_row(hopper, self.inventory.forecast(hopper))
+            if hopper in profiles:
+                row["supporting_text"] += "  —  " + self._format_profiles(profiles[hopper])
+            row["on_release"] = lambda x=None, h=hopper: self.open_refill_form(h)
+            data.append(row)
+        rv.data = data
+
+    def open_refill_form(self, hopper_index):
+        from kivymd.uix.dialog import MDDialog
+        from kivymd.uix.button import MDButton, MDButtonText
+        from forms import RefillForm
+
+        form = RefillForm(self, self.db.get_hopper(hopper_index))
+        self.refill_dialog = MDDialog(
+            title=f"Recargar tolva {hopper_index}",
+            type="custom",
+            content_cls=form,
+            buttons=[
+                MDButton(
+                    MDButtonText(text="Cancelar"),
+                    style="text",
+                    on_release=lambda *_: self.refill_dialog.dismiss(),
+                ),
+                MDButton(
+                    MDButtonText(text="Guardar"),
+                    style="elevated",
+                    on_release=lambda *_: self._save_refill(form, hopper_index),
+                ),
+            ],
+        )
+        self.refill_dialog.open()
+
+    def _save_refill(self, form, hopper_index):
+        try:
+            grams = float(form.grams_field.text.strip() or 0)
+            capacity_text = form.capacity_field.text.strip()
+            capacity = float(capacity_text) if capacity_text else None
+            if grams < 0 or (capacity is not None and capacity <= 0):
+                raise ValueError("Datos inválidos")
+            level = self.db.add_refill(hopper_index, grams, int(time()), capacity)
+            self.refill_dialog.dismiss()
+            _toast(f"Tolva {hopper_index}: {level:.0f} g")
+            self._refresh_hoppers_ui()
+        except Exception as e:
+            traceback.print_exc()
+            _toast(f"Error: {e}")
+
+    def open_profile_form(self):
+        from kivymd.uix.dialog import MDDialog
+        from kivymd.uix.button import MDButton, MDButtonText
+        from forms import ProfileForm
+
+        form = ProfileForm(self)
+        self.profile_dialog = MDDialog(
+            title="Perfil de alimentación",
+            type="custom",
+            content_cls=form,
+            buttons=[
+                MDButton(
+                    MDButtonText(text="Cancelar"),
+                    style="text",
+                    on_release=lambda *_: self.profile_dialog.dismiss(),
+                ),
+                MDButton(
+                    MDButtonText(text="Eliminar"),
+                    style="text",
+                    on_release=lambda *_: self._delete_profile(form),
+                ),
+                MDButton(
+                    MDButtonText(text="Guardar"),
+                    style="elevated",
+                    on_release=lambda *_: self._save_profile(form),
+                ),
+            ],
+        )
+        self.profile_dialog.open()
+
+    def _save_profile(self, form):
+        try:
+            name = form.name_field.text.strip()
+            hopper = max(1, min(3, int(form.hopper_field.text.strip() or 1)))
+            kcal = float(form.kcal_field.text.strip() or 0)
+            food = form.food_search.selected
+            food_name = form.food_search.field.text.strip()
+            if food is not None:
+                food_name = food[1]
+            elif food_name and self.db.food_by_name(food_name) is None:
+                raise ValueError(f"Alimento desconocido: {food_name}")
+            self.db.upsert_profile(name, hopper, kcal, food_name or None)
+            self.profile_dialog.dismiss()
+            _toast(f"{name}: {kcal:.0f} kcal/día en la tolva {hopper}")
+            self._refresh_hoppers_ui()
+        except Exception as e:
+            traceback.print_exc()
+            _toast(f"Error: {e}")
+
+    def _delete_profile(self, form):
+        name = form.name_field.text.strip()
+        if self.db.delete_profile(name):
+            self.profile_dialog.dismiss()
+            _toast(f"Perfil {name} eliminado")
+            self._refresh_hoppers_ui()
+        else:
+            _toast("No hay un perfil con ese nombre")
+
+    def import_foods(self):
+        if not self._ready():
+            return
+        if getattr(self, "_import_thread", None) is not None and self._import_thread.is_alive():
+            _toast("Ya hay una importación en curso")
+            return
+        try:
+            from plyer import filechooser
+
+            filechooser.open_file(
+                on_selection=self._import_foods_from,
+                filters=[["CSV", "*.csv", "*.csv.gz"]],
+            )
+        except Exception as e:
+            traceback.print_exc()
+            _toast(f"No se pudo abrir el selector: {e}")
+
+    def _import_foods_from(self, selection):
+        if not selection:
+            return
+        path = selection[0]
+
+        def _progress(done, skipped):
+            self._set_foods_status(f"Importando: {done} alimentos ({skipped} filas descartadas)")
+
+        def _run():
+            import food_import
+
+            try:
+                done, skipped = food_import.import_csv(self.db, path, _progress)
+                self._set_foods_status(f"{done} alimentos importados ({skipped} filas descartadas)")
+                Clock.schedule_once(lambda *_: self._refresh_foods_ui(), 0)
+            except Exception as e:
+                traceback.print_exc()
+                self._set_foods_status(f"Error importando: {e}")
+
+        self._import_thread = threading.Thread(target=_run, name="food-import", daemon=True)
+        self._import_thread.start()
+
+    def _set_foods_status(self, text):
+        # Llamado desde el hilo de importación
+        Clock.schedule_once(lambda *_: setattr(self, "foods_status_text", text), 0)
+
     # ---------------- Programación ----------------
+    @staticmethod
+    def _format_schedule_row(row):
+        sched_id, name, hopper, grams, when_ts, executed, food_id, device = row
+        dt = datetime.fromtimestamp(when_ts).strftime("%Y-%m-%d %H:%M")
+        if executed == SKIPPED:
+            status = "⊘ omitido (presupuesto)"
+        else:
+            status = "✓ ejecutado" if executed else "⏳ pendiente"
+        where = f"Tolva {hopper} @ {device}" if device else f"Tolva {hopper}"
+        return {
+            "headline_text": f"{name} · {grams:.0f} g ({where})",
+            "supporting_text": f"{dt}  —  {status}",
+        }
+
+    @staticmethod
+    def _format_recurrence_row(rec):
+        rec_id, name, hopper, grams, rule, start_ts, end_ts, last_run_ts, food_id, device = rec
+        where = f"Tolva {hopper} @ {device}" if device else f"Tolva {hopper}"
+        after = max(int(time()), start_ts - 1, last_run_ts or 0)
+        try:
+            from recurrence import next_occurrence
+
+            nxt = next_occurrence(rule, after, end_ts)
+        except ValueError:
+            nxt = None
+        when = (
+            "próxima " + datetime.fromtimestamp(nxt).strftime("%Y-%m-%d %H:%M")
+            if nxt else "finalizada"
+        )
+        return {
+            "headline_text": f"{name} · {grams:.0f} g ({where})",
+            "supporting_text": f"↻ {rule}  —  {when}",
+        }
+
+    @metrics.timed("ui.refresh_schedule")
     def _refresh_schedule_ui(self):
+        # Claves de la vista: (-1, id) para recurrentes (arriba) y
+        # (when_ts, id) para programaciones únicas
+        if not self.sm.has_screen("schedule"):
+            return
         schedule_scr = self.sm.get_screen("schedule")
-        rows = self.db.list_schedules()
         rv = schedule_scr.ids.sched_rv
-        rv.data = []
-        for sched_id, name, hopper, grams, when_ts, executed, food_id in rows:
-            dt = datetime.fromtimestamp(when_ts).strftime("%Y-%m-%d %H:%M")
-            status = "✓ ejecutado" if executed else "⏳ pendiente"
-            rv.data.append(
-                {
-                    "headline_text": f"{name} · {grams:.0f} g (Tolva {hopper})",
-                    "supporting_text": f"{dt}  —  {status}",
-                }
-            )
+        if self._sched_full:
+            recs = self.db.list_recurrences()
+            self._sched_full = False
+            self._sched_dirty.clear()
+            self._sched_recs = [r[0] for r in recs]
+            rv.data = [self._format_recurrence_row(r) for r in recs]
+            # Los nombres de alimento están en las páginas formateadas
+            self._sched_pager.clear_cache()
+            self._sched_pager.reset(rv.data, len(recs))
+            return
+        if not self._sched_dirty:
+            return
+        # Solo se consultan y formatean las filas nuevas o modificadas
+        dirty, self._sched_dirty = self._sched_dirty, set()
+        for kind, row_id in dirty:
+            if kind == "s":
+                row = self.db.get_schedule(row_id)
+                if row is not None:
+                    self._sched_pager.upsert(
+                        (row[4], row[0]), self._format_schedule_row(row), rv.data, len(self._sched_recs)
+                    )
+                continue
+            row = self.db.get_recurrence(row_id)
+            item = self._format_recurrence_row(row) if row else None
+            pos = bisect_left(self._sched_recs, row_id)
+            found = pos < len(self._sched_recs) and self._sched_recs[pos] == row_id
+            if item is None:
+                if found:
+                    del self._sched_recs[pos]
+                    del rv.data[pos]
+            elif found:
+                rv.data[pos] = item
+            else:
+                self._sched_recs.insert(pos, row_id)
+                rv.data.insert(pos, item)
 
     def open_schedule_form(self):
+        from kivymd.uix.dialog import MDDialog
+        from kivymd.uix.button import MDButton, MDButtonText
+        from forms import ScheduleForm
+
         form = ScheduleForm(self)
         self.sched_dialog = MDDialog(
             title="Programar dispensado",
@@ -403,10 +965,30 @@ class AppMain(MDApp):
             dt = datetime.strptime(
                 form.datetime_field.text.strip(), "%Y-%m-%d %H:%M"
             )
-            food = self.db.food_by_name(food_name)
+            device = form.device_field.text.strip() or None
+            repeat = form.repeat_field.text.strip()
+            until = form.until_field.text.strip()
+            food = form.food_search.selected or self.db.food_by_name(food_name)
             if not food:
-                raise ValueError("Alimento no encontrado (verifique nombre exacto)")
-            self.db.add_schedule(food[0], hopper, grams, int(dt.timestamp()))
+                # Se acepta el texto escrito si identifica un único alimento
+                matches = self.db.search_foods(food_name, 2)
+                if len(matches) != 1:
+                    raise ValueError("Alimento no encontrado (elíjalo de la lista)")
+                food = matches[0]
+            if repeat:
+                # Una sola fila con la regla; las ocurrencias se calculan al vuelo
+                from recurrence import canonical
+
+                rule = canonical(repeat, dt.strftime("%H:%M"))
+                end_ts = None
+                if until:
+                    end = datetime.strptime(until, "%Y-%m-%d").replace(hour=23, minute=59)
+                    end_ts = int(end.timestamp())
+                self.db.add_recurrence(
+                    food[0], hopper, grams, rule, int(dt.timestamp()), end_ts, device
+                )
+            else:
+                self.db.add_schedule(food[0], hopper, grams, int(dt.timestamp()), device)
             self.sched_dialog.dismiss()
             _toast("Programado")
             self._refresh_schedule_ui()
@@ -414,35 +996,103 @@ class AppMain(MDApp):
             traceback.print_exc()
             _toast(f"Error: {e}")
 
-    def _send_schedule(self, food_id, food_name, hopper_idx, grams):
+    # ---------------- Historial ----------------
+    @staticmethod
+    def _format_history_row(row):
+        _, name, hopper, grams, kcal, ts, device = row
+        dt = datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M")
+        where = f"Tolva {hopper} @ {device}" if device else f"Tolva {hopper}"
+        return {
+            "headline_text": f"{name} · {grams:.0f} g  (≈ {kcal:.0f} kcal)",
+            "supporting_text": f"{dt}  —  {where}",
+        }
+
+    # ---------------- Exportación ----------------
+    def export_data(self, fmt="csv", compress=True):
+        if not self._ready():
+            return
+        if getattr(self, "_export_thread", None) is not None and self._export_thread.is_alive():
+            _toast("Ya hay una exportación en curso")
+            return
+        directory = os.path.join(self.user_data_dir, "exportes")
+
+        def _progress(table, done, total):
+            pct = 100 if not total else int(done * 100 / total)
+            self._set_export_status(f"Exportando {table}: {done}/{total} ({pct}%)")
+
+        def _run():
+            import export
+
+            try:
+                export.export_all(self.db, directory, fmt, compress, _progress)
+                self._set_export_status(f"Exportado en {directory}")
+            except Exception as e:
+                traceback.print_exc()
+                self._set_export_status(f"Error exportando: {e}")
+
+        self._export_thread = threading.Thread(target=_run, name="export", daemon=True)
+        self._export_thread.start()
+
+    def _set_export_status(self, text):
+        # Llamado desde el hilo de exportación
+        Clock.schedule_once(lambda *_: setattr(self, "export_status_text", text), 0)
+
+    def _refresh_history_summary(self):
+        # NumPy se importa aquí, al abrir el historial, no en el arranque
         try:
-            cmd = f"DISPENSE:{hopper_idx}:{int(round(grams))}"
-            ok, msg = self.bt.send(cmd)
-            if ok:
-                food = self.db.get_food(food_id)
-                _, name, gpp, cpp = food
-                kcal = self.db.calories_for_grams(grams, gpp, cpp)
-                self.db.add_history(name, hopper_idx, grams, kcal, int(time()))
-            return ok
+            import analytics
+
+            s = analytics.summary(self.db)
         except Exception as e:
-            traceback.print_exc()
-            _toast(f"Error enviando programación: {e}")
-            return False
+            print("Resumen no disponible:", e)
+            return
+        text = f"Hoy: {s['today_kcal']:.0f} kcal"
+        if s["avg_kcal"] is not None:
+            text += f" · media 7 días: {s['avg_kcal']:.0f} kcal"
+        if s["anomaly"]:
+            text += " · fuera de lo habitual"
+        self.history_summary_text = text
 
-    # ---------------- Historial ----------------
+    @metrics.timed("ui.refresh_history")
     def _refresh_history_ui(self):
+        if not self.sm.has_screen("history"):
+            return
         history_scr = self.sm.get_screen("history")
-        items = self.db.history_last_7_days(int(time()))
         rv = history_scr.ids.hist_rv
-        rv.data = []
-        for name, hopper, grams, kcal, ts in items:
-            dt = datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M")
-            rv.data.append(
-                {
-                    "headline_text": f"{name} · {grams:.0f} g  (≈ {kcal:.0f} kcal)",
-                    "supporting_text": f"{dt}  —  Tolva {hopper}",
-                }
-            )
+        cutoff = int(time()) - 7 * 24 * 3600
+
+        version = self.db.version("history")
+        if self._hist_version == -1:
+            # Primera apertura: solo la primera página; el resto al desplazarse
+            self._hist_version = version
+            self._hist_pager.reset(rv.data)
+            if self._hist_pager.keys:
+                self._hist_hwm = -self._hist_pager.keys[0][0]
+            self._refresh_history_summary()
+        elif version != self._hist_version:
+            # Filas nuevas desde la marca de agua; se anteponen (más recientes arriba)
+            self._hist_version = version
+            rows = self.db.history_after(self._hist_hwm, cutoff)
+            if rows:
+                self._hist_hwm = rows[-1][0]
+                rows.reverse()
+                self._hist_pager.prepend(rows, rv.data)
+            self._refresh_history_summary()
+        self._trim_history(rv, cutoff)
+
+    def _fetch_history_page(self, after, limit):
+        cutoff = int(time()) - 7 * 24 * 3600
+        return self.db.history_page(-after[0] if after else None, cutoff, limit)
+
+    def _trim_history(self, rv, cutoff=None):
+        # Filas que salieron de la ventana de 7 días (siempre al final)
+        if cutoff is None:
+            cutoff = int(time()) - 7 * 24 * 3600
+        keys = self._hist_pager.keys
+        n = len(keys)
+        while n and keys[n - 1][1] < cutoff:
+            n -= 1
+        self._hist_pager.truncate(n, rv.data)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,230 @@
+# Instrumentación del camino crítico: temporizadores con histogramas de
+# cubetas logarítmicas (costo fijo por medición, memoria constante),
+# contadores y un perfilador por muestreo que solo existe mientras está activo.
+#
+# DISPENSADOR_METRICS=0 desactiva los temporizadores: timed() devuelve la
+# función original, sin envoltorio.
+import functools
+import inspect
+import json
+import os
+import sys
+import threading
+from collections import Counter
+from time import perf_counter, sleep
+
+ENABLED = os.environ.get("DISPENSADOR_METRICS", "1") != "0"
+
+# Cubeta i: duraciones en [2^(i-1), 2^i) microsegundos; la última acumula el resto
+_BUCKETS = 32
+
+
+class Histogram:
+    __slots__ = ("count", "total", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * _BUCKETS
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        us = int(seconds * 1e6)
+        self.buckets[min(us.bit_length(), _BUCKETS - 1)] += 1
+
+    def percentile(self, p):
+        # Límite superior de la cubeta que contiene el percentil (ms)
+        if not self.count:
+            return 0.0
+        target = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target:
+                return min((1 << i) / 1000.0, self.max * 1000)
+        return self.max * 1000
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            "p50_ms": round(self.percentile(50), 3),
+            "p95_ms": round(self.percentile(95), 3),
+            "p99_ms": round(self.percentile(99), 3),
+            "max_ms": round(self.max * 1000, 3),
+        }
+
+
+_timers = {}
+_counters = Counter()
+_lock = threading.Lock()
+
+
+def _histogram(name):
+    h = _timers.get(name)
+    if h is None:
+        with _lock:
+            h = _timers.setdefault(name, Histogram())
+    return h
+
+
+def record(name, seconds):
+    if ENABLED:
+        _histogram(name).record(seconds)
+
+
+def count(name, n=1):
+    if ENABLED:
+        _counters[name] += n
+
+
+class timer:
+    # with metrics.timer("nombre"): ...
+    __slots__ = ("name", "t0")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, perf_counter() - self.t0)
+        return False
+
+
+def timed(name):
+    def decorator(fn):
+        if not ENABLED:
+            return fn
+        h = _histogram(name)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            t0 = perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                h.record(perf_counter() - t0)
+
+        return wrapper
+    return decorator
+
+
+def instrument_class(cls, prefix, exclude=()):
+    # Envuelve los métodos públicos de cls con timed("<prefix>.<método>").
+    # Se omiten estáticos, generadores y los nombres de `exclude`.
+    for name, attr in list(vars(cls).items()):
+        if name.startswith("_") or name in exclude:
+            continue
+        if isinstance(attr, (staticmethod, classmethod)) or not inspect.isfunction(attr):
+            continue
+        if inspect.isgeneratorfunction(attr):
+            continue
+        setattr(cls, name, timed(f"{prefix}.{name}")(attr))
+    return cls
+
+
+def snapshot():
+    with _lock:
+        timers = {name: h.summary() for name, h in sorted(_timers.items()) if h.count}
+    return {"timers": timers, "counters": dict(sorted(_counters.items()))}
+
+
+def report():
+    snap = snapshot()
+    lines = []
+    for name, s in snap["timers"].items():
+        lines.append(
+            f"{name}: n={s['count']} p50={s['p50_ms']} p99={s['p99_ms']} máx={s['max_ms']} ms"
+        )
+    for name, n in snap["counters"].items():
+        lines.append(f"{name}: {n}")
+    return "\n".join(lines) or "Sin datos todavía"
+
+
+def dump(path):
+    data = snapshot()
+    if profiler.samples:
+        data["profile"] = profiler.top(50)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    return path
+
+
+def reset():
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+
+
+class SamplingProfiler:
+    # Muestrea la pila de un hilo (por defecto el principal) cada `interval`
+    # segundos desde un hilo aparte. Apagado no hay hilo ni ganchos: costo cero.
+    def __init__(self, interval=0.005, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        if self.thread_id is None:
+            self.thread_id = threading.main_thread().ident
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout=1.0)
+        self._thread = None
+
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+        return self.running
+
+    def _run(self):
+        while not self._stop.is_set():
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                stack = []
+                while frame is not None and len(stack) < 64:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                    frame = frame.f_back
+                self.samples[";".join(reversed(stack))] += 1
+            sleep(self.interval)
+
+    def top(self, n=20):
+        # Funciones "hoja" más frecuentes: [(función, muestras)]
+        leaves = Counter()
+        for stack, hits in self.samples.items():
+            leaves[stack.rsplit(";", 1)[-1]] += hits
+        return leaves.most_common(n)
+
+    def dump_collapsed(self, path):
+        # Formato de pilas colapsadas (compatible con flamegraph.pl / speedscope)
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, hits in self.samples.most_common():
+                f.write(f"{stack} {hits}\n")
+        return path
+
+
+profiler = SamplingProfiler()
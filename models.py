@@ -1,18 +1,279 @@
 import sqlite3
+import threading
+import atexit
+import queue
+import gzip
+import json
+import os
+import re
+import unicodedata
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime
+from difflib import get_close_matches
+from functools import lru_cache
+from urllib.request import pathname2url
+
+import metrics
 
 DB_NAME = "app.db"
 
+# Conexiones de solo lectura (WAL) para consultas de la UI y reportes
+READERS = 3
+# Espera máxima (s) por un lector libre antes de abrir uno temporal
+READER_WAIT = 0.05
+
+# Búsqueda aproximada de alimentos: candidatos revisados como máximo
+FUZZY_SCAN = 5000
+_WORD = re.compile(r"\w+")
+
+# Retención del historial crudo; lo anterior se archiva y solo quedan los
+# acumulados diarios (history_daily)
+RETENTION_DAYS = 90
+ARCHIVE_DIR = "archive"
+
+# Tolvas del dispensador, numeradas desde 1
+HOPPERS = 3
+
+# Bandeja de salida: días que se conservan los comandos ya resueltos
+OUTBOX_KEEP_DAYS = 7
+
+# schedules.executed: 0 pendiente, 1 ejecutada, 2 omitida (presupuesto
+# diario del perfil agotado, ver profiles.py)
+EXECUTED = 1
+SKIPPED = 2
+
+# Tablas que la app y daemon.py escriben sobre el mismo archivo; un cambio
+# de otro proceso sube la versión de todas (ver DB.check_external)
+SHARED_TABLES = ("foods", "schedules", "recurrences", "history", "outbox", "profiles", "hoppers")
+
 DEFAULT_FOODS = [
     ("Arroz", 100.0, 130.0),
     ("Avena", 100.0, 389.0),
     ("Frijol", 100.0, 347.0),
 ]
 
+
+def normalize_name(text):
+    # Minúsculas y sin acentos: "Plátano" -> "platano"
+    text = text.lower()
+    if text.isascii():
+        return text
+    text = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
 class DB:
-    def __init__(self, path=DB_NAME):
+    # Acceso concurrente: self.conn es la única conexión que escribe y toda
+    # escritura va bajo self._lock. Las lecturas usan un pool de conexiones
+    # de solo lectura sobre WAL, que no esperan a la escritora. Con :memory:
+    # no hay pool y las lecturas usan la escritora bajo el mismo lock.
+    def __init__(self, path=DB_NAME, write_behind=False, flush_size=50, flush_interval=2.0,
+                 readers=READERS):
+        self.path = path
         self.conn = sqlite3.connect(path, check_same_thread=False)
         self.conn.execute("PRAGMA foreign_keys=ON")
+        self._listeners = []
+        # Contador monotónico de cambios por tabla (para vistas incrementales)
+        self._versions = {}
+        self._lock = threading.RLock()
+
+        # Modo write-behind: historial y marcas de ejecución se acumulan en
+        # memoria y se escriben en una sola transacción (por tamaño o tiempo).
+        self.write_behind = write_behind
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._buf_history = []
+        self._buf_executed = []
+        self._flush_timer = None
+
+        # Catálogo de alimentos en memoria (se carga una vez, write-through).
+        # Lock propio y breve: las lecturas del catálogo no esperan a la escritora.
+        # Orden de locks: _lock antes que _cache_lock (las escrituras llegan a
+        # _update_profiles con _lock tomado); los SELECT que llenan las cachés
+        # van fuera de _cache_lock, porque sin lectores _query toma _lock
+        self._cache_lock = threading.RLock()
+        # Sube con cada cambio del catálogo o de los perfiles: una carga que
+        # se cruzó con un cambio no se guarda
+        self._cache_gen = 0
+        self._foods_by_id = None
+        self._foods_by_name = None
+        self._foods_sorted = None
+        self._food_index = None
+        # Perfiles por (tolva, alimento o None) -> (id, kcal diarias, nombre); bajo _cache_lock
+        self._profile_map = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # Solo surte efecto en una base nueva, antes de WAL y de crear tablas;
+        # las existentes se convierten con compact(full=True) (ver daemon.py)
+        self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+        wal = False
+        if path != ":memory:" and not path.startswith("file:"):
+            wal = self.conn.execute("PRAGMA journal_mode=WAL").fetchone()[0].lower() == "wal"
+        if write_behind:
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            atexit.register(self.close)
+
         self._migrate()
+        # PRAGMA data_version de la escritora: solo cambia cuando confirma
+        # otra conexión (otro proceso sobre el mismo archivo)
+        self._data_version = self.conn.execute("PRAGMA data_version;").fetchone()[0]
+
+        # Pool de lectores: se abren a demanda, hasta `readers`
+        self.readers = readers if wal else 0
+        self._read_pool = queue.LifoQueue()
+        self._read_all = []
+        self._pool_lock = threading.Lock()
+
+    # ---------------- Notificaciones de cambios ----------------
+    def subscribe(self, callback):
+        # callback(table, op, row_id)
+        self._listeners.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def version(self, table):
+        return self._versions.get(table, 0)
+
+    def _notify(self, table, op, row_id=None):
+        # Se llama en el hilo que escribió (p. ej. el de importación de
+        # alimentos): los suscriptores con estado propio lo llevan a su hilo
+        self._versions[table] = self._versions.get(table, 0) + 1
+        for cb in list(self._listeners):
+            cb(table, op, row_id)
+
+    def check_external(self):
+        # Escrituras de otro proceso (la app y el demonio comparten app.db)
+        # desde la última llamada: se invalidan las cachés y los suscriptores
+        # reciben ("db", "external", None). Llamar desde el hilo dueño de la
+        # DB; cuesta un PRAGMA
+        with self._lock:
+            version = self.conn.execute("PRAGMA data_version;").fetchone()[0]
+            if version == self._data_version:
+                return False
+            self._data_version = version
+        with self._cache_lock:
+            self._foods_by_id = self._foods_by_name = None
+            self._foods_sorted = self._food_index = None
+            self._profile_map = None
+            self._cache_gen += 1
+        for table in SHARED_TABLES:
+            self._versions[table] = self._versions.get(table, 0) + 1
+        self._notify("db", "external")
+        return True
+
+    # ---------------- Write-behind ----------------
+    def _buffer(self, buf, item):
+        with self._lock:
+            buf.append(item)
+            size = len(self._buf_history) + len(self._buf_executed)
+            if size >= self.flush_size:
+                self.flush()
+            else:
+                self._arm_flush()
+
+    def _arm_flush(self):
+        if self._flush_timer is None:
+            self._flush_timer = threading.Timer(self.flush_interval, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def _flush_pending(self, history_only=False):
+        # Lectura de lo propio: las consultas ven lo que aún está en memoria.
+        # history_only: la consulta no depende de las marcas de ejecución
+        if self._buf_history or (self._buf_executed and not history_only):
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if not self._buf_history and not self._buf_executed:
+                return
+            history, self._buf_history = self._buf_history, []
+            executed, self._buf_executed = self._buf_executed, []
+            try:
+                with self.conn:
+                    self.conn.executemany(
+                        "INSERT INTO history(food_name, hopper_index, grams, calories, ts, device) VALUES(?,?,?,?,?,?)",
+                        history
+                    )
+                    self._update_rollups(self.conn, history)
+                    self._update_levels(self.conn, history)
+                    self._update_profiles(self.conn, history)
+                    self.conn.executemany(
+                        "UPDATE schedules SET executed=? WHERE id=?",
+                        executed
+                    )
+            except sqlite3.Error:
+                # La transacción se deshizo (p. ej. SQLITE_BUSY o disco
+                # lleno): las filas vuelven al búfer, antes de lo que se haya
+                # acumulado mientras tanto, y se reintenta con el temporizador
+                self._buf_history[:0] = history
+                self._buf_executed[:0] = executed
+                self._arm_flush()
+                raise
+
+    def close(self):
+        with self._lock:
+            if self.conn is None:
+                return
+            self.flush()
+            self.conn.close()
+            self.conn = None
+        with self._pool_lock:
+            for conn in self._read_all:
+                conn.close()
+            self._read_all = []
+
+    # ---------------- Conexiones de lectura ----------------
+    def _open_reader(self):
+        uri = f"file:{pathname2url(os.path.abspath(self.path))}?mode=ro"
+        return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+    @contextmanager
+    def _reader(self):
+        # Presta una conexión de solo lectura (cada SELECT ve lo último
+        # confirmado). Si todas están ocupadas se espera READER_WAIT y luego
+        # se abre una temporal, para que ningún hilo quede sin turno.
+        if not self.readers:
+            with self._lock:
+                yield self.conn
+            return
+        pooled = True
+        try:
+            conn = self._read_pool.get_nowait()
+        except queue.Empty:
+            with self._pool_lock:
+                conn = None
+                if len(self._read_all) < self.readers:
+                    conn = self._open_reader()
+                    self._read_all.append(conn)
+            if conn is None:
+                try:
+                    conn = self._read_pool.get(timeout=READER_WAIT)
+                except queue.Empty:
+                    conn = self._open_reader()
+                    pooled = False
+        try:
+            yield conn
+        finally:
+            if pooled:
+                self._read_pool.put(conn)
+            else:
+                conn.close()
+
+    def _query(self, sql, params=()):
+        with self._reader() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def _query_one(self, sql, params=()):
+        with self._reader() as conn:
+            return conn.execute(sql, params).fetchone()
 
     def _migrate(self):
         cur = self.conn.cursor()
@@ -45,6 +306,130 @@ class DB:
             "ts INTEGER NOT NULL"
             ");"
         )
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_schedules_pending "
+            "ON schedules(executed, when_ts);"
+        )
+        # MAC del dispensador (NULL = dispensador actual)
+        self._add_column(cur, "schedules", "device", "TEXT")
+        self._add_column(cur, "history", "device", "TEXT")
+        # Programaciones recurrentes: una fila por regla (ver recurrence.py);
+        # last_run_ts es la última ocurrencia ejecutada
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS recurrences("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            "food_id INTEGER NOT NULL,"
+            "hopper_index INTEGER NOT NULL,"
+            "grams REAL NOT NULL,"
+            "rule TEXT NOT NULL,"
+            "start_ts INTEGER NOT NULL,"
+            "end_ts INTEGER,"
+            "device TEXT,"
+            "last_run_ts INTEGER,"
+            "FOREIGN KEY(food_id) REFERENCES foods(id) ON DELETE CASCADE"
+            ");"
+        )
+
+        # Lista paginada de programaciones: orden (when_ts, id) por índice
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_schedules_when ON schedules(when_ts);")
+
+        # Retención: índice por fecha y acumulados por día y tolva
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_history_ts ON history(ts);")
+        cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='history_daily';")
+        rollup_exists = cur.fetchone() is not None
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS history_daily("
+            "day TEXT NOT NULL,"
+            "hopper_index INTEGER NOT NULL,"
+            "grams REAL NOT NULL,"
+            "calories REAL NOT NULL,"
+            "count INTEGER NOT NULL,"
+            "PRIMARY KEY(day, hopper_index)"
+            ");"
+        )
+        if not rollup_exists:
+            cur.execute(
+                "INSERT INTO history_daily(day, hopper_index, grams, calories, count) "
+                "SELECT date(ts, 'unixepoch', 'localtime'), hopper_index, SUM(grams), SUM(calories), COUNT(*) "
+                "FROM history GROUP BY 1, 2;"
+            )
+
+        # Inventario: nivel actual por tolva (capacity_g = 0 => sin seguimiento)
+        # y registro de recargas
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS hoppers("
+            "hopper_index INTEGER PRIMARY KEY,"
+            "capacity_g REAL NOT NULL DEFAULT 0,"
+            "level_g REAL NOT NULL DEFAULT 0,"
+            "updated_ts INTEGER"
+            ");"
+        )
+        cur.executemany(
+            "INSERT OR IGNORE INTO hoppers(hopper_index) VALUES(?);",
+            [(h,) for h in range(1, HOPPERS + 1)]
+        )
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS refills("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            "hopper_index INTEGER NOT NULL,"
+            "grams REAL NOT NULL,"
+            "level_g REAL NOT NULL,"
+            "ts INTEGER NOT NULL"
+            ");"
+        )
+
+        # Bandeja de salida de comandos (ver outbox.py). cmd_id identifica el
+        # dispensado (p. ej. "s12@1700000000") y evita duplicados; state es
+        # 'pending', 'sending' (entregado al enlace, sin respuesta aún),
+        # 'done', 'failed' o 'unconfirmed' (enviado sin confirmación: lo
+        # resuelve el usuario); next_ts es el próximo intento
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS outbox("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            "cmd_id TEXT UNIQUE NOT NULL,"
+            "food_name TEXT NOT NULL,"
+            "hopper_index INTEGER NOT NULL,"
+            "grams REAL NOT NULL,"
+            "calories REAL NOT NULL,"
+            "device TEXT,"
+            "created_ts INTEGER NOT NULL,"
+            "next_ts INTEGER NOT NULL,"
+            "attempts INTEGER NOT NULL DEFAULT 0,"
+            "state TEXT NOT NULL DEFAULT 'pending',"
+            "last_error TEXT,"
+            "done_ts INTEGER"
+            ");"
+        )
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(state, next_ts);")
+
+        # Perfiles de alimentación: un animal o persona que come de una tolva,
+        # opcionalmente solo de un alimento (food_name, como en history), con
+        # un presupuesto diario de kcal. profile_daily lleva el total del día
+        # y se actualiza junto con cada fila de historial
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS profiles("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            "name TEXT UNIQUE NOT NULL,"
+            "hopper_index INTEGER NOT NULL,"
+            "food_name TEXT,"
+            "daily_kcal REAL NOT NULL"
+            ");"
+        )
+        cur.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_profiles_link "
+            "ON profiles(hopper_index, IFNULL(food_name, ''));"
+        )
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS profile_daily("
+            "profile_id INTEGER NOT NULL,"
+            "day TEXT NOT NULL,"
+            "calories REAL NOT NULL,"
+            "grams REAL NOT NULL,"
+            "count INTEGER NOT NULL,"
+            "PRIMARY KEY(profile_id, day),"
+            "FOREIGN KEY(profile_id) REFERENCES profiles(id) ON DELETE CASCADE"
+            ");"
+        )
         self.conn.commit()
 
         cur.execute("SELECT COUNT(*) FROM foods;")
@@ -55,81 +440,924 @@ class DB:
             )
             self.conn.commit()
 
+    @staticmethod
+    def _add_column(cur, table, column, decl):
+        cur.execute(f"PRAGMA table_info({table});")
+        if column not in [r[1] for r in cur.fetchall()]:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl};")
+
+    # ---------------- Caché de alimentos ----------------
+    def _food_cache(self):
+        while True:
+            with self._cache_lock:
+                if self._foods_by_id is not None:
+                    self.cache_hits += 1
+                    return self._foods_by_id
+                gen = self._cache_gen
+            rows = self._query("SELECT id, name, grams_per_portion, calories_per_portion FROM foods;")
+            with self._cache_lock:
+                if self._cache_gen == gen:
+                    self.cache_misses += 1
+                    self._foods_by_id = {r[0]: r for r in rows}
+                    self._foods_by_name = {r[1]: r for r in rows}
+                    self._foods_sorted = self._food_index = None
+                    return self._foods_by_id
+
+    @contextmanager
+    def _foods_locked(self):
+        # _cache_lock con el catálogo cargado; si se invalidó entre la carga
+        # y el lock, se vuelve a cargar
+        while True:
+            foods = self._food_cache()
+            with self._cache_lock:
+                if self._foods_by_id is foods:
+                    yield foods
+                    return
+
+    def _cache_put(self, row):
+        with self._cache_lock:
+            self._cache_gen += 1
+            if self._foods_by_id is None:
+                return
+            self._cache_drop(row[0])
+            old = self._foods_by_name.pop(row[1], None)
+            if old is not None:
+                self._foods_by_id.pop(old[0], None)
+            self._foods_by_id[row[0]] = row
+            self._foods_by_name[row[1]] = row
+            self._foods_sorted = self._food_index = None
+
+    def _cache_drop(self, food_id):
+        with self._cache_lock:
+            self._cache_gen += 1
+            if self._foods_by_id is None:
+                return
+            old = self._foods_by_id.pop(food_id, None)
+            if old is not None:
+                self._foods_by_name.pop(old[1], None)
+                self._foods_sorted = self._food_index = None
+
+    def cache_stats(self):
+        size = len(self._foods_by_id) if self._foods_by_id is not None else 0
+        return {"hits": self.cache_hits, "misses": self.cache_misses, "size": size}
+
     def list_foods(self):
-        cur = self.conn.cursor()
-        cur.execute("SELECT id, name, grams_per_portion, calories_per_portion FROM foods ORDER BY name;")
-        return cur.fetchall()
+        with self._foods_locked() as foods:
+            if self._foods_sorted is None:
+                self._foods_sorted = sorted(foods.values(), key=lambda r: r[1])
+            return list(self._foods_sorted)
 
     def upsert_food(self, name, grams_per_portion, calories_per_portion, food_id=None):
-        cur = self.conn.cursor()
-        if food_id is None:
-            cur.execute(
-                "INSERT OR REPLACE INTO foods(name, grams_per_portion, calories_per_portion) VALUES(?,?,?)",
-                (name, float(grams_per_portion), float(calories_per_portion))
-            )
-        else:
-            cur.execute(
-                "UPDATE foods SET name=?, grams_per_portion=?, calories_per_portion=? WHERE id=?",
-                (name, float(grams_per_portion), float(calories_per_portion), int(food_id))
-            )
-        self.conn.commit()
+        with self._lock:
+            cur = self.conn.cursor()
+            gpp, cpp = float(grams_per_portion), float(calories_per_portion)
+            if food_id is None:
+                cur.execute(
+                    "INSERT OR REPLACE INTO foods(name, grams_per_portion, calories_per_portion) VALUES(?,?,?)",
+                    (name, gpp, cpp)
+                )
+                food_id = cur.lastrowid
+            else:
+                cur.execute(
+                    "UPDATE foods SET name=?, grams_per_portion=?, calories_per_portion=? WHERE id=?",
+                    (name, gpp, cpp, int(food_id))
+                )
+                food_id = int(food_id)
+            self.conn.commit()
+            self._cache_put((food_id, name, gpp, cpp))
+        # INSERT OR REPLACE puede borrar en cascada programaciones del alimento anterior
+        self._notify("foods", "upsert", food_id)
+        return food_id
+
+    def delete_food(self, food_id):
+        with self._lock:
+            cur = self.conn.cursor()
+            cur.execute("DELETE FROM foods WHERE id=?", (int(food_id),))
+            self.conn.commit()
+            self._cache_drop(int(food_id))
+        # Las programaciones del alimento se borran en cascada
+        self._notify("foods", "delete", int(food_id))
 
     def get_food(self, food_id):
-        cur = self.conn.cursor()
-        cur.execute("SELECT id, name, grams_per_portion, calories_per_portion FROM foods WHERE id=?", (int(food_id),))
-        return cur.fetchone()
+        return self._food_cache().get(int(food_id))
 
     def food_by_name(self, name):
-        cur = self.conn.cursor()
-        cur.execute("SELECT id, name, grams_per_portion, calories_per_portion FROM foods WHERE name=?", (name,))
-        return cur.fetchone()
+        with self._foods_locked():
+            return self._foods_by_name.get(name)
+
+    # ---------------- Búsqueda e importación de alimentos ----------------
+    def _search_index(self):
+        # Dos listas ordenadas sobre el nombre normalizado: (nombre, id) y
+        # (sufijo desde cada palabra que no es la primera, id). Se invalida
+        # junto con _foods_sorted
+        with self._foods_locked() as foods:
+            if self._food_index is None:
+                names = []
+                words = []
+                for food_id, name, _, _ in foods.values():
+                    norm = normalize_name(name)
+                    names.append((norm, food_id))
+                    for m in _WORD.finditer(norm):
+                        if m.start():
+                            words.append((norm[m.start():], food_id))
+                names.sort()
+                words.sort()
+                self._food_index = (names, words, foods)
+            return self._food_index
 
+    def search_foods(self, query, k=10):
+        # Top-k: primero nombres que empiezan por la consulta, luego nombres
+        # con alguna palabra que empieza así (sin acentos ni mayúsculas); si no
+        # alcanza, coincidencias aproximadas entre los nombres con las mismas
+        # dos primeras letras
+        q = normalize_name(query.strip())
+        if not q:
+            return self.list_foods()[:k]
+        names, words, foods = self._search_index()
+        found = []
+        seen = set()
+        for entries in (names, words):
+            pos = bisect_left(entries, (q,))
+            while pos < len(entries) and len(found) < k and entries[pos][0].startswith(q):
+                food_id = entries[pos][1]
+                if food_id not in seen:
+                    seen.add(food_id)
+                    found.append(food_id)
+                pos += 1
+        if len(found) < k and len(q) >= 3:
+            lo = bisect_left(names, (q[:2],))
+            pool = {}
+            for norm, food_id in names[lo:lo + FUZZY_SCAN]:
+                if not norm.startswith(q[:2]):
+                    break
+                pool.setdefault(norm[:len(q)], []).append(food_id)
+            for key in get_close_matches(q, list(pool), n=k, cutoff=0.6):
+                for food_id in pool[key]:
+                    if food_id not in seen and len(found) < k:
+                        seen.add(food_id)
+                        found.append(food_id)
+        return [foods[i] for i in found]
+
+    def import_foods(self, rows, batch=1000, progress=None):
+        # rows: iterable de (nombre, gramos_por_porción, calorías_por_porción).
+        # Una transacción por lote; UPSERT por nombre para no borrar (ni
+        # arrastrar en cascada) las programaciones de alimentos que ya existen
+        sql = (
+            "INSERT INTO foods(name, grams_per_portion, calories_per_portion) VALUES(?,?,?) "
+            "ON CONFLICT(name) DO UPDATE SET "
+            "grams_per_portion = excluded.grams_per_portion, "
+            "calories_per_portion = excluded.calories_per_portion;"
+        )
+        done = 0
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= batch:
+                with self._lock, self.conn:
+                    self.conn.executemany(sql, chunk)
+                done += len(chunk)
+                chunk = []
+                if progress is not None:
+                    progress(done)
+        if chunk:
+            with self._lock, self.conn:
+                self.conn.executemany(sql, chunk)
+            done += len(chunk)
+        with self._cache_lock:
+            self._foods_by_id = self._foods_by_name = None
+            self._foods_sorted = self._food_index = None
+            self._cache_gen += 1
+        if progress is not None:
+            progress(done)
+        self._notify("foods", "import")
+        return done
+
+    # Memoizadas: la etiqueta de conversión repite los mismos argumentos por alimento
     @staticmethod
+    @lru_cache(maxsize=512)
     def calories_for_grams(grams, grams_per_portion, calories_per_portion):
         if grams_per_portion <= 0:
             return 0.0
         return (grams / grams_per_portion) * calories_per_portion
 
     @staticmethod
+    @lru_cache(maxsize=512)
     def grams_for_calories(calories, grams_per_portion, calories_per_portion):
         if calories_per_portion <= 0:
             return 0.0
         return (calories / calories_per_portion) * grams_per_portion
 
-    def add_schedule(self, food_id, hopper_index, grams, when_ts):
-        cur = self.conn.cursor()
-        cur.execute(
-            "INSERT INTO schedules(food_id, hopper_index, grams, when_ts) VALUES(?,?,?,?)",
-            (int(food_id), int(hopper_index), float(grams), int(when_ts))
-        )
-        self.conn.commit()
+    def add_schedule(self, food_id, hopper_index, grams, when_ts, device=None):
+        with self._lock:
+            cur = self.conn.cursor()
+            cur.execute(
+                "INSERT INTO schedules(food_id, hopper_index, grams, when_ts, device) VALUES(?,?,?,?,?)",
+                (int(food_id), int(hopper_index), float(grams), int(when_ts), device)
+            )
+            self.conn.commit()
+        sched_id = cur.lastrowid
+        self._notify("schedules", "add", sched_id)
+        return sched_id
 
     def list_schedules(self):
-        cur = self.conn.cursor()
-        cur.execute(
-            "SELECT s.id, f.name, s.hopper_index, s.grams, s.when_ts, s.executed, s.food_id "
+        self._flush_pending()
+        return self._query(
+            "SELECT s.id, f.name, s.hopper_index, s.grams, s.when_ts, s.executed, s.food_id, s.device "
             "FROM schedules s JOIN foods f ON f.id = s.food_id ORDER BY s.when_ts ASC;"
         )
-        return cur.fetchall()
 
-    def mark_executed(self, sched_id):
-        cur = self.conn.cursor()
-        cur.execute("UPDATE schedules SET executed=1 WHERE id=?", (int(sched_id),))
-        self.conn.commit()
+    def schedules_page(self, after=None, limit=50):
+        # Paginación por clave: filas con (when_ts, id) > after, en ese orden
+        self._flush_pending()
+        sql = (
+            "SELECT s.id, f.name, s.hopper_index, s.grams, s.when_ts, s.executed, s.food_id, s.device "
+            "FROM schedules s JOIN foods f ON f.id = s.food_id "
+        )
+        if after is None:
+            return self._query(sql + "ORDER BY s.when_ts ASC, s.id ASC LIMIT ?;", (int(limit),))
+        when_ts, sched_id = after
+        return self._query(
+            sql + "WHERE s.when_ts >= ? AND (s.when_ts > ? OR s.id > ?) "
+            "ORDER BY s.when_ts ASC, s.id ASC LIMIT ?;",
+            (int(when_ts), int(when_ts), int(sched_id), int(limit))
+        )
 
-    def add_history(self, food_name, hopper_index, grams, calories, ts):
-        cur = self.conn.cursor()
-        cur.execute(
-            "INSERT INTO history(food_name, hopper_index, grams, calories, ts) VALUES(?,?,?,?,?)",
-            (food_name, int(hopper_index), float(grams), float(calories), int(ts))
+    def list_pending_schedules(self, since_ts):
+        # Usa idx_schedules_pending: solo filas no ejecutadas a partir de since_ts
+        self._flush_pending()
+        return self._query(
+            "SELECT s.id, f.name, s.hopper_index, s.grams, s.when_ts, s.executed, s.food_id, s.device "
+            "FROM schedules s JOIN foods f ON f.id = s.food_id "
+            "WHERE s.executed = 0 AND s.when_ts >= ? ORDER BY s.when_ts ASC;",
+            (int(since_ts),)
         )
-        self.conn.commit()
+
+    def get_schedule(self, sched_id):
+        self._flush_pending()
+        return self._query_one(
+            "SELECT s.id, f.name, s.hopper_index, s.grams, s.when_ts, s.executed, s.food_id, s.device "
+            "FROM schedules s JOIN foods f ON f.id = s.food_id WHERE s.id = ?;",
+            (int(sched_id),)
+        )
+
+    def mark_executed(self, sched_id, skipped=False):
+        # skipped=True: atendida sin dispensar (queda como SKIPPED)
+        state = SKIPPED if skipped else EXECUTED
+        if self.write_behind:
+            self._buffer(self._buf_executed, (state, int(sched_id)))
+        else:
+            with self._lock:
+                cur = self.conn.cursor()
+                cur.execute("UPDATE schedules SET executed=? WHERE id=?", (state, int(sched_id)))
+                self.conn.commit()
+        self._notify("schedules", "executed", int(sched_id))
+
+    # ---------------- Programaciones recurrentes ----------------
+    def add_recurrence(self, food_id, hopper_index, grams, rule, start_ts, end_ts=None, device=None):
+        with self._lock:
+            cur = self.conn.cursor()
+            cur.execute(
+                "INSERT INTO recurrences(food_id, hopper_index, grams, rule, start_ts, end_ts, device) "
+                "VALUES(?,?,?,?,?,?,?)",
+                (int(food_id), int(hopper_index), float(grams), rule, int(start_ts),
+                 int(end_ts) if end_ts is not None else None, device)
+            )
+            self.conn.commit()
+        rec_id = cur.lastrowid
+        self._notify("recurrences", "add", rec_id)
+        return rec_id
+
+    def list_recurrences(self):
+        return self._query(
+            "SELECT r.id, f.name, r.hopper_index, r.grams, r.rule, r.start_ts, r.end_ts, "
+            "r.last_run_ts, r.food_id, r.device "
+            "FROM recurrences r JOIN foods f ON f.id = r.food_id ORDER BY r.id ASC;"
+        )
+
+    def get_recurrence(self, rec_id):
+        return self._query_one(
+            "SELECT r.id, f.name, r.hopper_index, r.grams, r.rule, r.start_ts, r.end_ts, "
+            "r.last_run_ts, r.food_id, r.device "
+            "FROM recurrences r JOIN foods f ON f.id = r.food_id WHERE r.id = ?;",
+            (int(rec_id),)
+        )
+
+    def mark_recurrence_run(self, rec_id, occurrence_ts):
+        with self._lock:
+            cur = self.conn.cursor()
+            cur.execute(
+                "UPDATE recurrences SET last_run_ts=? WHERE id=? AND (last_run_ts IS NULL OR last_run_ts < ?)",
+                (int(occurrence_ts), int(rec_id), int(occurrence_ts))
+            )
+            self.conn.commit()
+        self._notify("recurrences", "run", int(rec_id))
+
+    def delete_recurrence(self, rec_id):
+        with self._lock:
+            cur = self.conn.cursor()
+            cur.execute("DELETE FROM recurrences WHERE id=?", (int(rec_id),))
+            self.conn.commit()
+        self._notify("recurrences", "delete", int(rec_id))
+
+    def add_history(self, food_name, hopper_index, grams, calories, ts, device=None):
+        row = (food_name, int(hopper_index), float(grams), float(calories), int(ts), device)
+        if self.write_behind:
+            self._buffer(self._buf_history, row)
+            self._notify("history", "add")
+            return
+        with self._lock:
+            cur = self.conn.cursor()
+            cur.execute(
+                "INSERT INTO history(food_name, hopper_index, grams, calories, ts, device) VALUES(?,?,?,?,?,?)",
+                row
+            )
+            self._update_rollups(cur, [row])
+            self._update_levels(cur, [row])
+            self._update_profiles(cur, [row])
+            self.conn.commit()
+        self._notify("history", "add", cur.lastrowid)
 
     def history_last_7_days(self, now_ts):
-        cur = self.conn.cursor()
+        self._flush_pending()
         seven_days_ago = int(now_ts) - 7*24*3600
-        cur.execute(
+        return self._query(
             "SELECT food_name, hopper_index, grams, calories, ts FROM history WHERE ts >= ? ORDER BY ts DESC;",
             (seven_days_ago,)
         )
-        return cur.fetchall()
+
+    def history_after(self, after_id, since_ts):
+        # Marca de agua sobre history.id: solo filas nuevas desde la última consulta
+        self._flush_pending()
+        return self._query(
+            "SELECT id, food_name, hopper_index, grams, calories, ts, device FROM history "
+            "WHERE id > ? AND ts >= ? ORDER BY id ASC;",
+            (int(after_id), int(since_ts))
+        )
+
+    def history_page(self, before_id, since_ts, limit=50):
+        # Más recientes primero: filas con id < before_id (None = desde la última)
+        self._flush_pending()
+        return self._query(
+            "SELECT id, food_name, hopper_index, grams, calories, ts, device FROM history "
+            "WHERE id < ? AND ts >= ? ORDER BY id DESC LIMIT ?;",
+            (int(before_id) if before_id is not None else 2**63 - 1, int(since_ts), int(limit))
+        )
+
+    def history_range(self, start_ts, end_ts, batch=5000):
+        # Lotes de (ts, hopper, grams, kcal, food_name) para analytics.py;
+        # cada lote es una lista, así el consumidor arma columnas por bloque.
+        # Sin ORDER BY: los agregados no dependen del orden y evita recorrer
+        # la tabla en el orden del índice
+        self._flush_pending()
+        with self._reader() as conn:
+            cur = conn.execute(
+                "SELECT ts, hopper_index, grams, calories, food_name FROM history "
+                "WHERE ts >= ? AND ts < ?;",
+                (int(start_ts), int(end_ts))
+            )
+            while True:
+                rows = cur.fetchmany(int(batch))
+                if not rows:
+                    return
+                yield rows
+
+    # ---------------- Bandeja de salida (outbox) ----------------
+    # Filas: (id, cmd_id, food_name, hopper, grams, kcal, device, created_ts,
+    # next_ts, attempts, state, last_error)
+    OUTBOX_COLUMNS = (
+        "id, cmd_id, food_name, hopper_index, grams, calories, device, "
+        "created_ts, next_ts, attempts, state, last_error"
+    )
+
+    def enqueue_commands(self, commands, ts):
+        # commands: [(cmd_id, food_name, tolva, gramos, kcal, device)] en una
+        # sola transacción. Un cmd_id ya registrado se ignora; devuelve cuántos
+        # comandos son nuevos
+        rows = [
+            (cmd_id, name, int(hopper), float(grams), float(kcal), device, int(ts), int(ts))
+            for cmd_id, name, hopper, grams, kcal, device in commands
+        ]
+        with self._lock:
+            before = self.conn.total_changes
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO outbox(cmd_id, food_name, hopper_index, grams, calories, "
+                    "device, created_ts, next_ts) VALUES(?,?,?,?,?,?,?,?)",
+                    rows
+                )
+            added = self.conn.total_changes - before
+        if added:
+            self._notify("outbox", "add")
+        return added
+
+    def enqueue_command(self, cmd_id, food_name, hopper_index, grams, calories, ts, device=None):
+        return self.enqueue_commands([(cmd_id, food_name, hopper_index, grams, calories, device)], ts) == 1
+
+    def claim_commands(self, now_ts, limit):
+        # Toma hasta `limit` comandos vencidos y los pasa a 'sending'; de ahí
+        # salen con complete/retry/fail/unconfirm_command. attempts cuenta
+        # los envíos
+        with self._lock:
+            cur = self.conn.cursor()
+            cur.execute(
+                f"SELECT {self.OUTBOX_COLUMNS} FROM outbox "
+                "WHERE state = 'pending' AND next_ts <= ? ORDER BY next_ts ASC, id ASC LIMIT ?;",
+                (int(now_ts), int(limit))
+            )
+            rows = cur.fetchall()
+            if not rows:
+                return []
+            with self.conn:
+                self.conn.executemany(
+                    "UPDATE outbox SET state = 'sending', attempts = attempts + 1 WHERE id = ?;",
+                    [(r[0],) for r in rows]
+                )
+        return [r[:9] + (r[9] + 1, "sending") + r[11:] for r in rows]
+
+    def recover_commands(self, error, ts, exclude=()):
+        # Comandos en 'sending' de una ejecución que terminó sin su respuesta
+        # (la app se cerró): pudieron llegar al dispensador, así que quedan
+        # sin confirmar en lugar de reenviarse. Devuelve cuántos
+        with self._lock:
+            rows = [r[0] for r in self.conn.execute("SELECT cmd_id FROM outbox WHERE state = 'sending';")]
+            rows = [(error, int(ts), c) for c in rows if c not in exclude]
+            with self.conn:
+                self.conn.executemany(
+                    "UPDATE outbox SET state = 'unconfirmed', last_error = ?, done_ts = ? "
+                    "WHERE cmd_id = ? AND state = 'sending';",
+                    rows
+                )
+        if rows:
+            self._notify("outbox", "unconfirmed")
+        return len(rows)
+
+    def next_command_ts(self):
+        # Próximo vencimiento entre los pendientes (None si no hay)
+        return self._query_one(
+            "SELECT MIN(next_ts) FROM outbox WHERE state = 'pending';"
+        )[0]
+
+    def complete_command(self, cmd_id, ts, from_state="sending"):
+        # Confirmado por el firmware: marca el comando y escribe el historial
+        # en la misma transacción. Solo la primera confirmación escribe, así
+        # que cada cmd_id aparece una vez en el historial. No pasa por el
+        # write-behind (_buf_history): un historial en memoria que se pierde
+        # con el comando ya 'done' rompería esa garantía. Un dispensado cuesta
+        # tres commits (encolar, 'sending', 'done' + historial)
+        with self._lock:
+            cur = self.conn.cursor()
+            cur.execute(
+                "UPDATE outbox SET state = 'done', done_ts = ?, last_error = NULL "
+                "WHERE cmd_id = ? AND state = ?;",
+                (int(ts), cmd_id, from_state)
+            )
+            if cur.rowcount != 1:
+                self.conn.commit()
+                return False
+            cur.execute(
+                "SELECT food_name, hopper_index, grams, calories, ?, device FROM outbox WHERE cmd_id = ?;",
+                (int(ts), cmd_id)
+            )
+            row = cur.fetchone()
+            cur.execute(
+                "INSERT INTO history(food_name, hopper_index, grams, calories, ts, device) VALUES(?,?,?,?,?,?)",
+                row
+            )
+            self._update_rollups(cur, [row])
+            self._update_levels(cur, [row])
+            self._update_profiles(cur, [row])
+            self.conn.commit()
+        self._notify("outbox", "done")
+        self._notify("history", "add", cur.lastrowid)
+        return True
+
+    def retry_command(self, cmd_id, next_ts, error):
+        with self._lock:
+            with self.conn:
+                self.conn.execute(
+                    "UPDATE outbox SET state = 'pending', next_ts = ?, last_error = ? "
+                    "WHERE cmd_id = ? AND state = 'sending';",
+                    (int(next_ts), error, cmd_id)
+                )
+
+    def fail_command(self, cmd_id, error, ts):
+        # Reintentos agotados: queda registrado y no vuelve a enviarse
+        with self._lock:
+            with self.conn:
+                self.conn.execute(
+                    "UPDATE outbox SET state = 'failed', last_error = ?, done_ts = ? "
+                    "WHERE cmd_id = ? AND state = 'sending';",
+                    (error, int(ts), cmd_id)
+                )
+        self._notify("outbox", "failed")
+
+    def unconfirm_command(self, cmd_id, error, ts):
+        # Escrito en el enlace sin confirmación: pudo haber dispensado, así
+        # que no se reintenta ni se escribe historial hasta que el usuario
+        # lo resuelva (resolve_command)
+        with self._lock:
+            with self.conn:
+                self.conn.execute(
+                    "UPDATE outbox SET state = 'unconfirmed', last_error = ?, done_ts = ? "
+                    "WHERE cmd_id = ? AND state = 'sending';",
+                    (error, int(ts), cmd_id)
+                )
+        self._notify("outbox", "unconfirmed")
+
+    def list_unconfirmed(self):
+        return self._query(
+            f"SELECT {self.OUTBOX_COLUMNS} FROM outbox WHERE state = 'unconfirmed' ORDER BY id ASC;"
+        )
+
+    def resolve_command(self, cmd_id, dispensed, ts):
+        # El usuario revisó la tolva: dispensed=True escribe el historial
+        # (como una confirmación), False lo deja como fallido
+        if dispensed:
+            return self.complete_command(cmd_id, ts, from_state="unconfirmed")
+        with self._lock:
+            with self.conn:
+                cur = self.conn.execute(
+                    "UPDATE outbox SET state = 'failed', done_ts = ? WHERE cmd_id = ? AND state = 'unconfirmed';",
+                    (int(ts), cmd_id)
+                )
+        self._notify("outbox", "failed")
+        return cur.rowcount == 1
+
+    def outbox_stats(self):
+        # {'pending': n, 'sending': n, 'done': n, 'failed': n, 'unconfirmed': n}
+        stats = {"pending": 0, "sending": 0, "done": 0, "failed": 0, "unconfirmed": 0}
+        stats.update(self._query("SELECT state, COUNT(*) FROM outbox GROUP BY state;"))
+        return stats
+
+    def prune_outbox(self, older_than_days=OUTBOX_KEEP_DAYS, now_ts=None):
+        now_ts = int(now_ts if now_ts is not None else datetime.now().timestamp())
+        cutoff = now_ts - int(older_than_days) * 86400
+        with self._lock:
+            with self.conn:
+                cur = self.conn.execute(
+                    "DELETE FROM outbox WHERE state IN ('done', 'failed') AND done_ts < ?;", (cutoff,)
+                )
+        return cur.rowcount
+
+    # ---------------- Perfiles y presupuesto diario ----------------
+    def _profiles(self):
+        # Como _food_cache: el SELECT fuera de _cache_lock
+        while True:
+            with self._cache_lock:
+                if self._profile_map is not None:
+                    return self._profile_map
+                gen = self._cache_gen
+            rows = self._query("SELECT id, name, hopper_index, food_name, daily_kcal FROM profiles;")
+            with self._cache_lock:
+                if self._cache_gen == gen:
+                    self._profile_map = {
+                        (hopper, food): (pid, kcal, name) for pid, name, hopper, food, kcal in rows
+                    }
+                    return self._profile_map
+
+    def _profile_for(self, hopper_index, food_name):
+        # El perfil del alimento concreto manda sobre el de toda la tolva
+        profiles = self._profiles()
+        return profiles.get((hopper_index, food_name)) or profiles.get((hopper_index, None))
+
+    def _update_profiles(self, cur, rows):
+        # Suma cada fila de historial al total del día de su perfil: un
+        # UPSERT por perfil y día, sin volver a leer el historial
+        totals = {}
+        for name, hopper, grams, kcal, ts, _ in rows:
+            profile = self._profile_for(hopper, name)
+            if profile is None:
+                continue
+            t = totals.setdefault((profile[0], self._day(ts)), [0.0, 0.0, 0])
+            t[0] += kcal
+            t[1] += grams
+            t[2] += 1
+        if totals:
+            cur.executemany(
+                "INSERT INTO profile_daily(profile_id, day, calories, grams, count) VALUES(?,?,?,?,?) "
+                "ON CONFLICT(profile_id, day) DO UPDATE SET calories = calories + excluded.calories, "
+                "grams = grams + excluded.grams, count = count + excluded.count;",
+                [(pid, day, kcal, grams, n) for (pid, day), (kcal, grams, n) in totals.items()]
+            )
+
+    def _rebuild_profile_day(self, cur, ts):
+        # Tras crear o cambiar perfiles se recalcula solo el día en curso;
+        # los días anteriores conservan lo que se contó entonces
+        day = self._day(ts)
+        start = int(datetime.strptime(day, "%Y-%m-%d").timestamp())
+        cur.execute("DELETE FROM profile_daily WHERE day = ?;", (day,))
+        cur.execute(
+            "SELECT food_name, hopper_index, grams, calories, ts, device FROM history WHERE ts >= ?;",
+            (start,)
+        )
+        self._update_profiles(cur, [r for r in cur.fetchall() if self._day(r[4]) == day])
+
+    def upsert_profile(self, name, hopper_index, daily_kcal, food_name=None, ts=None):
+        # Crea o actualiza (por nombre). food_name=None: todo lo de la tolva
+        self._flush_pending(history_only=True)
+        name = name.strip()
+        if not name or float(daily_kcal) <= 0:
+            raise ValueError("Perfil inválido")
+        ts = int(ts if ts is not None else datetime.now().timestamp())
+        with self._lock:
+            cur = self.conn.cursor()
+            try:
+                cur.execute(
+                    "INSERT INTO profiles(name, hopper_index, food_name, daily_kcal) VALUES(?,?,?,?) "
+                    "ON CONFLICT(name) DO UPDATE SET hopper_index = excluded.hopper_index, "
+                    "food_name = excluded.food_name, daily_kcal = excluded.daily_kcal;",
+                    (name, int(hopper_index), food_name or None, float(daily_kcal))
+                )
+            except sqlite3.IntegrityError:
+                self.conn.rollback()
+                raise ValueError("Ya hay un perfil para esa tolva y alimento") from None
+            # El mapa se relee con los lectores: primero se confirma el perfil
+            self.conn.commit()
+            with self._cache_lock:
+                self._profile_map = None
+                self._cache_gen += 1
+            self._rebuild_profile_day(cur, ts)
+            self.conn.commit()
+        self._notify("profiles", "upsert")
+
+    def delete_profile(self, name, ts=None):
+        # Lo que comía del perfil borrado puede pasar a otro (p. ej. al de
+        # toda la tolva): se recalcula el día en curso
+        self._flush_pending(history_only=True)
+        ts = int(ts if ts is not None else datetime.now().timestamp())
+        with self._lock:
+            cur = self.conn.cursor()
+            cur.execute("DELETE FROM profiles WHERE name = ?;", (name,))
+            deleted = cur.rowcount == 1
+            self.conn.commit()
+            if not deleted:
+                return False
+            with self._cache_lock:
+                self._profile_map = None
+                self._cache_gen += 1
+            self._rebuild_profile_day(cur, ts)
+            self.conn.commit()
+        self._notify("profiles", "delete")
+        return True
+
+    def list_profiles(self, ts=None):
+        # [(id, nombre, tolva, alimento o None, kcal diarias, kcal hoy)]
+        self._flush_pending(history_only=True)
+        day = self._day(ts if ts is not None else datetime.now().timestamp())
+        return self._query(
+            "SELECT p.id, p.name, p.hopper_index, p.food_name, p.daily_kcal, COALESCE(d.calories, 0) "
+            "FROM profiles p LEFT JOIN profile_daily d ON d.profile_id = p.id AND d.day = ? "
+            "ORDER BY p.hopper_index ASC, p.name ASC;",
+            (day,)
+        )
+
+    def profile_budget(self, hopper_index, food_name, ts):
+        # (profile_id, nombre, kcal diarias, kcal de hoy) del perfil que come
+        # de esa tolva y alimento, o None. Una lectura por clave primaria
+        profile = self._profile_for(int(hopper_index), food_name)
+        if profile is None:
+            return None
+        self._flush_pending(history_only=True)
+        row = self._query_one(
+            "SELECT calories FROM profile_daily WHERE profile_id = ? AND day = ?;",
+            (profile[0], self._day(ts))
+        )
+        return profile[0], profile[2], profile[1], row[0] if row else 0.0
+
+    def pending_kcal(self, hopper_index):
+        # {profile_id: kcal} de los comandos de la tolva aún en la bandeja de
+        # salida (cuentan contra el presupuesto antes de confirmarse). Los
+        # que quedaron sin confirmar pudieron dispensar: también cuentan
+        totals = {}
+        for food_name, kcal in self._query(
+            "SELECT food_name, SUM(calories) FROM outbox "
+            "WHERE state IN ('pending', 'sending', 'unconfirmed') AND hopper_index = ? GROUP BY food_name;",
+            (int(hopper_index),)
+        ):
+            profile = self._profile_for(int(hopper_index), food_name)
+            if profile is not None:
+                totals[profile[0]] = totals.get(profile[0], 0.0) + kcal
+        return totals
+
+    # ---------------- Inventario de tolvas ----------------
+    def _update_levels(self, cur, rows):
+        # Descuenta lo dispensado del nivel de cada tolva (sin bajar de 0)
+        used = {}
+        last = {}
+        for _, hopper, grams, _, ts, _ in rows:
+            used[hopper] = used.get(hopper, 0.0) + grams
+            last[hopper] = max(last.get(hopper, 0), ts)
+        cur.executemany(
+            "UPDATE hoppers SET level_g = MAX(0, level_g - ?), updated_ts = ? "
+            "WHERE hopper_index = ? AND capacity_g > 0;",
+            [(g, last[h], h) for h, g in used.items()]
+        )
+
+    def hopper_levels(self):
+        # [(tolva, nivel_g, capacidad_g, updated_ts)]
+        self._flush_pending(history_only=True)
+        return self._query(
+            "SELECT hopper_index, level_g, capacity_g, updated_ts FROM hoppers ORDER BY hopper_index ASC;"
+        )
+
+    def get_hopper(self, hopper_index):
+        self._flush_pending(history_only=True)
+        return self._query_one(
+            "SELECT hopper_index, level_g, capacity_g, updated_ts FROM hoppers WHERE hopper_index = ?;",
+            (int(hopper_index),)
+        )
+
+    def add_refill(self, hopper_index, grams, ts, capacity=None):
+        # Suma `grams` al nivel (tope: capacidad). capacity fija la capacidad
+        # de la tolva; sin ella se conserva la actual o, si no hay, se usa el
+        # nivel resultante
+        self._flush_pending()
+        hopper_index = int(hopper_index)
+        with self._lock:
+            cur = self.conn.cursor()
+            cur.execute(
+                "SELECT level_g, capacity_g FROM hoppers WHERE hopper_index = ?;", (hopper_index,)
+            )
+            row = cur.fetchone()
+            if row is None:
+                raise ValueError(f"Tolva desconocida: {hopper_index}")
+            level, current_capacity = row
+            if capacity is None:
+                capacity = current_capacity if current_capacity > 0 else level + float(grams)
+            level = min(level + float(grams), float(capacity))
+            cur.execute(
+                "UPDATE hoppers SET level_g = ?, capacity_g = ?, updated_ts = ? WHERE hopper_index = ?;",
+                (level, float(capacity), int(ts), hopper_index)
+            )
+            cur.execute(
+                "INSERT INTO refills(hopper_index, grams, level_g, ts) VALUES(?,?,?,?)",
+                (hopper_index, float(grams), level, int(ts))
+            )
+            self.conn.commit()
+        self._notify("hoppers", "refill", hopper_index)
+        return level
+
+    def list_refills(self, hopper_index, limit=20):
+        return self._query(
+            "SELECT id, grams, level_g, ts FROM refills WHERE hopper_index = ? ORDER BY id DESC LIMIT ?;",
+            (int(hopper_index), int(limit))
+        )
+
+    def grams_dispensed(self, hopper_index, since_ts):
+        # Consumo reciente de una tolva (usa idx_history_ts)
+        self._flush_pending(history_only=True)
+        return self._query_one(
+            "SELECT COALESCE(SUM(grams), 0), MIN(ts) FROM history WHERE ts >= ? AND hopper_index = ?;",
+            (int(since_ts), int(hopper_index))
+        )
+
+    # ---------------- Retención y acumulados ----------------
+    @staticmethod
+    def _day(ts):
+        return datetime.fromtimestamp(int(ts)).strftime("%Y-%m-%d")
+
+    def _update_rollups(self, cur, rows):
+        # rows: filas de historial (food_name, hopper, grams, kcal, ts, device),
+        # agregadas en memoria antes del UPSERT
+        totals = {}
+        for _, hopper, grams, kcal, ts, _ in rows:
+            key = (self._day(ts), hopper)
+            g, c, n = totals.get(key, (0.0, 0.0, 0))
+            totals[key] = (g + grams, c + kcal, n + 1)
+        cur.executemany(
+            "INSERT INTO history_daily(day, hopper_index, grams, calories, count) VALUES(?,?,?,?,?) "
+            "ON CONFLICT(day, hopper_index) DO UPDATE SET "
+            "grams = grams + excluded.grams, calories = calories + excluded.calories, "
+            "count = count + excluded.count;",
+            [(day, hopper, g, c, n) for (day, hopper), (g, c, n) in totals.items()]
+        )
+
+    def daily_totals(self, start_day, end_day, hopper_index=None):
+        # Días en formato YYYY-MM-DD (inclusive); no toca la tabla history
+        self._flush_pending()
+        if hopper_index is None:
+            return self._query(
+                "SELECT day, SUM(grams), SUM(calories), SUM(count) FROM history_daily "
+                "WHERE day BETWEEN ? AND ? GROUP BY day ORDER BY day ASC;",
+                (start_day, end_day)
+            )
+        return self._query(
+            "SELECT day, grams, calories, count FROM history_daily "
+            "WHERE day BETWEEN ? AND ? AND hopper_index = ? ORDER BY day ASC;",
+            (start_day, end_day, int(hopper_index))
+        )
+
+    def prune_history(self, older_than_days=RETENTION_DAYS, archive_dir=ARCHIVE_DIR, now_ts=None, batch=5000):
+        # Archiva (JSON Lines + gzip) y borra el historial crudo anterior al
+        # corte. Los acumulados de history_daily se conservan.
+        self._flush_pending()
+        now_ts = int(now_ts if now_ts is not None else datetime.now().timestamp())
+        cutoff = now_ts - int(older_than_days) * 24 * 3600
+        first_ts, total, last_id = self._query_one(
+            "SELECT MIN(ts), COUNT(*), MAX(id) FROM history WHERE ts < ?;", (cutoff,)
+        )
+        if not total:
+            return 0
+
+        if archive_dir:
+            os.makedirs(archive_dir, exist_ok=True)
+            name = f"history-{self._day(first_ts)}_{self._day(cutoff - 1)}-{now_ts}.jsonl.gz"
+            path = os.path.join(archive_dir, name)
+            cols = ("id", "food_name", "hopper_index", "grams", "calories", "ts", "device")
+            after = 0
+            with gzip.open(path + ".tmp", "wt", encoding="utf-8") as out:
+                while True:
+                    rows = self._query(
+                        "SELECT id, food_name, hopper_index, grams, calories, ts, device FROM history "
+                        "WHERE ts < ? AND id > ? AND id <= ? ORDER BY id ASC LIMIT ?;",
+                        (cutoff, after, last_id, batch)
+                    )
+                    if not rows:
+                        break
+                    for r in rows:
+                        out.write(json.dumps(dict(zip(cols, r)), ensure_ascii=False) + "\n")
+                    after = rows[-1][0]
+            # El archivo queda completo antes de borrar nada
+            os.replace(path + ".tmp", path)
+
+        # Solo se borra lo que se archivó (id <= last_id): una fila con ts
+        # antiguo insertada mientras tanto queda para la próxima pasada
+        with self._lock:
+            with self.conn:
+                total = self.conn.execute(
+                    "DELETE FROM history WHERE ts < ? AND id <= ?;", (cutoff, last_id)
+                ).rowcount
+        self._notify("history", "prune")
+        return total
+
+    def compact(self, full=False):
+        # Con auto_vacuum=INCREMENTAL basta con devolver las páginas libres.
+        # Una base anterior necesita un VACUUM completo para activarlo, que
+        # bloquea toda escritura mientras dura: solo con full=True (al
+        # arrancar el demonio), nunca desde maintenance() con la app abierta.
+        self.flush()
+        with self._lock:
+            mode = self.conn.execute("PRAGMA auto_vacuum;").fetchone()[0]
+            if mode == 2:
+                self.conn.execute("PRAGMA incremental_vacuum;")
+            elif full:
+                self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+                self.conn.execute("VACUUM;")
+            if self.readers:
+                self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+
+    def maintenance(self, older_than_days=RETENTION_DAYS, archive_dir=ARCHIVE_DIR):
+        pruned = self.prune_history(older_than_days, archive_dir)
+        self.prune_outbox()
+        if pruned:
+            self.compact()
+        return pruned
+
+    # ---------------- Lectura por lotes (exportación) ----------------
+    # Paginación por clave (id > último visto): memoria constante y sin
+    # OFFSET, que se vuelve lento con tablas grandes.
+    EXPORT_COLUMNS = {
+        "foods": ("id", "name", "grams_per_portion", "calories_per_portion"),
+        "schedules": ("id", "food_id", "hopper_index", "grams", "when_ts", "executed", "device"),
+        "history": ("id", "food_name", "hopper_index", "grams", "calories", "ts", "device"),
+        "recurrences": ("id", "food_id", "hopper_index", "grams", "rule", "start_ts", "end_ts",
+                        "device", "last_run_ts"),
+        "refills": ("id", "hopper_index", "grams", "level_g", "ts"),
+        "profiles": ("id", "name", "hopper_index", "food_name", "daily_kcal"),
+    }
+
+    def iter_table(self, table, batch=1000):
+        cols = self.EXPORT_COLUMNS[table]
+        self._flush_pending()
+        sql = f"SELECT {', '.join(cols)} FROM {table} WHERE id > ? ORDER BY id ASC LIMIT ?;"
+        last_id = 0
+        while True:
+            # Un lector por lote: la exportación no retiene una conexión del pool
+            rows = self._query(sql, (last_id, int(batch)))
+            if not rows:
+                return
+            yield from rows
+            last_id = rows[-1][0]
+
+    def iter_history(self, batch=1000):
+        return self.iter_table("history", batch)
+
+    def iter_schedules(self, batch=1000):
+        return self.iter_table("schedules", batch)
+
+    def iter_foods(self, batch=1000):
+        return self.iter_table("foods", batch)
+
+    def count_rows(self, table):
+        if table not in self.EXPORT_COLUMNS:
+            raise ValueError(f"Tabla desconocida: {table}")
+        self._flush_pending()
+        return self._query_one(f"SELECT COUNT(*) FROM {table};")[0]
+
+
+# Tiempos por método público (db.<método>); se omiten los triviales y los
+# iteradores, cuyo costo real ocurre fuera de la llamada
+metrics.instrument_class(DB, "db", exclude=(
+    "subscribe", "unsubscribe", "version", "cache_stats", "close",
+    "iter_history", "iter_schedules", "iter_foods", "history_range",
+))
@@ -0,0 +1,194 @@
+# Bandeja de salida de dispensados. Cada comando se guarda primero en la
+# tabla outbox (DB.enqueue_commands) y un drenador lo envía después: con
+# reintentos acotados y espera exponencial, un máximo de comandos en vuelo y
+# sin duplicados por cmd_id. El historial se escribe solo cuando el firmware
+# confirma (DB.complete_command), una vez por cmd_id.
+#
+# El firmware no conoce los cmd_id, así que solo se reintenta lo que no llegó
+# al dispensador (sin conexión, error de escritura o rechazo del firmware).
+# Un comando escrito sin confirmación (ok=None en bt.py) pudo haber
+# dispensado: queda 'unconfirmed', sin historial ni reintento, hasta que el
+# usuario diga si salió comida (DB.resolve_command).
+from time import time
+
+import metrics
+import protocol
+
+# Comandos enviados sin confirmar, como máximo
+MAX_INFLIGHT = 4
+# Envíos por comando antes de darlo por fallido
+MAX_ATTEMPTS = 8
+# Espera entre reintentos: BASE_DELAY * 2^(intento-1), hasta MAX_DELAY (s)
+BASE_DELAY = 1.0
+MAX_DELAY = 60.0
+# Despertar periódico máximo del drenador
+MAX_SLEEP = 60.0
+
+
+def backoff(attempts):
+    return min(MAX_DELAY, BASE_DELAY * 2 ** max(0, attempts - 1))
+
+
+class Outbox:
+    # post(fn, *args) ejecuta fn en el hilo dueño de la DB (como Dispatcher);
+    # timer: objeto con schedule_once(cb, delay) (kivy.clock.Clock por defecto)
+    # y clock() el reloj que usa (time.time salvo en simulate.py)
+    def __init__(self, db, bt, post, timer=None, on_error=print,
+                 max_inflight=MAX_INFLIGHT, max_attempts=MAX_ATTEMPTS, clock=time):
+        self.db = db
+        self.bt = bt
+        self.post = post
+        if timer is None:
+            from kivy.clock import Clock as timer
+        self.timer = timer
+        # clock() -> segundos epoch: marca next_ts y el ts del historial
+        self.clock = clock
+        self.on_error = on_error
+        self.max_inflight = max_inflight
+        self.max_attempts = max_attempts
+        self._event = None
+        self._kicked = False
+        self._running = False
+        # cmd_id -> fila en vuelo; callbacks(ok, msg) de quien encoló el comando
+        self._inflight = {}
+        self._callbacks = {}
+
+    def start(self):
+        # Lo que quedó pendiente de una ejecución anterior se drena al iniciar;
+        # lo que quedó a medio enviar pasa a sin confirmar
+        recovered = self.db.recover_commands(
+            "Interrumpido antes de la confirmación", int(self.clock()), exclude=self._inflight
+        )
+        if recovered:
+            self.on_error(f"{recovered} dispensados sin confirmar: revise las tolvas")
+        self._running = True
+        self.db.subscribe(self._on_db_change)
+        self.kick()
+
+    def stop(self):
+        self._running = False
+        self.db.unsubscribe(self._on_db_change)
+        if self._event is not None:
+            self._event.cancel()
+            self._event = None
+
+    # ---------------- Encolar ----------------
+    def submit(self, commands, callbacks=None):
+        # commands: [(cmd_id, food_name, tolva, gramos, kcal, device)];
+        # callbacks: {cmd_id: callback(ok, msg)} opcional. Devuelve cuántos
+        # son nuevos (un cmd_id repetido no se vuelve a enviar)
+        added = self.db.enqueue_commands(commands, int(self.clock()))
+        if callbacks:
+            self._callbacks.update(callbacks)
+        self.kick()
+        return added
+
+    def pending(self):
+        stats = self.db.outbox_stats()
+        return stats["pending"] + stats["sending"]
+
+    def in_flight(self):
+        return len(self._inflight)
+
+    def _on_db_change(self, table, op, row_id):
+        # Otro proceso pudo encolar comandos (p. ej. la app con el demonio
+        # como dueño de los envíos)
+        if table == "db":
+            self.kick()
+
+    # ---------------- Drenador ----------------
+    def kick(self):
+        # Drenar en la próxima vuelta del hilo de la DB; varias llamadas
+        # seguidas (una ráfaga de vencidos) se atienden con una sola pasada
+        if self._kicked or not self._running:
+            return
+        self._kicked = True
+        self.timer.schedule_once(self._drain, 0)
+
+    def _arm(self):
+        if self._event is not None:
+            self._event.cancel()
+            self._event = None
+        if not self._running:
+            return
+        next_ts = self.db.next_command_ts()
+        delay = MAX_SLEEP
+        if next_ts is not None:
+            # Piso de 1 s: los vencidos que esperan un hueco (max_inflight)
+            # no deben girar en vacío; una confirmación llama a kick()
+            delay = min(delay, max(1.0, next_ts - self.clock()))
+        self._event = self.timer.schedule_once(self._drain, delay)
+
+    @metrics.timed("outbox.drain")
+    def _drain(self, *args):
+        self._kicked = False
+        free = self.max_inflight - len(self._inflight)
+        if free > 0 and self._running:
+            rows = self.db.claim_commands(int(self.clock()), free)
+            for row in rows:
+                self._inflight[row[1]] = row
+            self._send(rows)
+        self._arm()
+
+    def _send(self, rows):
+        # Agrupa por dispensador; con varios comandos para el mismo se usan
+        # tramas DISPENSEB si el enlace las admite (bt.dispense_batch)
+        groups = {}
+        for row in rows:
+            groups.setdefault(row[6], []).append(row)
+        for device, group in groups.items():
+            try:
+                if len(group) > 1 and hasattr(self.bt, "dispense_batch"):
+                    futures = self.bt.dispense_batch([(r[3], r[4]) for r in group], device=device)
+                    for row, fut in zip(group, futures):
+                        fut.add_done_callback(
+                            lambda f, c=row[1]: self.post(self._on_result, c, *f.result())
+                        )
+                    continue
+                for row in group:
+                    self.bt.send_async(
+                        protocol.dispense_cmd(row[3], row[4]),
+                        callback=lambda ok, msg, c=row[1]: self.post(self._on_result, c, ok, msg),
+                        device=device,
+                    )
+            except Exception as e:
+                for row in group:
+                    self._on_result(row[1], False, f"Error enviando: {e}")
+
+    def _on_result(self, cmd_id, ok, msg):
+        row = self._inflight.pop(cmd_id, None)
+        if row is None:
+            return
+        now = self.clock()
+        if ok:
+            metrics.record("outbox.latency", now - row[7])
+            try:
+                self.db.complete_command(cmd_id, int(now))
+            except Exception as e:
+                self.on_error(f"Error registrando historial: {e}")
+            self._finish(cmd_id, ok, msg)
+        elif ok is None:
+            metrics.count("outbox.unconfirmed")
+            self.db.unconfirm_command(cmd_id, msg, int(now))
+            self.on_error(f"{msg}: revise la tolva {row[3]} y confirme si dispensó")
+            self._finish(cmd_id, None, msg)
+        else:
+            attempts = row[9]
+            if attempts >= self.max_attempts:
+                metrics.count("outbox.failed")
+                self.db.fail_command(cmd_id, msg, int(now))
+                self.on_error(f"Dispensado descartado tras {attempts} intentos: {msg}")
+                self._finish(cmd_id, False, msg)
+            else:
+                metrics.count("outbox.retry")
+                delay = backoff(attempts)
+                self.db.retry_command(cmd_id, now + delay, msg)
+                if attempts == 1 and cmd_id in self._callbacks:
+                    self.on_error(f"{msg} · se reintentará en {delay:.0f} s")
+        self.kick()
+
+    def _finish(self, cmd_id, ok, msg):
+        # ok=None: sin confirmar (ver DB.list_unconfirmed)
+        callback = self._callbacks.pop(cmd_id, None)
+        if callback is not None:
+            callback(ok, msg)
@@ -0,0 +1,114 @@
+# Proveedor paginado para los RecycleView: las filas se piden a la base por
+# paginación por clave (keyset) a medida que el usuario se desplaza, y solo se
+# formatean las páginas cargadas. Las páginas ya formateadas se guardan en un
+# LRU acotado, indexado por la clave desde la que empiezan.
+#
+# Las claves de la vista son ascendentes en el orden en que se muestran
+# (p. ej. (when_ts, id) o (-id, ts) para "más recientes primero"), así que las
+# actualizaciones puntuales se ubican con bisect.
+from bisect import bisect_left
+from collections import OrderedDict
+
+PAGE_SIZE = 50
+CACHE_PAGES = 16
+
+
+class KeysetPager:
+    def __init__(self, fetch, key_of, fmt, page_size=PAGE_SIZE, cache_pages=CACHE_PAGES):
+        # fetch(after_key, limit) -> filas ordenadas por clave, estrictamente
+        # después de after_key (None = desde el principio)
+        self.fetch = fetch
+        self.key_of = key_of
+        self.fmt = fmt
+        self.page_size = page_size
+        self.cache_pages = cache_pages
+        self.keys = []
+        self.exhausted = False
+        # cursor -> (claves, items, última clave o None si es la última página)
+        self._pages = OrderedDict()
+        self.page_hits = 0
+        self.page_misses = 0
+
+    def _page(self, cursor):
+        page = self._pages.get(cursor)
+        if page is not None:
+            self._pages.move_to_end(cursor)
+            self.page_hits += 1
+            return page
+        self.page_misses += 1
+        rows = self.fetch(cursor, self.page_size)
+        keys = [self.key_of(r) for r in rows]
+        items = [self.fmt(r) for r in rows]
+        last = keys[-1] if len(rows) >= self.page_size else None
+        page = (keys, items, last)
+        self._pages[cursor] = page
+        while len(self._pages) > self.cache_pages:
+            self._pages.popitem(last=False)
+        return page
+
+    def reset(self, data, offset=0):
+        # Vuelve a la primera página; data es el rv.data (las filas de la
+        # vista empiezan en `offset`)
+        del data[offset:]
+        self.keys = []
+        self.exhausted = False
+        return self.load_more(data)
+
+    def load_more(self, data):
+        if self.exhausted:
+            return 0
+        keys, items, last = self._page(self.keys[-1] if self.keys else None)
+        self.keys.extend(keys)
+        data.extend(items)
+        self.exhausted = last is None
+        return len(keys)
+
+    def shrink(self, data, offset=0, pages=1):
+        # Libera lo cargado más allá de las primeras `pages` páginas
+        n = self.page_size * pages
+        if len(self.keys) > n:
+            del self.keys[n:]
+            del data[offset + n:]
+            self.exhausted = False
+
+    def clear_cache(self):
+        self._pages.clear()
+
+    def invalidate(self, key):
+        # Descarta las páginas en caché cuyo rango (cursor, última] contiene key
+        for cursor in [
+            c for c, (_, _, last) in self._pages.items()
+            if (c is None or c < key) and (last is None or key <= last)
+        ]:
+            del self._pages[cursor]
+
+    def upsert(self, key, item, data, offset=0):
+        # item None = borrar. Fuera de lo cargado solo se invalida la caché:
+        # la fila aparecerá al desplazarse
+        self.invalidate(key)
+        pos = bisect_left(self.keys, key)
+        found = pos < len(self.keys) and self.keys[pos] == key
+        if item is None:
+            if found:
+                del self.keys[pos]
+                del data[offset + pos]
+        elif found:
+            data[offset + pos] = item
+        elif pos < len(self.keys) or self.exhausted:
+            self.keys.insert(pos, key)
+            data.insert(offset + pos, item)
+
+    def prepend(self, rows, data, offset=0):
+        # Filas nuevas que van antes de todo lo cargado (p. ej. historial nuevo)
+        keys = [self.key_of(r) for r in rows]
+        for key in keys:
+            self.invalidate(key)
+        self.keys[0:0] = keys
+        data[offset:offset] = [self.fmt(r) for r in rows]
+
+    def truncate(self, n, data, offset=0):
+        # Deja solo las primeras n filas (p. ej. las que salieron de la ventana)
+        if n < len(self.keys):
+            del self.keys[n:]
+            del data[offset + n:]
+            self.exhausted = True
@@ -0,0 +1,39 @@
+# Presupuesto diario de kcal por perfil (DB.upsert_profile). Los totales del
+# día viven en profile_daily y se actualizan con cada fila de historial, así
+# que check() cuesta lo mismo con mil filas de historial que con un millón.
+# Dispatcher llama a check() antes de encolar cada dispensado.
+from time import time
+
+import metrics
+
+
+class Budget:
+    def __init__(self, db, clock=time):
+        self.db = db
+        # clock() -> segundos epoch (simulate.py inyecta un reloj virtual)
+        self.clock = clock
+        self.blocked = 0
+
+    def check(self, hopper_index, food_name, kcal, reserved=None):
+        # Mensaje si el dispensado excede el presupuesto del perfil, o None.
+        # Cuenta lo confirmado hoy y lo que sigue en la bandeja de salida.
+        # reserved: {profile_id: kcal} ya aceptadas en el mismo lote; se
+        # actualiza con este dispensado si cabe
+        budget = self.db.profile_budget(hopper_index, food_name, self.clock())
+        if budget is None:
+            return None
+        profile_id, name, daily_kcal, eaten = budget
+        pending = self.db.pending_kcal(hopper_index).get(profile_id, 0.0)
+        if reserved is not None:
+            pending += reserved.get(profile_id, 0.0)
+        if eaten + pending + kcal > daily_kcal + 1e-6:
+            self.blocked += 1
+            metrics.count("budget.blocked")
+            left = max(0.0, daily_kcal - eaten - pending)
+            return (
+                f"{name}: presupuesto diario agotado "
+                f"({eaten + pending:.0f} / {daily_kcal:.0f} kcal, quedan {left:.0f}, se piden {kcal:.0f})"
+            )
+        if reserved is not None:
+            reserved[profile_id] = reserved.get(profile_id, 0.0) + kcal
+        return None
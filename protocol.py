@@ -0,0 +1,59 @@
+# Protocolo serie con el firmware (líneas de texto terminadas en \n).
+#
+#   DISPENSE:<tolva>:<gramos>            comando clásico, un dispensado
+#   PING                                 prueba de enlace
+#   CAPS                                 negociación; el firmware nuevo responde OK:<cap>[,<cap>...]
+#   DISPENSEB:<t>:<g>,<t>:<g>...*<cs>    lote de dispensados (requiere la capacidad BATCH)
+#
+# <cs> es el XOR de los bytes entre "DISPENSEB:" y "*", en dos dígitos hex
+# (estilo NMEA). El firmware confirma el lote completo con un único OK.
+# El firmware antiguo ignora CAPS o responde con error: se usa DISPENSE.
+
+PING = "PING"
+CAPS = "CAPS"
+CAP_BATCH = "BATCH"
+BATCH_PREFIX = "DISPENSEB:"
+# Tamaño máximo de un lote (limita la línea a ~100 bytes para el buffer del HC-05)
+MAX_BATCH = 8
+
+
+def dispense_cmd(hopper, grams):
+    return f"DISPENSE:{int(hopper)}:{int(round(grams))}"
+
+
+def checksum(payload):
+    cs = 0
+    for b in payload.encode("ascii"):
+        cs ^= b
+    return f"{cs:02X}"
+
+
+def batch_cmd(pairs):
+    payload = ",".join(f"{int(h)}:{int(round(g))}" for h, g in pairs)
+    return f"{BATCH_PREFIX}{payload}*{checksum(payload)}"
+
+
+def parse_batch(line):
+    # Inverso de batch_cmd (lo usan el simulador y las pruebas de escritorio)
+    if not line.startswith(BATCH_PREFIX) or "*" not in line:
+        return None
+    payload, cs = line[len(BATCH_PREFIX):].rsplit("*", 1)
+    if checksum(payload) != cs.upper():
+        return None
+    pairs = []
+    for item in payload.split(","):
+        h, g = item.split(":")
+        pairs.append((int(h), int(g)))
+    return pairs
+
+
+def parse_caps(msg):
+    # "OK:BATCH,FOO" -> {"BATCH", "FOO"}; cualquier otra respuesta -> vacío
+    if not msg or not msg.startswith("OK:"):
+        return set()
+    return {c.strip() for c in msg[3:].split(",") if c.strip()}
+
+
+def chunks(items, size=MAX_BATCH):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
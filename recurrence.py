@@ -0,0 +1,149 @@
+# Reglas de repetición para programaciones recurrentes.
+# Se guardan como texto en recurrences.rule y el scheduler calcula la
+# siguiente ocurrencia bajo demanda (nunca se generan filas por ocurrencia).
+#
+# Formatos aceptados:
+#   "08:00,13:30"              todos los días a esas horas
+#   "diario 08:00"             igual que arriba
+#   "lun,mie,vie 07:15"        días de la semana concretos
+#   "*/30 6-20 * * 1-5"        expresión cron de 5 campos (min hora día mes día_semana)
+from datetime import datetime, timedelta
+
+WEEKDAYS = {"lun": 0, "mar": 1, "mie": 2, "mié": 2, "jue": 3, "vie": 4, "sab": 5, "sáb": 5, "dom": 6}
+# Horizonte de búsqueda: una regla sin ocurrencias en 5 años se considera agotada
+MAX_DAYS = 366 * 5
+
+
+class TimesRule:
+    def __init__(self, times, weekdays=None):
+        # times: [(hora, minuto)]; weekdays: conjunto 0=lunes..6=domingo o None
+        self.times = sorted(set(times))
+        self.weekdays = set(weekdays) if weekdays else None
+
+    def _day_matches(self, d):
+        return self.weekdays is None or d.weekday() in self.weekdays
+
+
+class CronRule:
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+
+    def __init__(self, expr):
+        parts = expr.split()
+        if len(parts) != 5:
+            raise ValueError("La expresión cron necesita 5 campos")
+        sets = []
+        for text, (lo, hi) in zip(parts, self.FIELDS):
+            # En cron el domingo puede ser 0 o 7
+            sets.append(_parse_cron_field(text, lo, 7 if hi == 6 else hi))
+        self.minutes, self.hours, self.dom, self.months, dow = sets
+        self.dow = {d % 7 for d in dow}
+        self.dom_any = parts[2] == "*"
+        self.dow_any = parts[4] == "*"
+        self.times = sorted((h, m) for h in self.hours for m in self.minutes)
+
+    def _day_matches(self, d):
+        if d.month not in self.months:
+            return False
+        # Semántica cron: si se restringen día del mes y de la semana, basta uno
+        cron_dow = (d.weekday() + 1) % 7
+        dom_ok = d.day in self.dom
+        dow_ok = cron_dow in self.dow
+        if self.dom_any and self.dow_any:
+            return True
+        if self.dom_any:
+            return dow_ok
+        if self.dow_any:
+            return dom_ok
+        return dom_ok or dow_ok
+
+
+def _parse_cron_field(text, lo, hi):
+    values = set()
+    for part in text.split(","):
+        step = 1
+        if "/" in part:
+            part, step_text = part.split("/", 1)
+            step = int(step_text)
+            if step <= 0:
+                raise ValueError(f"Paso inválido en cron: {text}")
+        if part == "*":
+            start, end = lo, hi
+        elif "-" in part:
+            a, b = part.split("-", 1)
+            start, end = int(a), int(b)
+        else:
+            start = int(part)
+            end = hi if step != 1 else start
+        if start < lo or end > hi or start > end:
+            raise ValueError(f"Valor fuera de rango en cron: {text}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+def _parse_times(text):
+    times = []
+    for item in text.split(","):
+        h, m = item.strip().split(":")
+        h, m = int(h), int(m)
+        if not (0 <= h <= 23 and 0 <= m <= 59):
+            raise ValueError(f"Hora inválida: {item}")
+        times.append((h, m))
+    return times
+
+
+def parse_rule(text, default_time=None):
+    text = (text or "").strip().lower()
+    if not text:
+        raise ValueError("Regla de repetición vacía")
+    if len(text.split()) == 5:
+        return CronRule(text)
+
+    parts = text.split()
+    days_text, times_text = None, None
+    for part in parts:
+        if ":" in part:
+            times_text = part
+        else:
+            days_text = part
+    if times_text is None:
+        if default_time is None:
+            raise ValueError("Indique la hora (HH:MM)")
+        times_text = default_time
+
+    weekdays = None
+    if days_text and days_text not in ("diario", "todos"):
+        weekdays = set()
+        for name in days_text.split(","):
+            if name not in WEEKDAYS:
+                raise ValueError(f"Día desconocido: {name}")
+            weekdays.add(WEEKDAYS[name])
+    return TimesRule(_parse_times(times_text), weekdays)
+
+
+def next_occurrence(rule, after_ts, end_ts=None):
+    # Primera ocurrencia estrictamente posterior a after_ts (hora local), o None
+    if isinstance(rule, str):
+        rule = parse_rule(rule)
+    start = datetime.fromtimestamp(int(after_ts))
+    day = start.replace(hour=0, minute=0, second=0, microsecond=0)
+    for _ in range(MAX_DAYS):
+        if rule._day_matches(day):
+            for h, m in rule.times:
+                ts = int(day.replace(hour=h, minute=m).timestamp())
+                if ts > after_ts:
+                    if end_ts is not None and ts > end_ts:
+                        return None
+                    return ts
+        day = day + timedelta(days=1)
+        if end_ts is not None and day.timestamp() > end_ts:
+            return None
+    return None
+
+
+def canonical(text, default_time):
+    # Valida la regla y le agrega la hora por defecto si no la trae ("lun,vie" -> "lun,vie 08:00")
+    text = (text or "").strip().lower()
+    rule = parse_rule(text, default_time)
+    if isinstance(rule, CronRule) or ":" in text:
+        return text
+    return f"{text} {default_time}"
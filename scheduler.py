@@ -1,29 +1,244 @@
-from kivy.clock import Clock
 from time import time
+import heapq
+
+import metrics
+from recurrence import next_occurrence
+
+# Ventana (s) durante la cual una programación vencida todavía se envía
+WINDOW = 30
+# Reintento dentro de la ventana si el envío no se pudo encolar
+RETRY_DELAY = 1.0
+# Despertar periódico máximo (protege contra cambios de hora del sistema)
+MAX_SLEEP = 60.0
+# Resultado de sender/batch_sender para una ocurrencia atendida sin
+# dispensar (p. ej. presupuesto agotado): no se reintenta y queda omitida
+SKIP = "omitido"
+
+# Revisión de escrituras de otro proceso (DB.check_external): la app y el
+# demonio comparten app.db. Menor que WINDOW para no perder lo que el otro
+# proceso programe para dentro de unos segundos
+SYNC_INTERVAL = 5.0
+
 
 class SchedulerEngine:
-    def __init__(self, db, sender_callable):
+    def __init__(self, db, sender_callable, batch_sender=None, timer=None,
+                 inventory=None, on_warning=print, clock=time, sync_interval=SYNC_INTERVAL):
         self.db = db
+        # sync_interval=None: ningún otro proceso escribe en la DB (simulate.py)
+        self.sync_interval = sync_interval
+        # clock() -> segundos epoch; simulate.py inyecta un reloj virtual
+        # (que también hace de timer) para recorrer días en segundos
+        self.clock = clock
         self.sender = sender_callable
+        # inventory: objeto con check(tolva, gramos) -> aviso o None
+        # (inventory.Inventory); el aviso no detiene el envío
+        self.inventory = inventory
+        self.on_warning = on_warning
+        # timer: objeto con schedule_once(cb, delay) -> evento con cancel(),
+        # seguro entre hilos. Por defecto kivy.clock.Clock; daemon.py usa asyncio.
+        if timer is None:
+            from kivy.clock import Clock as timer
+        self.timer = timer
+        # sender(food_id, food_name, tolva, gramos, device, cmd_id) -> bool,
+        # SKIP o Future; batch_sender(items) -> un resultado por item, con
+        # todo lo que vence en el mismo tick
+        self.batch_sender = batch_sender
         self._event = None
+        self._running = False
+        self._reload_queued = False
+        # Min-heap de (when_ts, key) + filas pendientes por key, donde key es
+        # ("s", id) para programaciones únicas y ("r", id) para recurrentes.
+        # Las entradas del heap cuya key ya no está en _pending (o cuyo
+        # when_ts cambió) se descartan al salir.
+        self._heap = []
+        self._pending = {}
+        # Envíos fallidos que se reintentan dentro de su ventana
+        self._retry = []
+        # Programaciones enviadas cuya confirmación aún no llega
+        self._inflight = set()
+        # Ticks ejecutados y ocurrencias que vencieron fuera de su ventana
+        self.ticks = 0
+        self.missed = 0
 
     def start(self):
-        if self._event is None:
-            self._event = Clock.schedule_interval(self._tick, 1.0)
+        if self._running:
+            return
+        self._running = True
+        self.db.subscribe(self._on_db_change)
+        self._reload()
+        self._arm()
 
     def stop(self):
+        self._running = False
+        self.db.unsubscribe(self._on_db_change)
+        self._cancel()
+
+    # ---------------- Cola de pendientes ----------------
+    def _reload(self):
+        now = int(self.clock())
+        self._heap = []
+        self._pending = {}
+        self._retry = []
+        for row in self.db.list_pending_schedules(now - WINDOW):
+            self._push(("s", row[0]), row)
+        for rec in self.db.list_recurrences():
+            self._push_recurrence(rec, now)
+
+    def _push(self, key, row):
+        # row: (id, food_name, hopper, grams, when_ts, executed, food_id, device)
+        self._pending[key] = row
+        heapq.heappush(self._heap, (row[4], key))
+
+    def _push_recurrence(self, rec, now, after_ts=None):
+        # Solo se encola la próxima ocurrencia; la siguiente se calcula al ejecutarla
+        rec_id, food_name, hopper, grams, rule, start_ts, end_ts, last_run_ts, food_id, device = rec
+        key = ("r", rec_id)
+        if after_ts is None:
+            after_ts = max(start_ts - 1, now - WINDOW - 1)
+            if last_run_ts is not None:
+                after_ts = max(after_ts, last_run_ts)
+        try:
+            when_ts = next_occurrence(rule, after_ts, end_ts)
+        except ValueError:
+            when_ts = None
+        if when_ts is None:
+            self._pending.pop(key, None)
+            return
+        self._push(key, (rec_id, food_name, hopper, grams, when_ts, 0, food_id, device))
+
+    def _on_db_change(self, table, op, row_id):
+        if not self._running:
+            return
+        if table == "schedules" and op == "add":
+            row = self.db.get_schedule(row_id)
+            if row is not None and not row[5] and row[4] >= int(self.clock()) - WINDOW:
+                self._push(("s", row[0]), row)
+                self._arm()
+        elif table == "schedules" and op == "executed":
+            self._pending.pop(("s", row_id), None)
+        elif table == "recurrences" and op in ("add", "delete"):
+            self._pending.pop(("r", row_id), None)
+            rec = self.db.get_recurrence(row_id) if op == "add" else None
+            if rec is not None:
+                self._push_recurrence(rec, int(self.clock()))
+            self._arm()
+        elif table in ("foods", "db"):
+            # Un REPLACE puede haber borrado programaciones en cascada; "db":
+            # otro proceso cambió la base y no se sabe qué filas. El aviso
+            # puede venir de otro hilo (DB.import_foods): la cola se rehace
+            # en el hilo del timer, como _tick
+            if not self._reload_queued:
+                self._reload_queued = True
+                self.timer.schedule_once(self._reload_later, 0)
+
+    def _reload_later(self, *args):
+        # _tick pudo haber recargado ya (cambio de otro proceso)
+        if not self._reload_queued:
+            return
+        self._reload_queued = False
+        if self._running:
+            self._reload()
+            self._arm()
+
+    # ---------------- Temporizador ----------------
+    def _cancel(self):
         if self._event is not None:
             self._event.cancel()
             self._event = None
 
+    def _arm(self):
+        self._cancel()
+        if not self._running:
+            return
+        delay = MAX_SLEEP
+        if self.sync_interval:
+            delay = min(delay, self.sync_interval)
+        if self._heap:
+            delay = min(delay, max(0.0, self._heap[0][0] - self.clock()))
+        if self._retry:
+            delay = min(delay, RETRY_DELAY)
+        self._event = self.timer.schedule_once(self._tick, delay)
+
+    def _due(self, now):
+        due, self._retry = self._retry, []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap))
+        return due
+
+    @metrics.timed("scheduler.tick")
     def _tick(self, *args):
-        now = int(time())
-        items = self.db.list_schedules()
-        for row in items:
-            sched_id, food_name, hopper_idx, grams, when_ts, executed, food_id = row
-            if executed:
+        self._event = None
+        self.ticks += 1
+        if self.sync_interval and self.db.check_external():
+            # Otro proceso escribió: la cola se rehace aquí, antes de buscar
+            # vencidos, en lugar de esperar a _reload_later
+            self._reload_queued = False
+            self._reload()
+        now = int(self.clock())
+        due = []
+        for when_ts, key in self._due(now):
+            row = self._pending.get(key)
+            if row is None or row[4] != when_ts or key in self._inflight:
                 continue
-            if when_ts <= now <= when_ts + 30:
-                ok = self.sender(food_id, food_name, hopper_idx, grams)
-                if ok:
-                    self.db.mark_executed(sched_id)
+            if now > when_ts + WINDOW:
+                # Ventana perdida: se deja sin ejecutar, igual que antes
+                self.missed += 1
+                metrics.count("scheduler.missed")
+                self._advance(key, when_ts)
+                continue
+            _, food_name, hopper_idx, grams, _, _, food_id, device = row
+            self._check_inventory(hopper_idx, grams)
+            # cmd_id: identifica la ocurrencia para que la bandeja de salida
+            # (outbox.py) no la repita si se dispara dos veces
+            cmd_id = f"{key[0]}{key[1]}@{when_ts}"
+            due.append((key, when_ts, (food_id, food_name, hopper_idx, grams, device, cmd_id)))
+
+        if self.batch_sender is not None and len(due) > 1:
+            results = self.batch_sender([args for _, _, args in due])
+        else:
+            results = [self.sender(*args) for _, _, args in due]
+
+        for (key, when_ts, _), result in zip(due, results):
+            if hasattr(result, "add_done_callback"):
+                # Envío asíncrono: se resuelve cuando el firmware confirma
+                self._inflight.add(key)
+                result.add_done_callback(
+                    lambda f, k=key, w=when_ts: self.timer.schedule_once(
+                        lambda *_: self._on_sent(k, w, f.result()[0]), 0
+                    )
+                )
+            else:
+                self._on_sent(key, when_ts, result, rearm=False)
+        self._arm()
+
+    def _check_inventory(self, hopper_idx, grams):
+        if self.inventory is None:
+            return
+        try:
+            msg = self.inventory.check(hopper_idx, grams)
+        except Exception as e:
+            print("Error revisando inventario:", e)
+            return
+        if msg:
+            self.on_warning(msg)
+
+    def _advance(self, key, when_ts):
+        # Una única se retira; una recurrente pasa a su siguiente ocurrencia
+        row = self._pending.pop(key, None)
+        if key[0] == "r" and row is not None:
+            rec = self.db.get_recurrence(key[1])
+            if rec is not None:
+                self._push_recurrence(rec, int(self.clock()), after_ts=when_ts)
+
+    def _on_sent(self, key, when_ts, ok, rearm=True):
+        self._inflight.discard(key)
+        if ok:
+            if key[0] == "s":
+                self.db.mark_executed(key[1], skipped=ok == SKIP)
+            else:
+                self.db.mark_recurrence_run(key[1], when_ts)
+            self._advance(key, when_ts)
+        elif key in self._pending:
+            self._retry.append((when_ts, key))
+        if rearm:
+            self._arm()
@@ -0,0 +1,347 @@
+# Simulación de extremo a extremo con reloj virtual. Scheduler, bandeja de
+# salida (outbox.py) e historial usan VirtualClock en lugar de time.time y
+# Kivy Clock: el tiempo salta de un evento al siguiente, así que semanas de
+# programaciones se recorren en segundos contra un transporte simulado.
+#
+#   python simulate.py --schedules 100000 --days 30 --db :memory:
+#   python simulate.py --days 7 --recurrences 50 --fail-rate 0.05 --downtime 30
+#   python simulate.py --days 1 --schedules 2000 --transport sim
+#
+# Transportes: "instant" confirma en el acto sin hilos (el más rápido),
+# "mock" usa MockBluetooth y "sim" firmware_sim.py por TCP. Con los dos
+# últimos el reloj virtual se detiene mientras hay comandos en vuelo.
+import argparse
+import heapq
+import itertools
+import json
+import os
+import queue
+import random
+import shutil
+import sqlite3
+import tempfile
+from time import perf_counter, time
+
+import metrics
+import protocol
+from bt import _done
+from dispatch import Dispatcher
+from inventory import Inventory
+from models import DB, HOPPERS
+from profiles import Budget
+from scheduler import SchedulerEngine, WINDOW
+
+DAY = 86400
+
+
+class _Event:
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class VirtualClock:
+    # Reloj y timer a la vez: clock() da la hora virtual y schedule_once()
+    # (la interfaz de kivy.clock.Clock) encola callbacks que run() ejecuta en
+    # orden, adelantando la hora hasta cada uno. post() es seguro entre hilos.
+    def __init__(self, start):
+        self.now = float(start)
+        self.events = 0
+        self._heap = []
+        self._seq = itertools.count()
+        self._posted = queue.Queue()
+
+    def __call__(self):
+        return self.now
+
+    def schedule_once(self, callback, timeout=0):
+        event = _Event()
+        heapq.heappush(self._heap, (self.now + max(0.0, timeout), next(self._seq), callback, event))
+        return event
+
+    def post(self, fn, *args):
+        self._posted.put((fn, args))
+
+    def _run_posted(self):
+        while True:
+            try:
+                fn, args = self._posted.get_nowait()
+            except queue.Empty:
+                return
+            fn(*args)
+
+    def run(self, until, busy=lambda: False, wait=5.0):
+        # busy() -> True mientras haya respuestas reales en camino: se esperan
+        # antes de adelantar la hora
+        while True:
+            self._run_posted()
+            if busy():
+                try:
+                    fn, args = self._posted.get(timeout=wait)
+                except queue.Empty:
+                    raise RuntimeError("El transporte no respondió") from None
+                fn(*args)
+                continue
+            while self._heap and self._heap[0][3].cancelled:
+                heapq.heappop(self._heap)
+            if not self._heap or self._heap[0][0] > until:
+                break
+            when, _, callback, event = heapq.heappop(self._heap)
+            self.now = max(self.now, when)
+            self.events += 1
+            callback(0)
+        self.now = max(self.now, until)
+
+
+class InstantLink:
+    # Transporte sin hilos con la interfaz de fleet.Fleet: cada comando se
+    # confirma en el acto, salvo una fracción fail_rate cuya confirmación se
+    # pierde: dispensa igual y queda sin confirmar (como drop_rate en
+    # firmware_sim.py). dispensed cuenta lo que salió físicamente.
+    current = None
+
+    def __init__(self, fail_rate=0.0, batch=True, seed=1):
+        self.fail_rate = fail_rate
+        self.batch = batch
+        self.rng = random.Random(seed)
+        self.down = False
+        self.frames = 0
+        self.dispensed = 0
+
+    def is_connected(self, device=None):
+        return not self.down
+
+    def devices(self):
+        return [] if self.down else ["SIM"]
+
+    def _reply(self, n, callback=None):
+        self.frames += 1
+        if self.down:
+            return _done(False, "No conectado", callback)
+        self.dispensed += n
+        if self.rng.random() < self.fail_rate:
+            return _done(None, "Sin confirmación del dispensador", callback)
+        return _done(True, "Confirmado", callback)
+
+    def send_async(self, text, callback=None, device=None):
+        return self._reply(1, callback)
+
+    def dispense_batch(self, pairs, callback=None, device=None):
+        pairs = list(pairs)
+        if not self.batch or len(pairs) < 2:
+            return [self._reply(1) for _ in pairs]
+        futures = []
+        for chunk in protocol.chunks(pairs):
+            fut = self._reply(len(chunk))
+            futures.extend(fut for _ in chunk)
+        return futures
+
+
+def _transport(kind, fail_rate, seed):
+    if kind == "instant":
+        return InstantLink(fail_rate, seed=seed), None
+    from fleet import Fleet
+
+    if kind == "mock":
+        from bt import MockBluetooth
+
+        fleet = Fleet(factory=MockBluetooth)
+        fleet.connect("HC-05-MOCK")
+        return fleet, None
+    from bt import SocketBluetooth
+    from firmware_sim import FirmwareSimulator
+
+    sim = FirmwareSimulator(drop_rate=fail_rate, seed=seed)
+    address = sim.start()
+    fleet = Fleet(factory=lambda: SocketBluetooth(address))
+    ok, msg = fleet.connect(address)
+    if not ok:
+        sim.stop()
+        raise SystemExit(msg)
+    fleet.get().wait_caps(3)
+    return fleet, sim
+
+
+def populate(db, start, days, schedules, recurrences, foods=50, seed=1):
+    # Programaciones únicas repartidas al azar en [start, start + days) y
+    # reglas recurrentes de 1 a 4 horarios diarios
+    rng = random.Random(seed)
+    conn = db.conn
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO foods(name, grams_per_portion, calories_per_portion) VALUES(?,?,?)",
+            ((f"Sim {i:04d}", 100.0, float(rng.randint(50, 500))) for i in range(foods))
+        )
+    food_ids = [r[0] for r in conn.execute("SELECT id FROM foods;")]
+    span = int(days * DAY)
+    with conn:
+        conn.executemany(
+            "INSERT INTO schedules(food_id, hopper_index, grams, when_ts) VALUES(?,?,?,?)",
+            ((rng.choice(food_ids), rng.randint(1, 3), float(rng.randint(10, 80)), start + rng.randrange(span))
+             for _ in range(schedules))
+        )
+        conn.executemany(
+            "INSERT INTO recurrences(food_id, hopper_index, grams, rule, start_ts) VALUES(?,?,?,?,?)",
+            ((rng.choice(food_ids), rng.randint(1, 3), 30.0,
+              ",".join(f"{h:02d}:{rng.randrange(60):02d}" for h in sorted(rng.sample(range(6, 22), rng.randint(1, 4)))),
+              start) for _ in range(recurrences))
+        )
+    # Las filas se insertaron sin pasar por la caché de alimentos
+    db._foods_by_id = None
+
+
+def _db_bytes(db):
+    # Tamaño lógico (páginas en uso); vale también para :memory:
+    pages = db._query_one("PRAGMA page_count;")[0] - db._query_one("PRAGMA freelist_count;")[0]
+    return pages * db._query_one("PRAGMA page_size;")[0]
+
+
+def run(days=7.0, schedules=10000, recurrences=0, transport="instant", fail_rate=0.0,
+        downtime=0.0, write_behind=True, seed=1, path=None, budget_kcal=0.0):
+    workdir = None
+    if path is None:
+        workdir = tempfile.mkdtemp(prefix="simulate_")
+        path = os.path.join(workdir, "sim.db")
+    start = int(time()) // DAY * DAY + DAY
+    end = start + int(days * DAY)
+    sim = None
+    try:
+        db = DB(path, write_behind=write_behind)
+        t0 = perf_counter()
+        populate(db, start, days, schedules, recurrences, seed=seed)
+        if budget_kcal > 0:
+            # Un perfil por tolva con el mismo presupuesto diario
+            for h in range(1, HOPPERS + 1):
+                db.upsert_profile(f"Tolva {h}", h, budget_kcal, ts=start)
+        fill_s = perf_counter() - t0
+        db.flush()
+        bytes_before = _db_bytes(db)
+        rows_before = {t: db.count_rows(t) for t in ("history", "schedules")}
+
+        clock = VirtualClock(start - WINDOW)
+        link, sim = _transport(transport, fail_rate, seed)
+        budget = Budget(db, clock=clock)
+        dispatcher = Dispatcher(db, link, clock.post, on_error=lambda msg: None,
+                                timer=clock, clock=clock, budget=budget)
+        engine = SchedulerEngine(
+            db, dispatcher.send_schedule, dispatcher.send_schedule_batch, timer=clock,
+            inventory=Inventory(db, clock=clock), on_warning=lambda msg: None, clock=clock,
+            sync_interval=None,
+        )
+
+        # Downtime: la app pasa `downtime` minutos cerrada cada día, tres horas
+        # después del inicio de cada día simulado; lo que vence mientras tanto
+        # se pierde como en la app real (never_sent)
+        def _close(*_):
+            engine.stop()
+            dispatcher.stop()
+            if isinstance(link, InstantLink):
+                link.down = True
+            clock.schedule_once(_open, downtime * 60)
+
+        def _open(*_):
+            if isinstance(link, InstantLink):
+                link.down = False
+            dispatcher.start()
+            engine.start()
+            clock.schedule_once(_close, DAY - downtime * 60)
+
+        if downtime > 0:
+            clock.schedule_once(_close, WINDOW + 3 * 3600)
+
+        t0 = perf_counter()
+        dispatcher.start()
+        engine.start()
+        clock.run(end, busy=lambda: dispatcher.outbox.in_flight() > 0)
+        # Vacía lo que siga en la bandeja (reintentos) más allá del final
+        clock.run(end + 3600, busy=lambda: dispatcher.outbox.in_flight() > 0)
+        wall_s = perf_counter() - t0
+        engine.stop()
+        dispatcher.stop()
+        db.flush()
+
+        lost = db._query_one(
+            "SELECT COUNT(*) FROM schedules WHERE executed = 0 AND when_ts < ?;", (end - WINDOW,)
+        )[0]
+        rows_after = {t: db.count_rows(t) for t in ("history", "schedules")}
+        outbox = db.outbox_stats()
+        bytes_after = _db_bytes(db)
+        db.close()
+        dispensed = rows_after["history"] - rows_before["history"]
+        result = {
+            "meta": {
+                "days": days, "schedules": schedules, "recurrences": recurrences,
+                "transport": transport, "fail_rate": fail_rate, "downtime_min": downtime,
+                "budget_kcal": budget_kcal,
+                "write_behind": write_behind, "fill_s": round(fill_s, 2),
+                "sqlite": sqlite3.sqlite_version,
+            },
+            "results": {
+                "wall_s": round(wall_s, 2),
+                "simulated_s": end - start,
+                "speedup": round((end - start) / wall_s) if wall_s else None,
+                "ticks": engine.ticks,
+                "ticks_per_s": round(engine.ticks / wall_s) if wall_s else None,
+                "events": clock.events,
+                "dispensed": dispensed,
+                "dispensed_per_s": round(dispensed / wall_s) if wall_s else None,
+                "missed_windows": engine.missed,
+                "over_budget": budget.blocked,
+                "never_sent": lost,
+                "outbox": outbox,
+                "db_bytes_before": bytes_before,
+                "db_bytes_after": bytes_after,
+                "db_bytes_per_dispense": round((bytes_after - bytes_before) / dispensed, 1) if dispensed else None,
+            },
+        }
+        # Dispensados físicos frente a filas de historial: unrecorded son los
+        # que salieron sin historial (sin confirmar); duplicates, los que
+        # salieron más de una vez (cota inferior si hubo sin confirmar que no
+        # llegaron a dispensar)
+        physical = None
+        if isinstance(link, InstantLink):
+            result["results"]["frames"] = link.frames
+            physical = link.dispensed
+        elif sim is not None:
+            physical = sim.stats["dispensed"]
+        if physical is not None:
+            result["results"]["physical_dispensed"] = physical
+            result["results"]["unrecorded"] = max(0, physical - dispensed)
+            result["results"]["duplicates"] = max(0, physical - dispensed - outbox["unconfirmed"])
+        if metrics.ENABLED:
+            result["metrics"] = metrics.snapshot()
+        return result
+    finally:
+        if sim is not None:
+            sim.stop()
+        if workdir is not None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Simulación del scheduler con reloj virtual")
+    ap.add_argument("--days", type=float, default=7.0, help="tiempo simulado")
+    ap.add_argument("--schedules", type=int, default=10000, help="programaciones únicas")
+    ap.add_argument("--recurrences", type=int, default=0, help="reglas recurrentes diarias")
+    ap.add_argument("--transport", choices=("instant", "mock", "sim"), default="instant")
+    ap.add_argument("--fail-rate", type=float, default=0.0, help="fracción de confirmaciones perdidas")
+    ap.add_argument("--downtime", type=float, default=0.0, help="minutos por día con la app cerrada")
+    ap.add_argument("--budget", type=float, default=0.0, help="kcal diarias por tolva (perfiles)")
+    ap.add_argument("--no-write-behind", action="store_true", help="un commit por historial y marca")
+    ap.add_argument("--db", help="usa (y conserva) esta base en lugar de una temporal; :memory: es lo más rápido")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--save", help="guarda los resultados JSON en este archivo")
+    args = ap.parse_args()
+
+    result = run(args.days, args.schedules, args.recurrences, args.transport, args.fail_rate,
+                 args.downtime, not args.no_write_behind, args.seed, args.db, args.budget)
+    print(json.dumps(result, indent=2))
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+# Supervisor de enlaces: mantiene conectados los dispensadores de una flota
+# (fleet.Fleet). Un hilo por dispensador vigilado:
+#   - conecta y reconecta en segundo plano, con espera exponencial acotada;
+#   - con el enlace en reposo envía PING cada KEEPALIVE s; MAX_MISSES PING
+#     sin respuesta seguidos dan el enlace por muerto y se reconecta;
+#   - publica el estado del enlace (health()) y avisa cada cambio con
+#     on_change(mac, state, msg), desde su hilo.
+# El OK a PING es opcional (README): la regla de enlace muerto solo se
+# aplica a un dispensador que ya respondió algún PING.
+from time import monotonic
+import random
+import threading
+
+import metrics
+import protocol
+
+# Reposo (s) tras el cual se envía un PING
+KEEPALIVE = 15.0
+# PING seguidos sin respuesta antes de dar el enlace por muerto
+MAX_MISSES = 3
+# Espera entre intentos de conexión: BASE_DELAY * 2^(fallos-1), hasta MAX_DELAY
+BASE_DELAY = 1.0
+MAX_DELAY = 30.0
+# Sondeo del estado del enlace (s)
+POLL = 1.0
+
+CONNECTED = "conectado"
+CONNECTING = "conectando"
+DOWN = "caído"
+
+
+class LinkHealth:
+    def __init__(self, mac):
+        self.mac = mac
+        self.state = CONNECTING
+        self.msg = ""
+        self.rtt = None
+        self.misses = 0
+        self.failures = 0
+        self.reconnects = 0
+        self.since = monotonic()
+        self.last_ping = 0.0
+        self.was_connected = False
+        # El firmware respondió al menos un PING (se conserva al reconectar)
+        self.answers_ping = False
+
+    def as_dict(self, link=None):
+        worker = link.worker if link is not None else None
+        last_rx = worker.last_rx if worker is not None else None
+        return {
+            "state": self.state,
+            "msg": self.msg,
+            "rtt_ms": round(self.rtt * 1000, 1) if self.rtt is not None else None,
+            "idle_s": round(monotonic() - last_rx, 1) if last_rx is not None else None,
+            "misses": self.misses,
+            "failures": self.failures,
+            "reconnects": self.reconnects,
+            "for_s": round(monotonic() - self.since, 1),
+        }
+
+
+class LinkSupervisor:
+    def __init__(self, fleet, on_change=None, keepalive=KEEPALIVE, max_misses=MAX_MISSES):
+        self.fleet = fleet
+        self.on_change = on_change
+        self.keepalive = keepalive
+        self.max_misses = max_misses
+        self._health = {}
+        self._threads = {}
+        self._stops = {}
+        self._lock = threading.Lock()
+
+    def watch(self, mac, make_current=True):
+        # Vuelve de inmediato: la conexión ocurre en el hilo del dispensador
+        with self._lock:
+            thread = self._threads.get(mac)
+            if thread is not None and thread.is_alive():
+                if make_current and self.fleet.is_connected(mac):
+                    self.fleet.current = mac
+                return
+            stop = threading.Event()
+            self._health[mac] = LinkHealth(mac)
+            self._stops[mac] = stop
+            thread = threading.Thread(
+                target=self._run, args=(mac, stop, make_current), name=f"bt-sup-{mac}", daemon=True
+            )
+            self._threads[mac] = thread
+        thread.start()
+
+    def unwatch(self, mac):
+        with self._lock:
+            stop = self._stops.pop(mac, None)
+            thread = self._threads.pop(mac, None)
+            self._health.pop(mac, None)
+        if stop is not None:
+            stop.set()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout=2.0)
+
+    def stop(self):
+        for mac in list(self._threads):
+            self.unwatch(mac)
+
+    def health(self):
+        # {mac: {...}} (ver LinkHealth.as_dict)
+        with self._lock:
+            items = list(self._health.items())
+        return {mac: h.as_dict(self.fleet.get(mac)) for mac, h in items}
+
+    def _set(self, health, state, msg):
+        changed = state != health.state
+        health.msg = msg
+        if changed:
+            health.state = state
+            health.since = monotonic()
+        if changed and self.on_change is not None:
+            self.on_change(health.mac, state, msg)
+
+    # ---------------- Hilo por dispensador ----------------
+    def _run(self, mac, stop, make_current):
+        health = self._health[mac]
+        next_try = 0.0
+        ping = None  # (Future, enviado_en)
+        while not stop.is_set():
+            now = monotonic()
+            link = self.fleet.get(mac)
+            if link is None or not link.is_connected():
+                ping = None
+                if health.state == CONNECTED:
+                    metrics.count("bt.link_dead")
+                    self._set(health, DOWN, "Enlace perdido")
+                    next_try = now
+                if now >= next_try:
+                    ok, msg = self.fleet.connect(mac, make_current=make_current)
+                    if ok:
+                        if health.was_connected:
+                            metrics.count("bt.reconnect")
+                            health.reconnects += 1
+                        health.was_connected = True
+                        health.failures = 0
+                        health.misses = 0
+                        health.last_ping = monotonic()
+                        make_current = False
+                        self._set(health, CONNECTED, msg)
+                    else:
+                        health.failures += 1
+                        # Jitter: varios dispensadores no reintentan a la vez
+                        delay = min(MAX_DELAY, BASE_DELAY * 2 ** (health.failures - 1))
+                        next_try = monotonic() + delay * random.uniform(0.8, 1.2)
+                        self._set(health, DOWN, msg)
+            else:
+                if health.state != CONNECTED:
+                    # Ya estaba conectado al empezar a vigilarlo (p. ej.
+                    # Fleet.connect_many en daemon.py)
+                    health.was_connected = True
+                    health.last_ping = monotonic()
+                    self._set(health, CONNECTED, "Conectado")
+                ping = self._keepalive(link, health, ping, now)
+            stop.wait(POLL)
+
+    def _keepalive(self, link, health, ping, now):
+        worker = link.worker
+        if worker is None:
+            return None
+        if ping is not None:
+            fut, sent = ping
+            if not fut.done():
+                return ping
+            ok, _ = fut.result()
+            # Cuenta como respuesta solo si llegó una línea después del envío
+            # (un enlace con require_ack=False resuelve ok al agotar el tiempo)
+            if ok and worker.last_rx is not None and worker.last_rx >= sent:
+                health.rtt = worker.last_rx - sent
+                health.misses = 0
+                health.answers_ping = True
+                metrics.record("bt.ping", health.rtt)
+            else:
+                health.misses += 1
+                if health.misses >= self.max_misses and health.answers_ping:
+                    # Enlace muerto aunque el socket no lo sepa: se cierra y
+                    # el siguiente sondeo reconecta
+                    link.disconnect()
+            return None
+        # Reposo: desde la última respuesta o el último PING. Con firmware que
+        # no responde a PING sigue habiendo PING, pero sin cerrar el enlace
+        idle = now - max(worker.last_rx or 0.0, health.last_ping)
+        if idle >= self.keepalive and worker.pending() == 0:
+            health.last_ping = monotonic()
+            return (link.send_async(protocol.PING), health.last_ping)
+        return None
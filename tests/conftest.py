@@ -0,0 +1,17 @@
+# Las pruebas importan los módulos de la app desde la raíz del repositorio
+# (sin Kivy: solo lo que también usan daemon.py y simulate.py)
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import DB  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = DB(str(tmp_path / "app.db"))
+    yield db
+    db.close()
@@ -0,0 +1,55 @@
+import gzip
+import json
+
+DAY = 86400
+NOW = 1_700_000_000
+OLD = NOW - 200 * DAY
+
+
+def _archived(path):
+    rows = []
+    for f in sorted(path.iterdir()):
+        with gzip.open(f, "rt", encoding="utf-8") as src:
+            rows.extend(json.loads(line) for line in src)
+    return rows
+
+
+def test_prune_archives_and_deletes_old_rows(db, tmp_path):
+    for i in range(5):
+        db.add_history("Arroz", 1, 10, 13, OLD + i)
+    db.add_history("Arroz", 1, 10, 13, NOW)
+    archive = tmp_path / "archive"
+    assert db.prune_history(90, str(archive), now_ts=NOW, batch=2) == 5
+    assert db.count_rows("history") == 1
+    assert len(_archived(archive)) == 5
+    # Los acumulados diarios sobreviven
+    day = db._day(OLD)
+    assert db.daily_totals(day, day)[0][3] == 5
+
+
+def test_prune_keeps_row_inserted_after_archive_pass(db, tmp_path, monkeypatch):
+    for i in range(3):
+        db.add_history("Arroz", 1, 10, 13, OLD + i)
+    query = db._query
+
+    def racing_query(sql, params=()):
+        rows = query(sql, params)
+        if "FROM history" in sql and not rows:
+            # Otro hilo inserta una fila antigua entre el archivado y el borrado
+            db.add_history("Avena", 2, 5, 20, OLD)
+        return rows
+
+    monkeypatch.setattr(db, "_query", racing_query)
+    archive = tmp_path / "archive"
+    assert db.prune_history(90, str(archive), now_ts=NOW) == 3
+    monkeypatch.undo()
+    assert [r["food_name"] for r in _archived(archive)] == ["Arroz"] * 3
+    # La fila nueva no se archivó, así que tampoco se borró
+    assert db.count_rows("history") == 1
+    assert db.prune_history(90, str(archive), now_ts=NOW + 1) == 1
+    assert len(_archived(archive)) == 4
+
+
+def test_new_database_uses_incremental_vacuum(db):
+    assert db.conn.execute("PRAGMA auto_vacuum;").fetchone()[0] == 2
+    db.compact()
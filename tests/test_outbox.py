@@ -0,0 +1,128 @@
+import outbox
+from bt import MockBluetooth
+from fleet import Fleet
+from outbox import Outbox
+from simulate import InstantLink, VirtualClock
+
+START = 1_700_000_000
+CMD = ("m1", "Arroz", 1, 50, 65.0, None)
+
+
+def _outbox(db, link, errors, **kwargs):
+    clock = VirtualClock(START)
+    box = Outbox(db, link, clock.post, timer=clock, on_error=errors.append, clock=clock, **kwargs)
+    return box, clock
+
+
+def _run(box, clock, seconds):
+    clock.run(clock.now + seconds, busy=lambda: box.in_flight() > 0)
+
+
+def test_never_acked_dispense_is_written_once(db):
+    link = MockBluetooth(reply=None)
+    link.worker_options = {"ack_timeout": 0.05}
+    writes = []
+    write_line = link._write_line
+    link._write_line = lambda text: (writes.append(text), write_line(text))[1]
+    fleet = Fleet(factory=lambda: link)
+    fleet.connect("X")
+    link.wait_caps(2)
+    errors = []
+    box, clock = _outbox(db, fleet, errors)
+    try:
+        box.start()
+        box.submit([CMD])
+        # Mucho más que todos los reintentos posibles
+        _run(box, clock, outbox.MAX_ATTEMPTS * outbox.MAX_DELAY)
+    finally:
+        box.stop()
+        fleet.disconnect()
+    assert [w for w in writes if w.startswith("DISPENSE")] == ["DISPENSE:1:50"]
+    assert db.outbox_stats()["unconfirmed"] == 1
+    assert db.count_rows("history") == 0
+    assert errors
+
+
+def test_unconfirmed_is_resolved_once(db):
+    link = InstantLink(fail_rate=1.0)
+    box, clock = _outbox(db, link, [])
+    box.start()
+    box.submit([CMD])
+    _run(box, clock, 600)
+    box.stop()
+    assert (link.frames, link.dispensed) == (1, 1)
+    [row] = db.list_unconfirmed()
+    assert row[1] == "m1"
+    assert db.resolve_command("m1", True, START + 10)
+    assert not db.resolve_command("m1", True, START + 11)
+    assert db.count_rows("history") == 1
+    assert db.outbox_stats()["done"] == 1
+
+
+def test_resolved_as_not_dispensed_writes_no_history(db):
+    box, clock = _outbox(db, InstantLink(fail_rate=1.0), [])
+    box.start()
+    box.submit([CMD])
+    _run(box, clock, 600)
+    box.stop()
+    assert db.resolve_command("m1", False, START + 10)
+    assert db.count_rows("history") == 0
+    assert db.outbox_stats()["failed"] == 1
+
+
+def test_not_connected_is_retried_until_max_attempts(db):
+    link = InstantLink()
+    link.down = True
+    errors = []
+    box, clock = _outbox(db, link, errors, max_attempts=3)
+    box.start()
+    box.submit([CMD])
+    _run(box, clock, 600)
+    box.stop()
+    assert link.frames == 3
+    assert link.dispensed == 0
+    assert db.outbox_stats()["failed"] == 1
+    assert "3 intentos" in errors[-1]
+
+
+def test_retry_succeeds_after_reconnect(db):
+    link = InstantLink()
+    link.down = True
+    box, clock = _outbox(db, link, [])
+    box.start()
+    box.submit([CMD])
+    _run(box, clock, 0.5)
+    link.down = False
+    _run(box, clock, 600)
+    box.stop()
+    assert link.dispensed == 1
+    assert db.count_rows("history") == 1
+    assert db.outbox_stats()["done"] == 1
+
+
+def test_duplicate_cmd_id_is_not_sent_again(db):
+    link = InstantLink()
+    box, clock = _outbox(db, link, [])
+    box.start()
+    assert box.submit([CMD]) == 1
+    _run(box, clock, 10)
+    assert box.submit([CMD]) == 0
+    _run(box, clock, 10)
+    box.stop()
+    assert link.frames == 1
+    assert db.count_rows("history") == 1
+
+
+def test_start_recovers_interrupted_sends_as_unconfirmed(db):
+    # Un proceso anterior reclamó el comando y se cerró antes de la confirmación
+    db.enqueue_commands([CMD], START)
+    assert len(db.claim_commands(START, 10)) == 1
+    link = InstantLink()
+    errors = []
+    box, clock = _outbox(db, link, errors)
+    box.start()
+    _run(box, clock, 600)
+    box.stop()
+    assert link.frames == 0
+    assert db.outbox_stats()["unconfirmed"] == 1
+    assert errors
@@ -0,0 +1,77 @@
+from paging import KeysetPager
+
+
+def _pager(rows, page_size=3, cache_pages=4):
+    # rows ya ordenadas por clave; fetch pagina por clave como la base
+    calls = []
+
+    def fetch(after, limit):
+        calls.append(after)
+        return [r for r in rows if after is None or r > after][:limit]
+
+    pager = KeysetPager(fetch, key_of=lambda r: r, fmt=lambda r: {"text": str(r)},
+                        page_size=page_size, cache_pages=cache_pages)
+    return pager, calls
+
+
+def _texts(data):
+    return [d["text"] for d in data]
+
+
+def test_pages_load_until_exhausted():
+    pager, calls = _pager(list(range(1, 8)))
+    data = []
+    assert pager.reset(data) == 3
+    while pager.load_more(data):
+        pass
+    assert _texts(data) == [str(i) for i in range(1, 8)]
+    assert pager.exhausted
+    assert calls == [None, 3, 6]
+
+
+def test_reset_reuses_cached_pages():
+    pager, calls = _pager(list(range(1, 8)))
+    data = []
+    pager.reset(data)
+    pager.load_more(data)
+    pager.reset(data)
+    pager.load_more(data)
+    assert calls == [None, 3]
+    assert pager.page_hits == 2
+
+
+def test_cache_is_bounded():
+    pager, calls = _pager(list(range(1, 31)), cache_pages=2)
+    data = []
+    pager.reset(data)
+    while pager.load_more(data):
+        pass
+    assert len(pager._pages) == 2
+
+
+def test_upsert_inside_loaded_range():
+    rows = [1, 3, 5, 7, 9]
+    pager, calls = _pager(rows)
+    data = []
+    pager.reset(data)
+    rows[:] = [1, 2, 3, 7, 9]
+    pager.upsert(2, {"text": "2"}, data)
+    pager.upsert(3, {"text": "tres"}, data)
+    pager.upsert(5, None, data)
+    assert _texts(data) == ["1", "2", "tres"]
+    # Fuera de lo cargado solo se invalida la caché de esa página
+    pager.upsert(8, {"text": "8"}, data)
+    assert pager.keys == [1, 2, 3]
+    rows.insert(4, 8)
+    pager.load_more(data)
+    assert _texts(data) == ["1", "2", "tres", "7", "8", "9"]
+
+
+def test_shrink_and_offset():
+    pager, calls = _pager(list(range(1, 10)))
+    data = [{"text": "cabecera"}]
+    pager.reset(data, offset=1)
+    pager.load_more(data)
+    pager.shrink(data, offset=1)
+    assert _texts(data) == ["cabecera", "1", "2", "3"]
+    assert not pager.exhausted
@@ -0,0 +1,72 @@
+from time import monotonic, sleep
+
+import protocol
+from bt import MockBluetooth
+
+
+def test_dispense_cmd_rounds_grams():
+    assert protocol.dispense_cmd(2, 49.6) == "DISPENSE:2:50"
+
+
+def test_batch_roundtrip():
+    pairs = [(1, 50), (2, 10), (3, 125)]
+    line = protocol.batch_cmd(pairs)
+    assert line.startswith(protocol.BATCH_PREFIX)
+    assert protocol.parse_batch(line) == pairs
+
+
+def test_batch_checksum_mismatch_is_rejected():
+    line = protocol.batch_cmd([(1, 50), (2, 10)])
+    assert protocol.parse_batch(line.replace("1:50", "1:51")) is None
+    assert protocol.parse_batch("DISPENSEB:1:50") is None
+
+
+def test_parse_caps():
+    assert protocol.parse_caps("OK:BATCH, FOO") == {"BATCH", "FOO"}
+    assert protocol.parse_caps("ERR:UNKNOWN") == set()
+    assert protocol.parse_caps(None) == set()
+
+
+def test_chunks_respect_max_batch():
+    sizes = [len(c) for c in protocol.chunks(list(range(19)))]
+    assert sizes == [protocol.MAX_BATCH, protocol.MAX_BATCH, 3]
+
+
+class _Silent(MockBluetooth):
+    # Firmware antiguo: no responde nada, ni a CAPS
+    def _read_line(self):
+        return None
+
+
+def _connect(link):
+    link.worker_options = {"ack_timeout": 0.05}
+    link.connect("X")
+    link.wait_caps(2)
+    return link
+
+
+def _wait_ready(link, timeout=1.0):
+    # Tras un tiempo agotado el hilo espera otro ack_timeout antes de escribir
+    deadline = monotonic() + timeout
+    while link.worker.pending() and monotonic() < deadline:
+        sleep(0.01)
+
+
+def test_ack_required_when_firmware_answers_caps():
+    link = _connect(MockBluetooth(reply=None))
+    try:
+        assert link.worker.require_ack
+        assert link.send(protocol.dispense_cmd(1, 50), timeout=2)[0] is None
+    finally:
+        link.disconnect()
+
+
+def test_old_firmware_keeps_fire_and_forget():
+    link = _connect(_Silent())
+    try:
+        assert not link.worker.require_ack
+        assert link.caps == frozenset()
+        _wait_ready(link)
+        assert link.send(protocol.dispense_cmd(1, 50), timeout=2)[0] is True
+    finally:
+        link.disconnect()
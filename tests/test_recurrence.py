@@ -0,0 +1,87 @@
+import os
+import time
+from datetime import datetime
+
+import pytest
+
+from recurrence import CronRule, TimesRule, canonical, next_occurrence, parse_rule
+
+HOUR = 3600
+
+
+@pytest.fixture
+def madrid():
+    # Zona con horario de verano: 29/03/2026 02:00 -> 03:00, 25/10/2026 03:00 -> 02:00
+    old = os.environ.get("TZ")
+    os.environ["TZ"] = "Europe/Madrid"
+    time.tzset()
+    yield
+    if old is None:
+        del os.environ["TZ"]
+    else:
+        os.environ["TZ"] = old
+    time.tzset()
+
+
+def _ts(*args):
+    return int(datetime(*args).timestamp())
+
+
+def _local(ts):
+    return datetime.fromtimestamp(ts)
+
+
+def test_parse_rule_formats():
+    assert isinstance(parse_rule("08:00,13:30"), TimesRule)
+    assert parse_rule("lun,mie 07:15").weekdays == {0, 2}
+    assert isinstance(parse_rule("*/30 6-20 * * 1-5"), CronRule)
+    with pytest.raises(ValueError):
+        parse_rule("lun,vie")
+    with pytest.raises(ValueError):
+        parse_rule("xyz 08:00")
+    assert canonical("lun,vie", "08:00") == "lun,vie 08:00"
+
+
+def test_next_occurrence_is_strictly_after(madrid):
+    after = _ts(2026, 5, 4, 8, 0)
+    assert _local(next_occurrence("08:00,13:30", after)) == datetime(2026, 5, 4, 13, 30)
+    assert _local(next_occurrence("08:00,13:30", after - 1)) == datetime(2026, 5, 4, 8, 0)
+
+
+def test_weekdays_and_end(madrid):
+    # 2026-05-04 es lunes
+    after = _ts(2026, 5, 4, 12, 0)
+    assert _local(next_occurrence("lun,vie 07:15", after)) == datetime(2026, 5, 8, 7, 15)
+    assert next_occurrence("lun,vie 07:15", after, end_ts=_ts(2026, 5, 7)) is None
+
+
+def test_cron_dom_or_dow(madrid):
+    # Día del mes y de la semana restringidos: basta con que coincida uno
+    after = _ts(2026, 5, 1, 12, 0)
+    assert _local(next_occurrence("0 9 15 * 1", after)) == datetime(2026, 5, 4, 9, 0)
+
+
+def test_daily_across_spring_forward(madrid):
+    first = next_occurrence("08:00", _ts(2026, 3, 28, 12, 0))
+    second = next_occurrence("08:00", first)
+    assert _local(first) == datetime(2026, 3, 29, 8, 0)
+    assert _local(second) == datetime(2026, 3, 30, 8, 0)
+    # Ese día dura 23 h
+    assert first - _ts(2026, 3, 28, 8, 0) == 23 * HOUR
+
+
+def test_time_inside_spring_forward_gap_runs_once(madrid):
+    # 02:30 no existe el 29/03: se ejecuta una vez, al salir del hueco
+    first = next_occurrence("02:30", _ts(2026, 3, 28, 12, 0))
+    second = next_occurrence("02:30", first)
+    assert _local(first) == datetime(2026, 3, 29, 3, 30)
+    assert _local(second) == datetime(2026, 3, 30, 2, 30)
+
+
+def test_repeated_hour_in_fall_back_runs_once(madrid):
+    # 02:30 ocurre dos veces el 25/10: solo la primera cuenta
+    first = next_occurrence("02:30", _ts(2026, 10, 24, 12, 0))
+    second = next_occurrence("02:30", first)
+    assert _local(first) == datetime(2026, 10, 25, 2, 30)
+    assert _local(second) == datetime(2026, 10, 26, 2, 30)
+    assert second - first == 25 * HOUR